@@ -0,0 +1,311 @@
+"""
+Benchmarks of the main operations of napari-annotation-project on a
+synthetic project: project load and save, file switching and annotation
+saving in the widget, and export. Each benchmark is timed over several
+runs and its peak memory is measured in a separate run. tracemalloc gives
+the peak of Python allocations of the benchmark process, which misses export
+worker processes and pages of memory-mapped files. When psutil is installed,
+the resident memory (RSS) of the process and of its children is also sampled
+during that run, which includes both.
+Results are saved as JSON and can be compared with a previous run:
+
+    python benchmarks/run_benchmarks.py --files 50 --shape 1024 1024 --output new.json
+    python benchmarks/run_benchmarks.py --output new.json --compare old.json
+
+Qt runs offscreen, so the benchmarks also run on machines without display.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from napari_annotation_project import project as pr
+from napari_annotation_project import export
+
+sys.path.insert(0, str(Path(__file__).parent))
+from synthetic import make_project
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCHMARKS = {}
+
+
+def benchmark(name, gui=False):
+    """Register a benchmark. The function gets a BenchmarkContext and
+    returns the number of items (files, crops) it processed."""
+
+    def register(function):
+        BENCHMARKS[name] = (function, gui)
+        return function
+    return register
+
+
+class BenchmarkContext:
+    """Synthetic project and objects shared by benchmarks."""
+
+    def __init__(self, folder, num_workers):
+
+        self.folder = Path(folder)
+        self.project_path = self.folder.joinpath('project')
+        self.num_workers = num_workers
+        self._widget = None
+
+    @property
+    def widget(self):
+        """ProjectWidget with the project loaded, created on first use."""
+
+        if self._widget is None:
+            import napari
+            from napari_annotation_project import ProjectWidget
+            self.viewer = napari.Viewer(show=False)
+            self._widget = ProjectWidget(self.viewer)
+            self._widget._on_click_load_project(project_path=self.project_path)
+            self._widget.file_list.setCurrentRow(0)
+        return self._widget
+
+    def close(self):
+
+        if self._widget is not None:
+            self._widget._close_project()
+            self.viewer.close()
+            # closing the viewer removes the rois layer, which saves rois
+            self._widget.param_saver.flush()
+            self._widget = None
+
+
+@benchmark('load_project')
+def bench_load_project(ctx):
+
+    params = pr.load_project(ctx.project_path)
+    return len(params.file_paths)
+
+
+@benchmark('save_parameters')
+def bench_save_parameters(ctx):
+
+    params = pr.load_project(ctx.project_path)
+    params.save_parameters()
+    return len(params.file_paths)
+
+
+@benchmark('switch_file', gui=True)
+def bench_switch_file(ctx):
+
+    widget = ctx.widget
+    for i in range(widget.file_list.count()):
+        widget.file_list.setCurrentRow(i)
+    widget.annotation_writer.drain()
+    return widget.file_list.count()
+
+
+@benchmark('save_annotations', gui=True)
+def bench_save_annotations(ctx):
+
+    ctx.widget.save_annotations(force=True)
+    return 1
+
+
+@benchmark('export_full')
+def bench_export_full(ctx):
+
+    rows = export.export_project(
+        ctx.project_path, ctx.folder.joinpath('export'), num_workers=ctx.num_workers, force=True)
+    return len(rows)
+
+
+@benchmark('export_incremental')
+def bench_export_incremental(ctx):
+
+    rows = export.export_project(
+        ctx.project_path, ctx.folder.joinpath('export'), num_workers=ctx.num_workers)
+    return len(rows)
+
+
+@benchmark('export_shards')
+def bench_export_shards(ctx):
+
+    rows = export.export_project_shards(
+        ctx.project_path, ctx.folder.joinpath('export_shards'), num_workers=ctx.num_workers)
+    return len(rows)
+
+
+class PeakRSS:
+    """Sample the resident memory of the process and of its children in a
+    background thread while in the context, and keep the peak of their sum.
+    Pages of memory-mapped files that are read are part of the resident
+    memory, unlike for tracemalloc."""
+
+    def __init__(self, interval=0.005):
+
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _rss(self):
+
+        rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                # the child exited since it was listed
+                pass
+        return rss
+
+    def _sample(self):
+
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._rss())
+
+    def __enter__(self):
+
+        self.start = self.peak = self._rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+def run_benchmark(name, ctx, repeat):
+    """Time a benchmark and measure its peak memory."""
+
+    function, _ = BENCHMARKS[name]
+    # first run warms up caches and is not measured
+    items = function(ctx)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(ctx)
+        times.append(time.perf_counter() - start)
+
+    rss = PeakRSS() if psutil is not None else None
+    tracemalloc.start()
+    if rss is not None:
+        with rss:
+            function(ctx)
+    else:
+        function(ctx)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'times': times,
+        'min': min(times),
+        'mean': sum(times) / len(times),
+        'items': items,
+        'time_per_item': min(times) / max(items, 1),
+        # Python allocations of this process only
+        'peak_memory_mb': peak / 2**20,
+        # process and worker processes, including memory-mapped pages
+        'peak_rss_mb': rss.peak / 2**20 if rss is not None else None,
+        'peak_rss_increase_mb': (rss.peak - rss.start) / 2**20 if rss is not None else None,
+    }
+
+
+def _git_commit():
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Print the ratio of the best times of two result sets."""
+
+    print(f"\n{'benchmark':<22}{'previous (s)':>14}{'current (s)':>14}{'ratio':>8}")
+    for name, result in results['results'].items():
+        if name not in previous['results']:
+            continue
+        before = previous['results'][name]['min']
+        print(f"{name:<22}{before:>14.4f}{result['min']:>14.4f}{result['min'] / before:>8.2f}")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmarks of napari-annotation-project.')
+    parser.add_argument('--files', type=int, default=20, help='number of images')
+    parser.add_argument('--shape', type=int, nargs='+', default=[512, 512], help='shape of images')
+    parser.add_argument('--rois', type=int, default=10, help='number of rois per image')
+    parser.add_argument('--roi-size', type=int, default=64)
+    parser.add_argument('--density', type=float, default=0.1, help='fraction of annotated pixels')
+    parser.add_argument('--backend', choices=pr.BACKENDS, default='yaml')
+    parser.add_argument('--compression', default=None, help='compression of annotation files')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs')
+    parser.add_argument('-j', '--num-workers', type=int, default=1, help='export worker processes')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--no-gui', action='store_true', help='skip benchmarks using the widget')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file for results')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run')
+    parser.add_argument('--keep', default=None, help='folder where the synthetic project is kept')
+    args = parser.parse_args(argv)
+
+    config = {
+        'files': args.files, 'shape': args.shape, 'rois': args.rois, 'roi_size': args.roi_size,
+        'density': args.density, 'backend': args.backend, 'compression': args.compression,
+        'repeat': args.repeat, 'num_workers': args.num_workers}
+    names = args.only if args.only is not None else list(BENCHMARKS)
+    if args.no_gui:
+        names = [n for n in names if not BENCHMARKS[n][1]]
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_folder:
+        folder = Path(args.keep) if args.keep is not None else Path(temp_folder)
+        make_project(
+            folder, num_files=args.files, shape=tuple(args.shape), rois_per_file=args.rois,
+            roi_size=args.roi_size, annotation_density=args.density, backend=args.backend,
+            compression=args.compression)
+        ctx = BenchmarkContext(folder, args.num_workers)
+        results = {}
+        try:
+            for name in names:
+                results[name] = run_benchmark(name, ctx, args.repeat)
+                rss_increase = results[name]['peak_rss_increase_mb']
+                print(f"{name:<22}{results[name]['min']:>10.4f} s"
+                      f"{results[name]['peak_memory_mb']:>10.1f} MB"
+                      + (f"{rss_increase:>10.1f} MB RSS" if rss_increase is not None else ''))
+        finally:
+            ctx.close()
+            # the widget changes the working directory to the project
+            os.chdir(cwd)
+
+    output = {
+        'metadata': {
+            'commit': _git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': config},
+        'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(output, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Generation of synthetic projects used by the benchmarks.
+"""
+from pathlib import Path
+import numpy as np
+import tifffile
+
+from napari_annotation_project import project as pr
+from napari_annotation_project.image_io import write_annotations
+
+
+def make_project(folder, num_files=20, shape=(512, 512), rois_per_file=10, roi_size=64,
+                 annotation_density=0.1, backend='yaml', compression=None, seed=0):
+    """
+    Create a project with random images, annotations and rois.
+
+    Parameters
+    ----------
+    folder : str or Path
+        folder where images and project are created
+    num_files : int
+        number of images of the project
+    shape : tuple
+        shape of each image, the last two dimensions being the plane
+    rois_per_file : int
+        number of rois of each image, placed at random positions
+    roi_size : int
+        side length of the rois
+    annotation_density : float
+        fraction of labelled pixels in the annotations. Files are annotated
+        as squares so that compressed annotations are representative.
+    backend : str
+        'yaml' or 'sqlite'
+    compression : str, optional
+        compression of annotation files
+    seed : int
+        seed of the random number generator
+
+    Returns
+    -------
+    project_path : Path
+        path of the project
+    """
+
+    rng = np.random.default_rng(seed)
+    folder = Path(folder)
+    images_path = folder.joinpath('images')
+    images_path.mkdir(parents=True, exist_ok=True)
+    project_path = folder.joinpath('project')
+
+    file_paths = []
+    rois = {}
+    for i in range(num_files):
+        image_path = images_path.joinpath(f'image_{i:05d}.tif')
+        tifffile.imwrite(image_path, rng.integers(0, 255, shape, dtype=np.uint8), photometric='minisblack')
+        file_paths.append(image_path.as_posix())
+
+        corners = np.stack([rng.integers(0, s, rois_per_file) for s in shape[:-2]] + [
+            rng.integers(0, shape[-2] - roi_size, rois_per_file),
+            rng.integers(0, shape[-1] - roi_size, rois_per_file)], axis=1)
+        offsets = np.zeros((4, len(shape)))
+        offsets[:, -2:] = [[0, 0], [0, roi_size], [roi_size, roi_size], [roi_size, 0]]
+        rois[image_path.as_posix()] = corners[:, np.newaxis, :] + offsets[np.newaxis]
+
+    channels = {f: Path(f).stem for f in file_paths}
+    params = pr.create_project(
+        project_path, file_paths=file_paths, channels=channels, rois=rois, backend=backend)
+    params.annotation_compression = compression
+    params.save_parameters()
+
+    for f in file_paths:
+        annotations = np.zeros(shape, dtype=np.uint16)
+        num_pixels = annotation_density * shape[-2] * shape[-1]
+        side = max(1, int(np.sqrt(num_pixels / 10)))
+        for _ in range(10):
+            y = rng.integers(0, max(1, shape[-2] - side))
+            x = rng.integers(0, max(1, shape[-1] - side))
+            annotations[..., y:y+side, x:x+side] = rng.integers(1, 5)
+        write_annotations(pr.get_annotation_path(project_path, f), annotations, compression=compression)
+
+    return project_path
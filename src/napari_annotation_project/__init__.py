@@ -5,4 +5,13 @@ except ImportError:
     __version__ = "unknown"
 
 
-from .project_widget import ProjectWidget
\ No newline at end of file
+__all__ = ['ProjectWidget']
+
+
+def __getattr__(name):
+    # the widget pulls in Qt and napari, it is only imported when requested
+    # so that scripts using the project functions stay lightweight
+    if name == 'ProjectWidget':
+        from .project_widget import ProjectWidget
+        return ProjectWidget
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,76 @@
+import numpy as np
+import tifffile
+import pytest
+
+from napari_annotation_project import project as pr
+from napari_annotation_project.dataset import ProjectDataset
+
+
+@pytest.fixture
+def project_path(tmp_path):
+
+    image = np.arange(2 * 30 * 40, dtype=np.uint16).reshape(2, 30, 40)
+    tifffile.imwrite(tmp_path.joinpath('image.tif'), image)
+    file_path = tmp_path.joinpath('image.tif').as_posix()
+    rois = {file_path: [[1, 0, 0, 1, 0, 10, 1, 10, 10, 1, 10, 0], [0, 5, 5, 0, 5, 25, 0, 20, 25, 0, 20, 5]] * 10}
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(project_path, file_paths=[file_path], channels={file_path: None}, rois=rois)
+    annotation = np.zeros((2, 30, 40), dtype=np.uint16)
+    annotation[1, 2:5, 2:5] = 1
+    tifffile.imwrite(pr.get_annotation_path(project_path, file_path), annotation)
+    return project_path, image, annotation
+
+def test_dataset_getitem(project_path):
+
+    project_path, image, annotation = project_path
+    dataset = ProjectDataset(project_path)
+    assert len(dataset) == 20
+
+    image_crop, label_crop, metadata = dataset[0]
+    np.testing.assert_array_equal(image_crop, image[1, 0:10, 0:10])
+    np.testing.assert_array_equal(label_crop, annotation[1, 0:10, 0:10])
+    assert (metadata['crop_index'], metadata['roi_index'], metadata['plane']) == (0, 0, (1,))
+
+    image_crop, _, metadata = dataset[-1]
+    np.testing.assert_array_equal(image_crop, image[0, 5:20, 5:25])
+    assert metadata['crop_index'] == 19
+    with pytest.raises(IndexError):
+        dataset[20]
+
+def test_dataset_iter(project_path):
+
+    project_path, image, _ = project_path
+    dataset = ProjectDataset(project_path, num_threads=3, read_ahead=4)
+    crops = list(dataset)
+    assert [m['crop_index'] for _, _, m in crops] == list(range(20)), 'Crops not in order'
+    np.testing.assert_array_equal(crops[3][0], image[0, 5:20, 5:25])
+
+    # stopping early does not leave reads running
+    for i, _ in enumerate(dataset):
+        if i == 2:
+            break
+
+def test_dataset_open_files(project_path, monkeypatch):
+
+    from napari_annotation_project import dataset as dataset_module
+
+    project_path, image, _ = project_path
+    opened = []
+    original = dataset_module.open_file_readers
+    def open_file_readers(task):
+        opened.append(task['file_name'])
+        return original(task)
+    monkeypatch.setattr(dataset_module, 'open_file_readers', open_file_readers)
+
+    # each file is opened once for all its crops, in any order
+    with ProjectDataset(project_path, num_threads=3, read_ahead=4) as dataset:
+        for index in [5, 0, 19, 3]:
+            dataset[index]
+        crops = list(dataset)
+        assert len(opened) == 1, 'File opened for each crop'
+    np.testing.assert_array_equal(crops[3][0], image[0, 5:20, 5:25])
+
+    # closed files are opened again
+    dataset[0]
+    assert len(opened) == 2
+    dataset.close()
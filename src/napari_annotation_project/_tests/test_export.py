@@ -0,0 +1,212 @@
+import csv
+import threading
+import numpy as np
+import tifffile
+import pytest
+
+from napari_annotation_project import project as pr
+from napari_annotation_project import export
+
+
+@pytest.fixture
+def project_with_rois(tmp_path):
+
+    image = np.random.randint(0, 255, (30, 40), dtype=np.uint8)
+    image2 = np.random.randint(0, 255, (3, 30, 40), dtype=np.uint8)
+    annotation = np.random.randint(0, 3, (30, 40), dtype=np.uint16)
+    tifffile.imwrite(tmp_path.joinpath('image.tif'), image)
+    tifffile.imwrite(tmp_path.joinpath('image2.tif'), image2)
+
+    file_paths = [tmp_path.joinpath('image.tif').as_posix(), tmp_path.joinpath('image2.tif').as_posix()]
+    rois = {
+        file_paths[0]: [[0, 0, 0, 10, 10, 10, 10, 0], [5, 5, 5, 25, 20, 25, 20, 5]],
+        file_paths[1]: [[2, 3, 4, 2, 3, 14, 2, 13, 14, 2, 13, 4]]}
+    channels = {f: None for f in file_paths}
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(project_path, file_paths=file_paths, channels=channels, rois=rois)
+    tifffile.imwrite(pr.get_annotation_path(project_path, file_paths[0]), annotation)
+
+    return project_path, file_paths, image, image2, annotation
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_export_project(project_with_rois, tmp_path, num_workers):
+
+    project_path, file_paths, image, image2, annotation = project_with_rois
+    export_folder = tmp_path.joinpath('export')
+    export.export_project(project_path, export_folder, num_workers=num_workers)
+
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_0.tif')), image[0:10, 0:10])
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('target', 'target_0.tif')), annotation[0:10, 0:10])
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_1.tif')), image[5:20, 5:25])
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_2.tif')), image2[2, 3:13, 4:14])
+    # missing annotations are exported as empty crops
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('target', 'target_2.tif')), np.zeros((10, 10)))
+
+    with open(export_folder.joinpath('rois_infos.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [r['file_name'] for r in rows] == [file_paths[0], file_paths[0], file_paths[1]]
+    assert [r['image_index'] for r in rows] == ['1', '2', '3']
+    assert [r['roi_index'] for r in rows] == ['0', '1', '0']
+
+def test_export_main(project_with_rois, tmp_path):
+
+    project_path, _, image, _, _ = project_with_rois
+    export_folder = tmp_path.joinpath('export_cli')
+    export.main([project_path.as_posix(), export_folder.as_posix(), '-j', '1', '--source-folder-name', 'images'])
+
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('images', 'img_0.tif')), image[0:10, 0:10])
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_export_project_shards(project_with_rois, tmp_path, num_workers):
+
+    project_path, file_paths, image, image2, annotation = project_with_rois
+    export_folder = tmp_path.joinpath('export_shards')
+    # small shards to get crops distributed over several files
+    export.export_project_shards(project_path, export_folder, shard_size=300, num_workers=num_workers)
+    assert len(list(export_folder.glob('shard_*.npy'))) > 1
+
+    crops = export.ShardedCrops(export_folder)
+    assert len(crops) == 3
+    image_crop, label_crop, metadata = crops[1]
+    np.testing.assert_array_equal(image_crop, image[5:20, 5:25])
+    np.testing.assert_array_equal(label_crop, annotation[5:20, 5:25])
+    assert label_crop.dtype == annotation.dtype
+    assert metadata == {'crop_index': 1, 'file_name': file_paths[0], 'roi_index': 1, 'plane': ()}
+
+    image_crop, label_crop, metadata = crops[2]
+    np.testing.assert_array_equal(image_crop, image2[2, 3:13, 4:14])
+    np.testing.assert_array_equal(label_crop, np.zeros((10, 10)))
+    assert metadata['plane'] == (2,)
+
+def test_export_project_incremental(project_with_rois, tmp_path):
+
+    project_path, file_paths, image, image2, annotation = project_with_rois
+    export_folder = tmp_path.joinpath('export_incremental')
+    export.export_project(project_path, export_folder, num_workers=1)
+
+    def mtimes():
+        return {p.relative_to(export_folder).as_posix(): p.stat().st_mtime_ns
+                for p in export_folder.glob('*/*.tif')}
+    first = mtimes()
+
+    # nothing changed, nothing is written
+    export.export_project(project_path, export_folder, num_workers=1)
+    assert mtimes() == first
+
+    # painting outside of the rois does not change crops
+    annotation[25:, 30:] = 5
+    tifffile.imwrite(pr.get_annotation_path(project_path, file_paths[0]), annotation)
+    export.export_project(project_path, export_folder, num_workers=1)
+    assert mtimes() == first
+
+    # removing the first roi renames the following crops and deletes the last one
+    params = pr.load_project(project_path)
+    params.rois[file_paths[0]] = params.rois[file_paths[0]][1:]
+    params.save_parameters()
+    export.export_project(project_path, export_folder, num_workers=1)
+    assert sorted(mtimes()) == ['source/img_0.tif', 'source/img_1.tif', 'target/target_0.tif', 'target/target_1.tif']
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_0.tif')), image[5:20, 5:25])
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('target', 'target_0.tif')), annotation[5:20, 5:25])
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_1.tif')), image2[2, 3:13, 4:14])
+    assert mtimes()['source/img_0.tif'] == first['source/img_1.tif'], 'Crop written instead of renamed'
+
+    # crops missing after an interruption are written again
+    export_folder.joinpath('source', 'img_1.tif').unlink()
+    export.export_project(project_path, export_folder, num_workers=1)
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_1.tif')), image2[2, 3:13, 4:14])
+    assert len(export.ExportManifest(export_folder).read()) == 2
+
+def test_export_project_cancel(project_with_rois, tmp_path):
+
+    project_path, _, _, image2, _ = project_with_rois
+    export_folder = tmp_path.joinpath('export_cancel')
+
+    # cancel once the first file is written
+    cancel_event = threading.Event()
+    exporter = export.iter_export_project(project_path, export_folder, num_workers=1, cancel_event=cancel_event)
+    assert next(exporter) == (0, 3, 0)
+    done, total, nbytes = next(exporter)
+    assert (done, total) == (2, 3) and nbytes > 0
+    cancel_event.set()
+    with pytest.raises(StopIteration) as stop:
+        next(exporter)
+    assert [r['image_index'] for r in stop.value.value] == [1, 2], 'Unwritten crops listed'
+    assert not export_folder.joinpath('source', 'img_2.tif').exists()
+
+    # exporting again resumes the export
+    progress = list(export.iter_export_project(project_path, export_folder, num_workers=1))
+    assert progress[-1][:2] == (1, 1)
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_2.tif')), image2[2, 3:13, 4:14])
+
+def test_export_project_force(project_with_rois, tmp_path):
+
+    project_path, file_paths, image, image2, annotation = project_with_rois
+    export_folder = tmp_path.joinpath('export_force')
+    export.export_project(project_path, export_folder, num_workers=1)
+
+    # crops that are no longer exported are removed with force
+    params = pr.load_project(project_path)
+    params.rois[file_paths[0]] = params.rois[file_paths[0]][:1]
+    params.save_parameters()
+    export.export_project(project_path, export_folder, num_workers=1, force=True)
+    assert sorted(p.relative_to(export_folder).as_posix() for p in export_folder.glob('*/*.tif')) == [
+        'source/img_0.tif', 'source/img_1.tif', 'target/target_0.tif', 'target/target_1.tif']
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_1.tif')), image2[2, 3:13, 4:14])
+    assert len(export.ExportManifest(export_folder).read()) == 2
+
+def test_export_project_channel(project_with_rois, tmp_path, monkeypatch):
+
+    project_path, file_paths, image, image2, annotation = project_with_rois
+    np.testing.assert_array_equal(export.read_layer(file_paths[1]), image2)
+
+    # a channel other than the image itself is read with napari readers
+    params = pr.load_project(project_path)
+    params.channels[file_paths[1]] = 'image2 [1]'
+    params.save_parameters()
+    channel_image = image2[::-1].copy()
+    read = []
+    def read_layer(image_path, channel=None):
+        read.append(channel)
+        return channel_image
+    monkeypatch.setattr(export, 'read_layer', read_layer)
+
+    export_folder = tmp_path.joinpath('export_channel')
+    export.export_project(project_path, export_folder, num_workers=1)
+    assert read == ['image2 [1]']
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_0.tif')), image[0:10, 0:10])
+    np.testing.assert_array_equal(tifffile.imread(export_folder.joinpath('source', 'img_2.tif')), channel_image[2, 3:13, 4:14])
+
+    # changing the channel exports the crops again
+    params.channels[file_paths[1]] = 'image2 [2]'
+    params.save_parameters()
+    export.export_project(project_path, export_folder, num_workers=1)
+    assert read == ['image2 [1]', 'image2 [2]']
+
+def test_plan_export_roi_order(project_with_rois):
+
+    project_path, file_paths, image, image2, annotation = project_with_rois
+    params = pr.load_project(project_path)
+    params.rois[file_paths[1]] = np.array([[[2, 3, 4], [2, 3, 14], [2, 13, 14], [2, 13, 4]],
+                                           [[0, 3, 4], [0, 3, 14], [0, 13, 14], [0, 13, 4]],
+                                           [[2, 0, 0], [2, 0, 5], [2, 5, 5], [2, 5, 0]]], dtype=float)
+    task = export._plan_export(params)[1]
+    # rois are cropped plane by plane
+    assert task['roi_order'] == [1, 0, 2]
+    crops = list(export.iter_file_crops(task))
+    assert [c[0] for c in crops] == [1, 0, 2]
+    np.testing.assert_array_equal(crops[1][2], image2[2, 3:13, 4:14])
+    assert [c[0] for c in export.iter_file_crops(task, [2, 1])] == [1, 2]
+
+def test_read_layer_channels(project_with_rois, monkeypatch):
+
+    from napari.plugins import io as napari_io
+
+    _, file_paths, _, image2, _ = project_with_rois
+    # readers splitting channels open one layer per channel, named as in the viewer
+    monkeypatch.setattr(napari_io, 'read_data_with_plugins', lambda paths, stack: (
+        [(image2, {'channel_axis': 0}), (image2[0], {'name': 'mask'})], None))
+    np.testing.assert_array_equal(export.read_layer(file_paths[1]), image2[0])
+    np.testing.assert_array_equal(export.read_layer(file_paths[1], 'image2 [2]'), image2[2])
+    np.testing.assert_array_equal(export.read_layer(file_paths[1], 'mask'), image2[0])
+    with pytest.raises(ValueError):
+        export.read_layer(file_paths[1], 'image2 [3]')
@@ -0,0 +1,83 @@
+import time
+
+from napari_annotation_project.folder_list_widget import FolderList
+from napari_annotation_project.parameters import Param
+
+
+def test_folder_list(qtbot):
+
+    file_list = FolderList(None)
+    qtbot.addWidget(file_list)
+    changes = []
+    file_list.currentItemChanged.connect(
+        lambda current, previous: changes.append((
+            current.text() if current is not None else None,
+            previous.text() if previous is not None else None)))
+
+    files = [f'folder{i % 10}/image_{i:06d}.tif' for i in range(100000)]
+    start = time.perf_counter()
+    assert len(file_list.add_files(files + files[:10])) == 100000, 'Duplicates added'
+    assert time.perf_counter() - start < 2, 'Adding files is too slow'
+    assert file_list.count() == 100000
+    assert file_list.row_of('folder3/image_099993.tif') == 99993
+    assert file_list.item(5).text() == files[5]
+
+    file_list.setCurrentRow(10)
+    assert changes == [(files[10], None)]
+
+    # filtering keeps the current file
+    file_list.set_filter('image_0000')
+    assert file_list.filter_model.rowCount() == 100
+    file_list.set_filter('image_00001')
+    assert file_list.filter_model.rowCount() == 10
+    assert file_list.selectionModel().currentIndex().row() == 0, 'Current file not selected'
+    file_list.set_filter('', allowed={files[1], files[2]})
+    assert file_list.filter_model.rowCount() == 2
+    assert file_list.currentRow() == 10, 'Hidden current file changed'
+    file_list.add_files(['folder0/new.tif'])
+    assert file_list.filter_model.rowCount() == 2, 'New file not filtered'
+    file_list.set_filter()
+    assert file_list.filter_model.rowCount() == 100001
+
+    # renaming and removing files update the rows
+    file_list.item(10).setText('images/image_000010.tif')
+    assert file_list.row_of('images/image_000010.tif') == 10
+    assert file_list.row_of(files[10]) == -1
+    file_list.takeItem(10)
+    assert changes[-1] == (files[11], 'images/image_000010.tif')
+    assert file_list.row_of(files[11]) == 10
+    assert len(changes) == 2
+
+
+def test_folder_list_params(qtbot):
+
+    file_list = FolderList(None)
+    qtbot.addWidget(file_list)
+    files = [f'image_{i:06d}.tif' for i in range(100000)]
+    params = Param(file_paths=list(files))
+    file_list.set_params(params)
+    assert file_list.count() == 100000
+
+    # files are added, renamed and removed in the list of the parameters
+    file_paths = params.file_paths
+    file_list.add_files(['new.tif'])
+    file_list.item(1).setText('renamed.tif')
+    start = time.perf_counter()
+    for _ in range(1000):
+        file_list.takeItem(2)
+    assert time.perf_counter() - start < 1, 'Removing files is too slow'
+    assert params.file_paths is file_paths
+    assert params.file_paths == [files[0], 'renamed.tif'] + files[1002:] + ['new.tif']
+    assert file_list.row_of(files[1002]) == 2
+    assert file_list.row_of('new.tif') == 99000
+    assert file_list.row_of(files[2]) == -1
+
+    # clearing the list leaves the parameters untouched, a new project
+    # takes the files shown in the list
+    file_list.clear()
+    assert len(params.file_paths) == 99001
+    file_list.add_files(['a.tif'])
+    other = Param()
+    file_list.set_params(other)
+    file_list.add_files(['b.tif'])
+    assert other.file_paths == ['a.tif', 'b.tif']
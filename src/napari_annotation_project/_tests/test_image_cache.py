@@ -0,0 +1,36 @@
+import time
+import numpy as np
+import tifffile
+
+from napari_annotation_project.image_cache import ImageCache
+
+
+def test_image_cache(tmp_path):
+
+    paths = []
+    for i in range(3):
+        paths.append(tmp_path.joinpath(f'image{i}.tif'))
+        tifffile.imwrite(paths[-1], np.full((10, 10), i, dtype=np.uint8))
+
+    # only two images fit in the cache
+    cache = ImageCache(max_bytes=250)
+    np.testing.assert_array_equal(cache.get(paths[0]), np.zeros((10, 10)))
+    assert (cache.hits, cache.misses) == (0, 1)
+    cache.get(paths[0])
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.prefetch(paths[1:])
+    for _ in range(100):
+        if cache.stats()['pending'] == 0:
+            break
+        time.sleep(0.05)
+    assert cache.nbytes <= 250, 'Cache exceeds memory limit'
+    np.testing.assert_array_equal(cache.get(paths[2]), np.full((10, 10), 2))
+    assert cache.hits == 2, 'Prefetched image not served from cache'
+
+    # modified files are read again
+    tifffile.imwrite(paths[2], np.full((10, 10), 5, dtype=np.uint8))
+    cache.invalidate(paths[2])
+    np.testing.assert_array_equal(cache.pop(paths[2]), np.full((10, 10), 5))
+    assert cache.stats()['entries'] == 1
+    cache.close()
@@ -0,0 +1,100 @@
+import numpy as np
+import tifffile
+import pytest
+
+from napari_annotation_project import image_io
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_region_reader(tmp_path, compression):
+
+    image = np.random.randint(0, 255, (2, 3, 40, 50), dtype=np.uint8)
+    tifffile.imwrite(tmp_path.joinpath('image.tif'), image, compression=compression)
+    roi = np.array([[1, 2, 5, 10], [1, 2, 5, 30], [1, 2, 25, 30], [1, 2, 25, 10]])
+
+    with image_io.RegionReader(tmp_path.joinpath('image.tif')) as reader:
+        assert reader.shape == image.shape
+        crop = reader.read_roi(roi, annotations_ndim=4)
+
+    np.testing.assert_array_equal(crop, image[1, 2, 5:25, 10:30])
+    np.testing.assert_array_equal(crop, image_io.crop_roi(image, roi, 4))
+
+def test_region_reader_memmap(tmp_path):
+
+    image = np.random.randint(0, 255, (40, 50), dtype=np.uint16)
+    tifffile.imwrite(tmp_path.joinpath('image.tif'), image)
+    roi = np.array([[0, 0], [0, 10], [10, 10], [10, 0]])
+
+    reader = image_io.RegionReader(tmp_path.joinpath('image.tif'))
+    assert isinstance(reader._array, np.memmap), 'Uncompressed file not memory-mapped'
+    np.testing.assert_array_equal(reader.read_roi(roi, 2), image[0:10, 0:10])
+    reader.close()
+
+def test_compressed_annotations(tmp_path):
+
+    annotations = np.zeros((3, 100, 130), dtype=np.uint16)
+    annotations[1, 10:80, 20:100] = 2
+    image_io.write_annotations(tmp_path.joinpath('annot.tif'), annotations, compression='zlib', tile_size=64)
+    image_io.write_annotations(tmp_path.joinpath('annot_raw.tif'), annotations)
+
+    assert tmp_path.joinpath('annot.tif').stat().st_size < tmp_path.joinpath('annot_raw.tif').stat().st_size / 10
+    np.testing.assert_array_equal(image_io.read_annotations(tmp_path.joinpath('annot.tif')), annotations)
+    np.testing.assert_array_equal(image_io.read_annotations(tmp_path.joinpath('annot_raw.tif')), annotations)
+
+    # region reads only decode the required tiles
+    roi = np.array([[1, 50, 60], [1, 50, 120], [1, 90, 120], [1, 90, 60]])
+    with image_io.RegionReader(tmp_path.joinpath('annot.tif')) as reader:
+        np.testing.assert_array_equal(reader.read_roi(roi, 3), annotations[1, 50:90, 60:120])
+
+def test_annotations_memmap(tmp_path):
+
+    annotations = np.zeros((40, 50), dtype=np.uint8)
+    annotations[5:10, 5:10] = 1
+    image_io.write_annotations(tmp_path.joinpath('annot.tif'), annotations, compression='zlib', tile_size=16)
+
+    # missing and compressed files cannot be memory-mapped
+    assert image_io.memmap_annotations(tmp_path.joinpath('new_annot.tif'), (40, 50)) is None
+    assert image_io.memmap_annotations(tmp_path.joinpath('annot.tif'), (40, 50)) is None
+
+    # compressed files are converted to memory-mappable files
+    data = image_io.create_annotations_memmap(tmp_path.joinpath('annot.tif'), image_io.read_annotations(tmp_path.joinpath('annot.tif')))
+    np.testing.assert_array_equal(data, annotations)
+    data[20, 20] = 2
+    data.flush()
+    del data
+    assert image_io.read_annotations(tmp_path.joinpath('annot.tif'))[20, 20] == 2
+
+    data = image_io.memmap_annotations(tmp_path.joinpath('annot.tif'), (40, 50))
+    assert data.dtype == np.uint8 and data[20, 20] == 2
+    del data
+    with pytest.raises(ValueError):
+        image_io.memmap_annotations(tmp_path.joinpath('annot.tif'), (30, 50))
+
+def test_annotation_writer(tmp_path):
+
+    writer = image_io.AnnotationWriter()
+    annotations = np.zeros((40, 50), dtype=np.uint16)
+    path = tmp_path.joinpath('annot.tif')
+    for i in range(3):
+        annotations[i, i] = i + 1
+        writer.submit(path, annotations)
+    # the data can be modified once submitted
+    annotations[:] = 0
+    writer.wait(path)
+    assert not writer.is_pending(path)
+
+    saved = image_io.read_annotations(path)
+    assert (saved[0, 0], saved[1, 1], saved[2, 2]) == (1, 2, 3), 'Writes not done in order'
+    assert list(tmp_path.iterdir()) == [path], 'Temporary file left'
+
+    # errors of completed writes are reported once
+    future = writer.submit(tmp_path.joinpath('missing', 'annot.tif'), annotations)
+    assert isinstance(future.exception(timeout=10), FileNotFoundError)
+    with pytest.raises(FileNotFoundError):
+        writer.drain()
+    writer.drain()
+
+    writer.submit(tmp_path.joinpath('missing', 'annot.tif'), annotations).exception(timeout=10)
+    with pytest.raises(FileNotFoundError):
+        writer.wait(tmp_path.joinpath('missing', 'annot.tif'))
+    writer.wait(tmp_path.joinpath('missing', 'annot.tif'))
@@ -0,0 +1,50 @@
+import json
+import subprocess
+import sys
+
+# generous budget for the headless import, which takes ~0.1 s
+IMPORT_BUDGET = 1.5
+
+
+def _import_in_subprocess(code):
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    # cumulative time in us of the top level modules imported by the code
+    total = 0
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].startswith(' napari_annotation_project'):
+            total += int(fields[1])
+    return json.loads(result.stdout), total / 1e6
+
+
+def test_headless_import():
+
+    modules, duration = _import_in_subprocess(
+        "import sys, json; import napari_annotation_project.project; "
+        "import napari_annotation_project.export; import napari_annotation_project.integrity; "
+        "print(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules))))")
+    for heavy in ['napari', 'qtpy', 'PyQt5', 'skimage']:
+        assert heavy not in modules, f'{heavy} imported by headless use'
+    assert duration < IMPORT_BUDGET, f'Import took {duration:.2f} s'
+
+
+def test_lazy_widget():
+
+    modules, _ = _import_in_subprocess(
+        "import sys, json; import napari_annotation_project as nap; "
+        "assert nap.ProjectWidget.__name__ == 'ProjectWidget'; "
+        "print(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules))))")
+    assert 'qtpy' in modules
+
+
+def test_widget_lazy_imports():
+
+    modules, _ = _import_in_subprocess(
+        "import sys, json; import napari_annotation_project.project_widget; "
+        "print(json.dumps(sorted(m for m in sys.modules if m.startswith('napari_annotation_project'))))")
+    # modules of the export, tiling, copy and cache features are imported
+    # when they are first used
+    for lazy in ['export', 'dataset', 'integrity', 'tiling', 'local_copy', 'metadata', 'thumbnails', 'pyramid']:
+        assert f'napari_annotation_project.{lazy}' not in modules, f'{lazy} imported with the widget'
@@ -0,0 +1,38 @@
+import csv
+import numpy as np
+
+from napari_annotation_project import instrumentation
+
+
+def test_timed(tmp_path):
+
+    @instrumentation.timed('double', nbytes=lambda result, x: x.nbytes)
+    def double(x):
+        return 2 * x
+
+    instrumentation.clear()
+    instrumentation.disable()
+    double(np.ones(10))
+    assert instrumentation.records() == [], 'Timing recorded while disabled'
+
+    instrumentation.enable(capacity=5)
+    try:
+        for _ in range(7):
+            np.testing.assert_array_equal(double(np.ones(10)), 2)
+    finally:
+        instrumentation.disable()
+
+    records = instrumentation.records()
+    assert len(records) == 5, 'Ring buffer not bounded'
+    summary = instrumentation.summary()['double']
+    assert summary['count'] == 5
+    assert summary['bytes'] == 5 * 80
+    assert summary['p50'] <= summary['p99'] <= summary['max']
+
+    instrumentation.export_log(tmp_path.joinpath('log.csv'))
+    with open(tmp_path.joinpath('log.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [r['name'] for r in rows] == ['double'] * 5
+    instrumentation.enable(capacity=instrumentation.DEFAULT_CAPACITY)
+    instrumentation.disable()
+    instrumentation.clear()
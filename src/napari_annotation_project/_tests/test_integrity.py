@@ -0,0 +1,95 @@
+import shutil
+import numpy as np
+import tifffile
+import pytest
+
+from napari_annotation_project import project as pr
+from napari_annotation_project import integrity
+
+
+@pytest.fixture
+def broken_project(tmp_path):
+
+    images = tmp_path.joinpath('images')
+    images.joinpath('a').mkdir(parents=True)
+    images.joinpath('b').mkdir()
+    file_paths = [
+        images.joinpath('a', 'image.tif').as_posix(),
+        images.joinpath('b', 'image.tif').as_posix(),
+        images.joinpath('moved.tif').as_posix(),
+        images.joinpath('float.tif').as_posix()]
+    for file_path in file_paths:
+        tifffile.imwrite(file_path, np.zeros((30, 40), dtype=np.uint8))
+    rois = {
+        file_paths[0]: [[0, 0, 0, 10, 10, 10, 10, 0], [20, 30, 20, 50, 40, 50, 40, 30]],
+        file_paths[2]: [[0, 0, 0, 10, 10, 10, 10, 0]]}
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(project_path, file_paths=file_paths, channels={f: None for f in file_paths}, rois=rois)
+
+    tifffile.imwrite(pr.get_annotation_path(project_path, file_paths[2]), np.zeros((30, 40), dtype=np.uint16))
+    tifffile.imwrite(pr.get_annotation_path(project_path, file_paths[3]), np.zeros((20, 40), dtype=np.float32))
+    tifffile.imwrite(project_path.joinpath('annotations', 'deleted_annot.tif'), np.zeros((5, 5), dtype=np.uint16))
+    # the third file is moved to another folder
+    images.joinpath('new').mkdir()
+    shutil.move(file_paths[2], images.joinpath('new', 'moved.tif'))
+
+    return project_path, file_paths, images
+
+def test_check_project(broken_project):
+
+    project_path, file_paths, _ = broken_project
+    issues = integrity.check_project(project_path, num_threads=2)
+    kinds = {(i['kind'], i['file_path']) for i in issues}
+    assert kinds == {
+        ('missing_source', file_paths[2]),
+        ('annotation_dtype', file_paths[3]),
+        ('annotation_shape', file_paths[3]),
+        ('roi_out_of_bounds', file_paths[0]),
+        ('stem_collision', file_paths[0]),
+        ('stem_collision', file_paths[1]),
+        ('orphaned_annotation', None)}
+    out_of_bounds = [i for i in issues if i['kind'] == 'roi_out_of_bounds'][0]
+    assert out_of_bounds['rois'] == [1]
+    orphan = [i for i in issues if i['kind'] == 'orphaned_annotation'][0]
+    assert orphan['path'].name == 'deleted_annot.tif'
+
+def test_repair_project(broken_project):
+
+    project_path, file_paths, images = broken_project
+    actions, issues = integrity.repair_project(
+        project_path, search_roots=[images], clip=True, move_orphans=True, num_threads=2)
+
+    new_path = images.joinpath('new', 'moved.tif').absolute().as_posix()
+    assert actions['relinked'] == {file_paths[2]: new_path}
+    assert actions['clipped'] == 1
+    assert {i['kind'] for i in issues} == {'annotation_dtype', 'annotation_shape', 'stem_collision'}
+
+    params = pr.load_project(project_path)
+    # relinked files keep their position, rois and annotations
+    assert params.file_paths[2] == new_path
+    assert len(params.rois[new_path]) == 1
+    np.testing.assert_array_equal(params.rois[file_paths[0]][1], [[20, 30], [20, 40], [30, 40], [30, 30]])
+    assert project_path.joinpath('annotations', 'orphaned', 'deleted_annot.tif').exists()
+
+def test_integrity_main(broken_project, capsys):
+
+    project_path, file_paths, _ = broken_project
+    assert integrity.main([project_path.as_posix(), '--remove-missing', '-j', '2']) == 1
+    assert f"Removed {file_paths[2]}" in capsys.readouterr().out
+    assert file_paths[2] not in pr.load_project(project_path).file_paths
+
+@pytest.mark.parametrize('backend', pr.BACKENDS)
+def test_remove_last_file(tmp_path, backend):
+
+    file_path = tmp_path.joinpath('image.tif').as_posix()
+    tifffile.imwrite(file_path, np.zeros((30, 40), dtype=np.uint8))
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(project_path, file_paths=[file_path], channels={file_path: None},
+                      rois={file_path: [[0, 0, 0, 10, 10, 10, 10, 0]]}, backend=backend)
+    tmp_path.joinpath('image.tif').unlink()
+
+    # removing the only file leaves an empty project
+    actions, issues = integrity.repair_project(project_path, remove_missing=True, num_threads=2)
+    assert actions['removed'] == [file_path]
+    assert issues == []
+    assert not pr.load_project(project_path).file_paths
@@ -0,0 +1,40 @@
+import threading
+import pytest
+
+from napari_annotation_project import local_copy
+
+
+def test_copy_files(tmp_path):
+
+    tmp_path.joinpath('a').mkdir()
+    tmp_path.joinpath('b').mkdir()
+    tmp_path.joinpath('a', 'image.tif').write_bytes(b'first image')
+    tmp_path.joinpath('b', 'image.tif').write_bytes(b'second image')
+    tmp_path.joinpath('b', 'same.tif').write_bytes(b'first image')
+    files = [tmp_path.joinpath(*f).as_posix() for f in [('a', 'image.tif'), ('b', 'image.tif'), ('b', 'same.tif')]]
+
+    folder = tmp_path.joinpath('images')
+    results = {source: name for source, name, error in local_copy.copy_files(files, folder)}
+
+    # same names get distinct copies, identical contents are stored once.
+    # Which file keeps its original name depends on the copy order
+    assert results[files[0]] == results[files[2]]
+    assert results[files[1]] != results[files[0]]
+    assert results[files[1]] in ['image.tif', 'image_1.tif']
+    assert results[files[0]] in ['image.tif', 'image_1.tif', 'same.tif']
+    assert folder.joinpath(results[files[1]]).read_bytes() == b'second image'
+    assert folder.joinpath(local_copy.INDEX_NAME).is_file(), 'Index not saved'
+
+    # a new copy is deduplicated using the saved index
+    index = local_copy.CopyIndex(folder)
+    assert local_copy.copy_to_folder(files[1], folder, index) == results[files[1]]
+
+def test_copy_cancelled(tmp_path):
+
+    tmp_path.joinpath('image.tif').write_bytes(b'image')
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(local_copy.CopyCancelled):
+        local_copy.copy_to_folder(tmp_path.joinpath('image.tif'), tmp_path.joinpath('images'),
+                                  local_copy.CopyIndex(tmp_path.joinpath('images')), cancel_event)
+    assert not tmp_path.joinpath('images', 'image.tif').exists()
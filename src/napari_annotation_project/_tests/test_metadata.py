@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import tifffile
+import pytest
+from skimage.io import imsave
+
+from napari_annotation_project import project as pr
+from napari_annotation_project import export
+from napari_annotation_project.metadata import MetadataCache, read_metadata
+
+
+def test_read_metadata(tmp_path):
+
+    tifffile.imwrite(tmp_path.joinpath('stack.tif'), np.zeros((3, 20, 30), dtype=np.uint16))
+    tifffile.imwrite(tmp_path.joinpath('rgb.tif'), np.zeros((20, 30, 3), dtype=np.uint8), photometric='rgb')
+    imsave(tmp_path.joinpath('rgb.png'), np.zeros((20, 30, 3), dtype=np.uint8), check_contrast=False)
+
+    stack = read_metadata(tmp_path.joinpath('stack.tif'))
+    assert (stack['shape'], stack['dtype'], stack['rgb']) == ((3, 20, 30), 'uint16', False)
+    rgb = read_metadata(tmp_path.joinpath('rgb.tif'))
+    assert (rgb['shape'], rgb['channels'], rgb['rgb']) == ((20, 30, 3), 3, True)
+    png = read_metadata(tmp_path.joinpath('rgb.png'))
+    assert (png['shape'], png['dtype'], png['rgb']) == ((20, 30, 3), 'uint8', True)
+    assert read_metadata(tmp_path.joinpath('image.czi')) is None
+
+def test_metadata_cache(tmp_path):
+
+    image_path = tmp_path.joinpath('image.tif')
+    tifffile.imwrite(image_path, np.zeros((20, 30), dtype=np.uint8))
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(project_path, file_paths=[image_path.as_posix()])
+
+    with MetadataCache(project_path) as cache:
+        headers = cache.update([image_path.as_posix(), 'missing.tif'])
+        assert list(headers) == [image_path.as_posix()]
+        assert headers[image_path.as_posix()]['shape'] == (20, 30)
+
+    # entries are reloaded from the project cache folder
+    with MetadataCache(project_path) as cache:
+        assert image_path.as_posix() in cache._entries
+        # a modified file is read again
+        tifffile.imwrite(image_path, np.zeros((2, 20, 30), dtype=np.uint8))
+        os.utime(image_path, ns=(0, 10**9))
+        assert cache.get(image_path.as_posix())['shape'] == (2, 20, 30)
+
+def test_export_checks_dimensions(tmp_path):
+
+    image_path = tmp_path.joinpath('image.tif')
+    tifffile.imwrite(image_path, np.zeros((2, 20, 30), dtype=np.uint8))
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(
+        project_path, file_paths=[image_path.as_posix()],
+        rois={image_path.as_posix(): [[0, 0, 0, 10, 10, 10, 10, 0]]})
+
+    with pytest.raises(ValueError, match='dimensions'):
+        export.export_project(project_path, tmp_path.joinpath('export'), num_workers=1)
+    assert not tmp_path.joinpath('export', export.MANIFEST_NAME).exists(), 'Export started'
@@ -1,8 +1,10 @@
 import shutil
+import pytest
 from pathlib import Path
 import numpy as np
 import skimage.io
 from napari_annotation_project import project as pr
+from napari_annotation_project.rois import rois_to_list
 
 
 demoimage = np.random.randint(0,255, (30,30), dtype=np.uint8)
@@ -51,11 +53,68 @@ def test_load_project():
     rois = {f: [] for f in file_paths}
     channels = {f: None for f in file_paths}
 
-    assert project.rois == rois, 'rois not imported or saved correctly'
+    assert {k: rois_to_list(v) for k, v in project.rois.items()} == rois, 'rois not imported or saved correctly'
     assert project.channels == channels, 'channels not imported or saved correctly'
 
 def remove_test_folder():
 
     proj_path = Path('src/napari_annotation_project/_tests/test_project')
     if proj_path.exists():
-        shutil.rmtree(proj_path)
\ No newline at end of file
+        shutil.rmtree(proj_path)
+
+def test_param_saver(tmp_path):
+
+    from napari_annotation_project.parameters import ParamSaver
+
+    project = pr.create_project(project_path=tmp_path.joinpath('saver_project'))
+    saver = ParamSaver(delay=10)
+    for i in range(5):
+        project.rois['file.tif'] = [[0, 0, 0, i, i, i, i, 0]]
+        saver.request_save(project)
+    assert saver.pending, 'Save request not pending'
+    assert pr.load_project(project.project_path).rois == {}, 'Parameters saved before quiet period'
+
+    saver.flush()
+    assert not saver.pending
+    assert rois_to_list(pr.load_project(project.project_path).rois['file.tif']) == [[0, 0, 0, 4, 4, 4, 4, 0]]
+
+    saver.delay = 0.01
+    project.channels['file.tif'] = 'file'
+    saver.request_save(project)
+    saver.close()
+    assert pr.load_project(project.project_path).channels == {'file.tif': 'file'}
+    assert not project.project_path.joinpath('Parameters.yml.tmp').exists()
+
+def test_param_saver_copy_and_retry(tmp_path):
+
+    from napari_annotation_project.parameters import ParamSaver
+
+    project = pr.create_project(project_path=tmp_path.joinpath('saver_project'))
+    saver = ParamSaver(delay=10)
+    project.channels['file.tif'] = 'requested'
+    saver.request_save(project)
+    # parameters are copied when written, so the latest changes are saved
+    project.channels['file.tif'] = 'modified'
+    saver.flush()
+    assert pr.load_project(project.project_path).channels == {'file.tif': 'modified'}
+
+    # parameters whose write failed stay pending and are written again
+    moved_path = tmp_path.joinpath('moved')
+    project.project_path.rename(moved_path)
+    project.channels['file.tif'] = 'retried'
+    saver.request_save(project)
+    with pytest.raises(FileNotFoundError):
+        saver.flush()
+    assert saver.pending, 'Failed save dropped'
+    moved_path.rename(project.project_path)
+    saver.close()
+    assert pr.load_project(project.project_path).channels == {'file.tif': 'retried'}
+
+    # a failing flush still stops the saver
+    saver = ParamSaver(delay=10)
+    project.project_path.rename(moved_path)
+    saver.request_save(project)
+    with pytest.raises(FileNotFoundError):
+        saver.close()
+    assert saver._closed and saver._thread is None
+    moved_path.rename(project.project_path)
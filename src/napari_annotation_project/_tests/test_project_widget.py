@@ -5,8 +5,12 @@ from pathlib import Path
 import numpy as np
 import skimage.io
 import shutil
+import sys
+import time
+from qtpy.QtCore import Qt
 
 import napari_annotation_project.project as pr
+from napari_annotation_project import image_io
 
 demoimage = np.random.randint(0,255, (30,30), dtype=np.uint8)
 demoimage2 = np.random.randint(0,255, (30,30), dtype=np.uint8)
@@ -23,6 +27,12 @@ if proj_path.exists():
 projlocal_path = Path('src/napari_annotation_project/_tests/test_project_local').absolute()
 if projlocal_path.exists():
     shutil.rmtree(projlocal_path)
+projbulk_path = Path('src/napari_annotation_project/_tests/test_project_bulk').absolute()
+if projbulk_path.exists():
+    shutil.rmtree(projbulk_path)
+projdisk_path = Path('src/napari_annotation_project/_tests/test_project_disk').absolute()
+if projdisk_path.exists():
+    shutil.rmtree(projdisk_path)
 
 '''def test_fake():
     assert True
@@ -67,7 +77,7 @@ def test_project_widget_add_file(project_widget):
     project_widget.file_list.addItem(data_path.joinpath('demo_data2.tif').as_posix())
     assert project_widget.file_list.count() == 2, 'Second file not added'
 
-def test_project_widget_add_file_local(project_widget):
+def test_project_widget_add_file_local(project_widget, qtbot):
         
     project_widget.params = pr.create_project(projlocal_path)
     assert projlocal_path.joinpath('Parameters.yml').is_file(), 'Parameters file not created'
@@ -85,7 +95,16 @@ def test_project_widget_add_file_local(project_widget):
     project_widget.file_list.addItem(data_path.joinpath('demo_data2.tif').as_posix())
     assert project_widget.file_list.count() == 2, 'Second file not added'
 
+    # files are copied in the background
+    qtbot.waitUntil(lambda: len(project_widget._copy_workers) == 0, timeout=10000)
     assert project_widget.params.project_path.joinpath('images','demo_data.tif').is_file(), 'Local file not added'
+    assert project_widget.params.file_paths == ['images/demo_data.tif', 'images/demo_data2.tif'], 'File list not updated'
+
+    # identical files are only stored once
+    project_widget.file_list.addItem(data_path.joinpath('demo_data.tif').as_posix())
+    qtbot.waitUntil(lambda: len(project_widget._copy_workers) == 0, timeout=10000)
+    assert project_widget.file_list.count() == 2, 'Duplicate file not removed'
+    assert len(list(project_widget.params.project_path.joinpath('images').glob('*.tif'))) == 2
 
 def test_project_add_roi(project_widget):
     
@@ -114,7 +133,7 @@ def test_project_add_save_annotation(project_widget):
     assert proj_path.joinpath('annotations','demo_data_annot.tif').is_file(), 'Annotation not saved'
     assert proj_path.joinpath('annotations','demo_data2_annot.tif').is_file(), 'Second annotation not saved'
 
-def test_project_export(project_widget):
+def test_project_export(project_widget, qtbot):
     
     project_widget._on_click_load_project(project_path=proj_path)
     project_widget.file_list.setCurrentRow(0)
@@ -123,7 +142,11 @@ def test_project_export(project_widget):
     if not project_widget.export_folder.exists():
         project_widget.export_folder.mkdir(exist_ok=False)
 
+    # the export runs in the background without changing the selection
     project_widget._export_data()
+    qtbot.waitUntil(lambda: project_widget._export_worker is None, timeout=10000)
+    assert project_widget.file_list.currentRow() == 0, 'Selection changed by export'
+    assert project_widget.export_info.text() == 'Export finished.'
 
     assert project_widget.export_folder.joinpath('source','img_0.tif').is_file(), 'Source image not exported'
     import_crop = skimage.io.imread(Path(project_widget.export_folder).joinpath('source','img_0.tif'))
@@ -133,6 +156,31 @@ def test_project_export(project_widget):
     import_crop = skimage.io.imread(Path(project_widget.export_folder).joinpath('source','img_1.tif'))
     np.testing.assert_array_equal(import_crop, demoimage2[0:15,0:15], 'Second cropped image not correct')
 
+def test_project_filter_files(project_widget):
+
+    project_widget._on_click_load_project(project_path=proj_path)
+    project_widget.file_list.setCurrentRow(0)
+    project_widget.file_filter.setText('data2')
+    assert project_widget.file_list.filter_model.rowCount() == 1, 'Files not filtered by name'
+    project_widget.file_filter.setText('')
+    project_widget.file_status_filter.setCurrentText('Has ROIs')
+    assert project_widget.file_list.filter_model.rowCount() == 2
+    project_widget.file_status_filter.setCurrentText('Missing file')
+    assert project_widget.file_list.filter_model.rowCount() == 0, 'Files not filtered by status'
+    assert project_widget.file_list.currentRow() == 0, 'Current file changed by filter'
+    project_widget.file_status_filter.setCurrentText('All files')
+
+def test_project_thumbnails(project_widget, qtbot):
+
+    project_widget._on_click_load_project(project_path=proj_path)
+    project_widget.check_show_thumbnails.setChecked(True)
+    model = project_widget.file_list.file_model
+    # thumbnails are created in the background and shown once ready
+    qtbot.waitUntil(lambda: model.data(model.index(0), Qt.DecorationRole) is not None, timeout=10000)
+    assert proj_path.joinpath('cache', 'thumbnails').is_dir(), 'Thumbnails not saved'
+    project_widget.check_show_thumbnails.setChecked(False)
+    assert model.data(model.index(0), Qt.DecorationRole) is None
+
 def test_project_load(project_widget):
         
     project_widget._on_click_load_project(project_path=proj_path)
@@ -144,13 +192,201 @@ def test_project_load(project_widget):
     np.testing.assert_array_equal(project_widget.viewer.layers['rois'].data[0], expected_roi, 'Wrong roi')
     np.testing.assert_array_equal(project_widget.viewer.layers['annotations'].data, image_annotation2, 'Wrong annotation')
 
-def test_project_remove_file(project_widget):
+    # loading a project closes the image cache of the previous one
+    image_cache = project_widget.image_cache
+    project_widget._on_click_load_project(project_path=proj_path)
+    assert image_cache._executor._shutdown, 'Image cache not closed'
+    assert project_widget.image_cache is not image_cache
+
+def test_project_remove_file(project_widget, monkeypatch):
     
     project_widget._on_click_load_project(project_path=proj_path)
     
     assert project_widget.file_list.count() == 2, 'Wrong number of files'
     
     project_widget.file_list.setCurrentRow(1)
+    # modified annotations are saved in the background when the file is
+    # deselected. Writes are slowed down so that the save is still running
+    # when the file is deleted
+    write_annotations = image_io.write_annotations
+    def slow_write(*args, **kwargs):
+        time.sleep(0.5)
+        write_annotations(*args, **kwargs)
+    monkeypatch.setattr(image_io, 'write_annotations', slow_write)
+    project_widget._annotations_modified = True
+    annotation_file = pr.get_annotation_path(proj_path, project_widget._get_current_file())
     project_widget._on_remove_file()
     
-    assert project_widget.file_list.count() == 1, 'Second image not removed correctly'
\ No newline at end of file
+    assert project_widget.file_list.count() == 1, 'Second image not removed correctly'
+    project_widget.annotation_writer.drain()
+    assert not annotation_file.exists(), 'Annotations of removed file written again'
+
+def test_project_add_files(project_widget):
+
+    project_widget.params = pr.create_project(projbulk_path)
+    inserted = []
+    project_widget.file_list.model().rowsInserted.connect(lambda parent, first, last: inserted.append((first, last)))
+
+    # folders are searched recursively and duplicates are skipped
+    added = project_widget.add_files([data_path, data_path.joinpath('demo_data.tif')])
+    assert len(added) == 2, 'Files not added'
+    assert inserted == [(0, 1)], 'Files not added in a single batch'
+    assert project_widget.params.file_paths == [
+        data_path.joinpath('demo_data.tif').as_posix(), data_path.joinpath('demo_data2.tif').as_posix()]
+
+    added = project_widget.add_files([data_path.joinpath('demo_data2.tif')])
+    assert len(added) == 0, 'Duplicate file added'
+    assert project_widget.file_list.count() == 2
+
+    # headers of added files are read in the background
+    metadata = project_widget._get_metadata()
+    metadata.update_async([]).result()
+    header = metadata._entries[data_path.joinpath('demo_data.tif').as_posix()]
+    assert header['shape'] == skimage.io.imread(data_path.joinpath('demo_data.tif')).shape
+    assert projbulk_path.joinpath('cache', 'metadata.sqlite').exists(), 'Metadata not saved'
+
+def test_project_save_modified_annotations_only(project_widget):
+
+    project_widget._on_click_load_project(project_path=projbulk_path)
+    project_widget.file_list.setCurrentRow(0)
+    project_widget.file_list.setCurrentRow(1)
+    assert not projbulk_path.joinpath('annotations', 'demo_data_annot.tif').exists(), 'Unmodified annotation saved'
+
+    project_widget.viewer.layers['annotations'].fill((0, 0), 2)
+    project_widget.file_list.setCurrentRow(0)
+    # annotations of the previous file are written in the background
+    project_widget.annotation_writer.drain()
+    assert projbulk_path.joinpath('annotations', 'demo_data2_annot.tif').is_file(), 'Modified annotation not saved'
+
+    project_widget.save_annotations(force=True)
+    assert projbulk_path.joinpath('annotations', 'demo_data_annot.tif').is_file(), 'Forced save not done'
+
+def test_project_out_of_core(project_widget):
+
+    project_widget.params = pr.create_project(projdisk_path)
+    project_widget.check_out_of_core.setChecked(True)
+    project_widget.add_files([data_path])
+    project_widget.file_list.setCurrentRow(0)
+
+    # the annotation file is only created once annotations are modified
+    annotation_file = projdisk_path.joinpath('annotations', 'demo_data_annot.tif')
+    annotation_file.unlink(missing_ok=True)
+    project_widget.file_list.setCurrentRow(1)
+    project_widget.file_list.setCurrentRow(0)
+    assert not annotation_file.exists(), 'Annotation file created without modification'
+    project_widget.viewer.layers['annotations'].fill((0, 0), 3)
+    assert isinstance(project_widget.viewer.layers['annotations'].data, np.memmap), 'Annotations not memory-mapped'
+    project_widget.file_list.setCurrentRow(1)
+
+    saved = skimage.io.imread(annotation_file)
+    assert saved[0, 0] == 3, 'Out-of-core annotation not saved'
+
+    # compressed files are left untouched until annotations are modified
+    image_io.write_annotations(annotation_file, saved, compression='zlib')
+    mtime = annotation_file.stat().st_mtime_ns
+    project_widget.file_list.setCurrentRow(0)
+    assert project_widget.viewer.layers['annotations'].data[0, 0] == 3
+    project_widget.file_list.setCurrentRow(1)
+    assert annotation_file.stat().st_mtime_ns == mtime, 'Compressed annotations converted without modification'
+
+def test_project_pyramids(project_widget, qtbot):
+
+    project_widget._on_click_load_project(project_path=projdisk_path)
+    project_widget.pyramid_min_size = 16
+    project_widget.file_list.setCurrentRow(0)
+    project_widget.check_use_pyramids.setChecked(True)
+    # pyramids are built in the background and used once ready
+    file_path = project_widget.file_list.item(1).text()
+    qtbot.waitUntil(lambda: project_widget._get_pyramids().get(file_path) is not None, timeout=10000)
+    project_widget.file_list.setCurrentRow(1)
+
+    assert project_widget.viewer.layers[0].multiscale, 'Image not opened as pyramid'
+    assert project_widget.viewer.layers['annotations'].data.shape == (30, 30), 'Annotations not full resolution'
+    project_widget.check_use_pyramids.setChecked(False)
+
+def test_project_add_tiles(project_widget, monkeypatch, qtbot):
+
+    project_widget._on_click_load_project(project_path=projbulk_path)
+    project_widget.file_list.setCurrentRow(0)
+    project_widget.tile_size.setValue(10)
+    project_widget.tile_stride.setValue(10)
+    project_widget._on_click_add_tiles()
+    assert len(project_widget.viewer.layers['rois'].data) == 9, 'Grid not added'
+    assert len(project_widget.params.rois[project_widget._get_current_file()]) == 9, 'Rois not saved'
+
+    # rois overlapping existing rois are skipped
+    project_widget.check_tile_no_overlap.setChecked(True)
+    project_widget._on_click_add_tiles()
+    assert len(project_widget.viewer.layers['rois'].data) == 9, 'Overlapping rois added'
+    project_widget.check_tile_no_overlap.setChecked(False)
+
+    # a grid over other files is created in the background without reading
+    # their annotations
+    widget_module = sys.modules[type(project_widget).__module__]
+    def read_annotations(path):
+        raise AssertionError('Annotations read for a grid')
+    with monkeypatch.context() as m:
+        m.setattr(widget_module, 'read_annotations', read_annotations)
+        project_widget.check_tile_all_files.setChecked(True)
+        second_file = project_widget.file_list.item(1).text()
+        num_rois = len(project_widget.params.rois.get(second_file, []))
+        assert project_widget._on_click_add_tiles() is not None
+        qtbot.waitUntil(lambda: project_widget._tiling_worker is None, timeout=10000)
+    assert len(project_widget.params.rois[second_file]) == num_rois + 9, 'Grid not added to other files'
+
+    # sampling over the project uses the saved annotations of other files
+    project_widget.tiling_mode.setCurrentText('Labelled regions')
+    project_widget.tile_number.setValue(5)
+    project_widget.check_tile_all_files.setChecked(True)
+    # rois of other files are set at once and saved in a single save
+    set_files = []
+    set_rois = project_widget.params.set_rois
+    monkeypatch.setattr(project_widget.params, 'set_rois', lambda f, r: (set_files.append(f), set_rois(f, r)))
+    project_widget._on_click_add_tiles()
+    qtbot.waitUntil(lambda: project_widget._tiling_worker is None, timeout=10000)
+    assert len(project_widget.params.rois[second_file]) == num_rois + 9 + 5, 'Rois not sampled in other files'
+    assert second_file not in set_files, 'Rois of other files set one by one'
+
+def test_project_timings(project_widget, tmp_path):
+
+    from napari_annotation_project import instrumentation
+
+    project_widget.check_record_timings.setChecked(True)
+    try:
+        project_widget._on_click_load_project(project_path=proj_path)
+        project_widget.file_list.setCurrentRow(0)
+        project_widget.file_list.setCurrentRow(1)
+    finally:
+        project_widget.check_record_timings.setChecked(False)
+
+    names = [project_widget.timings_table.item(i, 0).text() for i in range(project_widget.timings_table.rowCount())]
+    assert {'load_project', 'open_file', 'select_file'}.issubset(names), 'Operations not timed'
+    project_widget._on_save_timings(path=tmp_path.joinpath('timings.csv'))
+    assert tmp_path.joinpath('timings.csv').is_file()
+    instrumentation.clear()
+
+def test_project_annotation_write_error(project_widget, monkeypatch, tmp_path):
+
+    project_widget.params = pr.create_project(tmp_path.joinpath('project'))
+    project_widget.add_files([data_path])
+    project_widget.file_list.setCurrentRow(0)
+
+    # a failed background write is reported when the file is selected
+    # again, and the file is still opened
+    widget_module = sys.modules[type(project_widget).__module__]
+    errors = []
+    monkeypatch.setattr(widget_module, 'show_error', errors.append)
+    def failing_write(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(image_io, 'write_annotations', failing_write)
+    project_widget.viewer.layers['annotations'].fill((0, 0), 2)
+    project_widget.file_list.setCurrentRow(1)
+    project_widget.file_list.setCurrentRow(0)
+    assert len(errors) == 1 and 'disk full' in errors[0], 'Write error not reported'
+    assert 'annotations' in project_widget.viewer.layers, 'File not opened after a write error'
+
+    # an export is not started with annotations that could not be saved
+    project_widget.export_folder = tmp_path.joinpath('export')
+    project_widget.viewer.layers['annotations'].fill((0, 0), 3)
+    assert project_widget._export_data() is None, 'Export started after a write error'
+    assert len(errors) == 2
@@ -0,0 +1,66 @@
+import threading
+import numpy as np
+import tifffile
+
+from napari_annotation_project import project as pr
+from napari_annotation_project.pyramid import PyramidCache, build_pyramid
+
+
+def test_build_pyramid(tmp_path):
+
+    image = np.random.randint(0, 255, (2, 101, 60), dtype=np.uint8)
+    tifffile.imwrite(tmp_path.joinpath('image.tif'), image, compression='zlib')
+
+    num_levels = build_pyramid(tmp_path.joinpath('image.tif'), tmp_path.joinpath('pyramid'), min_size=30)
+    levels = [np.load(tmp_path.joinpath('pyramid', f'level_{k}.npy')) for k in range(num_levels)]
+    assert [l.shape for l in levels] == [(2, 101, 60), (2, 51, 30), (2, 26, 15)]
+    # compressed images are stored uncompressed as level 0
+    np.testing.assert_array_equal(levels[0], image)
+    assert levels[1].dtype == np.uint8
+    assert levels[1][1, 0, 0] == np.rint(image[1, :2, :2].mean())
+    # odd sizes repeat the last row
+    assert levels[1][0, -1, 0] == np.rint(image[0, -1, :2].mean())
+
+def test_build_pyramid_rgb(tmp_path):
+
+    image = np.random.randint(0, 255, (64, 64, 3), dtype=np.uint8)
+    tifffile.imwrite(tmp_path.joinpath('image.tif'), image)
+
+    num_levels = build_pyramid(tmp_path.joinpath('image.tif'), tmp_path.joinpath('pyramid'), rgb=True, min_size=16)
+    assert num_levels == 3
+    # memory-mappable images are used as level 0 directly
+    assert not tmp_path.joinpath('pyramid', 'level_0.npy').exists()
+    assert np.load(tmp_path.joinpath('pyramid', 'level_2.npy')).shape == (16, 16, 3)
+
+def test_pyramid_cache(tmp_path):
+
+    image_path = tmp_path.joinpath('image.tif')
+    small_path = tmp_path.joinpath('small.tif')
+    tifffile.imwrite(image_path, np.random.randint(0, 255, (100, 100), dtype=np.uint8))
+    tifffile.imwrite(small_path, np.random.randint(0, 255, (20, 20), dtype=np.uint8))
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(project_path, file_paths=[image_path.as_posix(), small_path.as_posix()])
+
+    ready = threading.Event()
+    cache = PyramidCache(project_path, min_size=32, callback=lambda f: ready.set())
+    assert cache.get(image_path.as_posix()) is None, 'Pyramid not built in background'
+    assert ready.wait(10)
+    levels = cache.get(image_path.as_posix())
+    assert [l.shape for l in levels] == [(100, 100), (50, 50), (25, 25)]
+    assert all(isinstance(l, np.memmap) for l in levels), 'Levels not memory-mapped'
+
+    # small images have no pyramid
+    assert cache.get(small_path.as_posix()) is None
+    cache.close()
+    assert cache.get(small_path.as_posix()) is None
+    assert len(list(cache.folder.iterdir())) == 1
+
+    # pyramids are built again when the image changes
+    tifffile.imwrite(image_path, np.random.randint(0, 255, (100, 80), dtype=np.uint8))
+    ready.clear()
+    cache = PyramidCache(project_path, min_size=32, callback=lambda f: ready.set())
+    assert cache.get(image_path.as_posix()) is None
+    assert ready.wait(10)
+    assert cache.get(image_path.as_posix())[1].shape == (50, 40)
+    assert len(list(cache.folder.iterdir())) == 1, 'Outdated pyramid not removed'
+    cache.close()
@@ -0,0 +1,40 @@
+import numpy as np
+
+from napari_annotation_project import rois as roi_utils
+
+
+def test_roi_array_conversion():
+
+    flat = [[0, 0, 0, 10, 10, 10, 10, 0], [0.5, 0, 0, 10, 10, 10, 10, 0]]
+    rois = roi_utils.as_roi_array(flat)
+    assert rois.shape == (2, 4, 2) and rois.dtype == np.float64
+    assert roi_utils.as_roi_array(rois) is rois, 'Array copied'
+    assert roi_utils.as_roi_array([], ndim=3).shape == (0, 4, 3)
+    assert roi_utils.rois_to_list(rois) == flat
+    assert isinstance(roi_utils.rois_to_list(rois[:1])[0][1], int)
+    np.testing.assert_array_equal(roi_utils.decode_rois(roi_utils.encode_rois(rois)), rois)
+
+def test_roi_index():
+
+    # rois of 10x10 on a grid in two planes
+    corners = np.array([[p, y, x] for p in range(2) for y in range(0, 100, 10) for x in range(0, 100, 10)])
+    offsets = np.array([[0, 0, 0], [0, 0, 10], [0, 10, 10], [0, 10, 0]])
+    rois = corners[:, np.newaxis, :] + offsets[np.newaxis]
+    index = roi_utils.RoiIndex(rois)
+
+    assert index.planes == [(0,), (1,)]
+    np.testing.assert_array_equal(index.in_plane((1,)), np.arange(100, 200))
+    # region covering parts of four rois, touching rois are excluded
+    found = index.query([15, 15], [25, 25], plane=(1,))
+    np.testing.assert_array_equal(found, [111, 112, 121, 122])
+    assert len(index.query([15, 15], [25, 25])) == 8
+    np.testing.assert_array_equal(index.overlapping(rois[0]), [0])
+    assert len(index.query([200, 200], [210, 210])) == 0
+    # rois contained in a region, including rois on its border
+    np.testing.assert_array_equal(index.contained([10, 10], [30, 30], plane=(0,)), [11, 12, 21, 22])
+    assert len(index.contained([0, 0], [100, 100])) == 200
+
+    # the row window alone does not narrow queries of tall rois
+    tall = np.array([[[0, 0], [0, 5], [100, 5], [100, 0]], [[50, 50], [50, 55], [55, 55], [55, 50]]])
+    np.testing.assert_array_equal(roi_utils.RoiIndex(tall).query([60, 0], [70, 10]), [0])
+    assert len(roi_utils.RoiIndex(np.zeros((0, 4, 2))).query([0, 0], [10, 10])) == 0
@@ -0,0 +1,98 @@
+import sqlite3
+from napari_annotation_project import project as pr
+from napari_annotation_project import sqlite_store
+from napari_annotation_project.rois import rois_to_list
+
+
+file_paths = ['images/demo_data.tif', 'images/demo_data2.tif']
+
+def test_create_load_sqlite_project(tmp_path):
+
+    rois = {f: [] for f in file_paths}
+    channels = {f: None for f in file_paths}
+    project = pr.create_project(tmp_path, file_paths=file_paths, rois=rois, channels=channels, backend='sqlite')
+    assert tmp_path.joinpath(sqlite_store.DB_NAME).is_file(), 'Database not created'
+    assert not tmp_path.joinpath('Parameters.yml').exists()
+    assert pr.get_project_backend(tmp_path) == 'sqlite'
+
+    project.set_rois(file_paths[1], [[0, 0, 0, 10, 10, 10, 10, 0]])
+    project.set_channel(file_paths[1], 'demo_data2')
+    project.rgb = True
+    project.save_parameters()
+
+    loaded = pr.load_project(tmp_path)
+    assert isinstance(loaded, sqlite_store.SQLiteParam)
+    assert loaded.file_paths == file_paths
+    assert {k: rois_to_list(v) for k, v in loaded.rois.items()} == {
+        file_paths[0]: [], file_paths[1]: [[0, 0, 0, 10, 10, 10, 10, 0]]}
+    assert loaded.channels == {file_paths[0]: None, file_paths[1]: 'demo_data2'}
+    assert loaded.rgb is True
+    assert loaded.rois[file_paths[1]].shape == (1, 4, 2)
+
+    # removing a file only deletes its rows
+    loaded.file_paths = file_paths[1:]
+    loaded.rois.pop(file_paths[0])
+    loaded.channels.pop(file_paths[0])
+    loaded.save_parameters()
+    reloaded = pr.load_project(tmp_path)
+    assert reloaded.file_paths == file_paths[1:]
+    assert list(reloaded.rois.keys()) == file_paths[1:]
+
+    # an existing sqlite project keeps its backend
+    assert isinstance(pr.create_project(tmp_path), sqlite_store.SQLiteParam)
+
+def test_sqlite_file_positions(tmp_path):
+
+    project = pr.create_project(tmp_path, file_paths=file_paths, backend='sqlite')
+    def positions():
+        with sqlite3.connect(tmp_path.joinpath(sqlite_store.DB_NAME)) as conn:
+            return dict(conn.execute("SELECT path, position FROM files"))
+
+    # appending and removing files keeps the positions of the other files
+    project.file_paths = file_paths[1:] + ['images/new.tif']
+    project.save_parameters()
+    assert positions() == {file_paths[1]: 1, 'images/new.tif': 2}
+    assert pr.load_project(tmp_path).file_paths == project.file_paths
+
+    # reordering writes all positions
+    project.file_paths = ['images/new.tif', file_paths[1]]
+    project.save_parameters()
+    assert positions() == {'images/new.tif': 0, file_paths[1]: 1}
+    assert pr.load_project(tmp_path).file_paths == project.file_paths
+
+def test_sqlite_changes_during_save(tmp_path, monkeypatch):
+
+    channels = {f: None for f in file_paths}
+    project = pr.create_project(tmp_path, file_paths=file_paths, channels=channels, backend='sqlite')
+
+    # a change made while a save is written is saved by the next save
+    update = sqlite_store.ProjectDatabase.update
+    def update_and_edit(database, **changes):
+        update(database, **changes)
+        project.channels[file_paths[0]] = 'edited'
+    monkeypatch.setattr(sqlite_store.ProjectDatabase, 'update', update_and_edit)
+    project.rgb = True
+    project.save_parameters()
+    monkeypatch.setattr(sqlite_store.ProjectDatabase, 'update', update)
+    project.save_parameters()
+
+    loaded = pr.load_project(tmp_path)
+    assert loaded.rgb is True
+    assert loaded.channels[file_paths[0]] == 'edited', 'Change made during save lost'
+
+def test_migrate_project(tmp_path):
+
+    rois = {file_paths[0]: [[0, 0, 0, 5, 5, 5, 5, 0]], file_paths[1]: []}
+    channels = {f: None for f in file_paths}
+    pr.create_project(tmp_path, file_paths=file_paths, rois=rois, channels=channels)
+
+    project = pr.migrate_project(tmp_path, 'sqlite')
+    assert isinstance(project, sqlite_store.SQLiteParam)
+    assert tmp_path.joinpath('Parameters.yml.bak').is_file(), 'Old parameters not kept'
+    assert {k: rois_to_list(v) for k, v in pr.load_project(tmp_path).rois.items()} == rois
+
+    project = pr.migrate_project(tmp_path, 'yaml')
+    assert pr.get_project_backend(tmp_path) == 'yaml'
+    loaded = pr.load_project(tmp_path)
+    assert {k: rois_to_list(v) for k, v in loaded.rois.items()} == rois
+    assert loaded.file_paths == file_paths
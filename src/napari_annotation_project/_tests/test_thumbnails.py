@@ -0,0 +1,53 @@
+import threading
+import numpy as np
+import tifffile
+
+from napari_annotation_project import project as pr
+from napari_annotation_project.thumbnails import ThumbnailCache, make_thumbnail
+
+
+def test_make_thumbnail(tmp_path):
+
+    image = np.zeros((4, 200, 100), dtype=np.uint16)
+    image[2, :, 50:] = 1000
+    annotations = np.zeros((4, 200, 100), dtype=np.uint16)
+    annotations[2, :20, :20] = 1
+    tifffile.imwrite(tmp_path.joinpath('image.tif'), image)
+    tifffile.imwrite(tmp_path.joinpath('annotations.tif'), annotations, compression='zlib')
+
+    thumbnail = make_thumbnail(tmp_path.joinpath('image.tif'), tmp_path.joinpath('annotations.tif'), size=50)
+    assert thumbnail.shape == (50, 25, 3) and thumbnail.dtype == np.uint8
+    # middle plane is shown, labels are overlaid in color
+    np.testing.assert_array_equal(thumbnail[-1, -1], [255, 255, 255])
+    np.testing.assert_array_equal(thumbnail[-1, 0], [0, 0, 0])
+    assert thumbnail[0, 0, 0] != thumbnail[0, 0, 1], 'Annotations not overlaid'
+
+def test_thumbnail_cache(tmp_path):
+
+    image_path = tmp_path.joinpath('image.tif')
+    tifffile.imwrite(image_path, np.random.randint(0, 255, (100, 100), dtype=np.uint8))
+    project_path = tmp_path.joinpath('project')
+    pr.create_project(project_path, file_paths=[image_path.as_posix()])
+
+    ready = threading.Event()
+    cache = ThumbnailCache(project_path, size=32, callback=lambda f: ready.set())
+    assert cache.get(image_path.as_posix()) is None, 'Thumbnail not created in background'
+    assert ready.wait(10)
+    thumbnail = cache.get(image_path.as_posix())
+    assert thumbnail.shape == (25, 25, 3)
+    cache.close()
+
+    # thumbnails are reused from the cache folder
+    cache = ThumbnailCache(project_path, size=32)
+    np.testing.assert_array_equal(cache.get(image_path.as_posix()), thumbnail)
+
+    # and are created again when the annotations change
+    ready.clear()
+    cache.callback = lambda f: ready.set()
+    annotations = np.ones((100, 100), dtype=np.uint16)
+    tifffile.imwrite(pr.get_annotation_path(project_path, image_path), annotations)
+    assert cache.get(image_path.as_posix()) is None
+    assert ready.wait(10)
+    assert not np.array_equal(cache.get(image_path.as_posix()), thumbnail)
+    assert len(list(cache.folder.glob('*.npy'))) == 1, 'Outdated thumbnail not removed'
+    cache.close()
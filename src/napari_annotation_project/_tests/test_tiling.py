@@ -0,0 +1,41 @@
+import numpy as np
+
+from napari_annotation_project import tiling
+
+
+def test_grid_rois():
+
+    rois = tiling.grid_rois((2, 50, 40), roi_size=20, stride=15)
+    # positions 0, 15, 30 along y and 0, 15, 20 along x in both planes
+    assert rois.shape == (18, 4, 3)
+    np.testing.assert_array_equal(rois[0], [[0, 0, 0], [0, 0, 20], [0, 20, 20], [0, 20, 0]])
+    np.testing.assert_array_equal(rois[-1], [[1, 30, 20], [1, 30, 40], [1, 50, 40], [1, 50, 20]])
+
+    rois = tiling.grid_rois((2, 50, 40), roi_size=20, planes=[(1,)])
+    assert rois.shape == (6, 4, 3)
+    assert np.all(rois[:, :, 0] == 1)
+
+def test_random_and_label_rois():
+
+    rois = tiling.random_rois((50, 40), roi_size=10, num_rois=100, rng=0)
+    assert rois.shape == (100, 4, 2)
+    assert rois.min() >= 0 and rois[:, :, 0].max() <= 50 and rois[:, :, 1].max() <= 40
+
+    labels = np.zeros((2, 50, 40), dtype=np.uint8)
+    labels[1, 45:, 35:] = 1
+    rois = tiling.label_rois(labels, roi_size=10, num_rois=5, rng=0)
+    assert rois.shape == (5, 4, 3)
+    assert np.all(rois[:, :, 0] == 1), 'Rois sampled in empty plane'
+    # rois are kept within the image
+    np.testing.assert_array_equal(rois[:, 2, 1:].max(axis=0), [50, 40])
+    assert len(tiling.label_rois(labels, 10, 5, planes=[(0,)])) == 0
+
+def test_remove_overlapping():
+
+    existing = tiling.grid_rois((50, 40), roi_size=20)
+    rois = tiling.grid_rois((50, 40), roi_size=10, stride=10)
+    assert len(tiling.remove_overlapping(rois, existing)) == 0
+    # only rois outside of the existing ones are kept
+    kept = tiling.remove_overlapping(rois, existing[:1])
+    assert len(kept) == len(rois) - 4
+    assert np.all((kept[:, :, 0].min(axis=1) >= 20) | (kept[:, :, 1].min(axis=1) >= 20))
@@ -0,0 +1,176 @@
+"""
+Access to the crops of a project without exporting them. Crops are read
+from the images and annotations on disk when they are requested, so that
+they can be streamed directly into the training of a model.
+"""
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import project as pr
+from .export import _plan_export, open_file_readers, read_file_crop
+
+
+def _close_readers(readers):
+
+    image, annotations = readers
+    image.close()
+    if annotations is not None:
+        annotations.close()
+
+
+class _OpenFile:
+    """Readers of a file shared by the threads reading its crops. Readers
+    are opened on first use and used under lock."""
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.readers = None
+        self.closed = False
+
+    def close(self):
+
+        with self.lock:
+            self.closed = True
+            if self.readers is not None:
+                _close_readers(self.readers)
+            self.readers = None
+
+
+class ProjectDataset:
+    """
+    Crops of the rois of a project as a dataset. Items are tuples
+    (image_crop, label_crop, metadata) and can be accessed by index
+    (map-style dataset) or by iterating over the dataset. When iterating,
+    crops are read ahead in worker threads.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    num_threads : int
+        number of threads reading crops when iterating
+    read_ahead : int
+        maximum number of crops read in advance when iterating
+    max_open_files : int
+        number of files kept open. Each file is opened once and its crops
+        are read from the open file, the least recently used files are
+        closed. Crops of a file are read by one thread at a time.
+
+    """
+
+    def __init__(self, project_path, num_threads=4, read_ahead=16, max_open_files=8):
+
+        self.params = pr.load_project(project_path)
+        self.num_threads = num_threads
+        self.read_ahead = max(1, read_ahead)
+        self.max_open_files = max(1, max_open_files)
+        self._tasks = _plan_export(self.params)
+        self._index = [(task, j) for task in self._tasks for j in range(len(task['rois']))]
+        self._open_files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, index):
+        """
+        Get a crop.
+
+        Returns
+        -------
+        image_crop : array
+            crop of the image
+        label_crop : array
+            crop of the annotations, zeros if the file has no annotations
+        metadata : dict
+            crop_index, file_name, roi_index, plane and channel of the crop
+        """
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'Crop index {index} out of range')
+
+        task, j = self._index[index]
+        open_file = self._open_file(task)
+        with open_file.lock:
+            if open_file.closed:
+                # the file was closed by another thread since it was taken
+                # from the open files, it is read without being kept open
+                readers = open_file_readers(task)
+                try:
+                    plane, image_crop, label_crop = read_file_crop(task, j, *readers)
+                finally:
+                    _close_readers(readers)
+            else:
+                if open_file.readers is None:
+                    open_file.readers = open_file_readers(task)
+                plane, image_crop, label_crop = read_file_crop(task, j, *open_file.readers)
+        metadata = {
+            'crop_index': index,
+            'file_name': task['file_name'],
+            'roi_index': j,
+            'plane': plane,
+            'channel': self._channel(task['file_name']),
+        }
+        return image_crop, label_crop, metadata
+
+    def _open_file(self, task):
+        """Get the open file of a task, closing the least recently used
+        files beyond max_open_files."""
+
+        with self._lock:
+            open_file = self._open_files.get(task['file_name'])
+            if open_file is None:
+                open_file = self._open_files[task['file_name']] = _OpenFile()
+            self._open_files.move_to_end(task['file_name'])
+            evicted = []
+            while len(self._open_files) > self.max_open_files:
+                evicted.append(self._open_files.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return open_file
+
+    def close(self):
+        """Close the open files."""
+
+        with self._lock:
+            open_files = list(self._open_files.values())
+            self._open_files.clear()
+        for open_file in open_files:
+            open_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _channel(self, file_name):
+        """Channel selected for a file. Images opened as a single layer have
+        their file name as channel, which is equivalent to no selection."""
+
+        channel = self.params.channels.get(file_name)
+        if channel == Path(file_name).stem:
+            return None
+        return channel
+
+    def __iter__(self):
+
+        executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        pending = deque()
+        next_index = 0
+        try:
+            while (next_index < len(self)) or (len(pending) > 0):
+                while (next_index < len(self)) and (len(pending) < self.read_ahead):
+                    pending.append(executor.submit(self.__getitem__, next_index))
+                    next_index += 1
+                yield pending.popleft().result()
+        finally:
+            # the consumer may stop iterating early
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,931 @@
+"""
+Headless export of the rois of a project as cropped images and annotations.
+The export only relies on the project parameters and on the files on disk,
+so that it can run without a napari viewer, e.g. on a compute node.
+"""
+import argparse
+import csv
+import functools
+import hashlib
+import io
+import json
+import os
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+import numpy as np
+import tifffile
+
+from . import project as pr
+from .image_io import RegionReader, crop_roi, IMAGE_SUFFIXES
+from .metadata import MetadataCache
+from .rois import RoiIndex
+
+
+MANIFEST_NAME = 'export_manifest.sqlite'
+
+_MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crops (
+    source TEXT PRIMARY KEY,
+    target TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    roi TEXT NOT NULL,
+    source_size INTEGER,
+    source_mtime INTEGER,
+    annotation_size INTEGER,
+    annotation_mtime INTEGER,
+    digest TEXT NOT NULL
+);
+"""
+_MANIFEST_FIELDS = [
+    'source', 'target', 'file_name', 'roi', 'source_size', 'source_mtime',
+    'annotation_size', 'annotation_mtime', 'digest']
+# suffix of crops being renamed, left over if an export is interrupted
+_MOVE_SUFFIX = '.moving'
+# number of encoded crops waiting to be written to disk
+_WRITE_QUEUE_SIZE = 8
+
+
+class ExportManifest:
+    """
+    Record of the crops present in an export folder and of the inputs they
+    were created from: size and modification time of the source file and
+    of its annotation file, roi geometry and a digest of the roi geometry
+    and annotation region. Crops are identified by the path of their image
+    crop relative to the export folder.
+
+    Parameters
+    ----------
+    export_folder : str or Path
+        folder containing the exported crops
+
+    """
+
+    def __init__(self, export_folder):
+
+        self.db_path = Path(export_folder).joinpath(MANIFEST_NAME)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_MANIFEST_SCHEMA)
+
+    def _connect(self):
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return closing(conn)
+
+    def read(self):
+        """Get all entries as a dict of dicts keyed by image crop path."""
+
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(_MANIFEST_FIELDS)} FROM crops").fetchall()
+        return {row[0]: dict(zip(_MANIFEST_FIELDS, row)) for row in rows}
+
+    def add(self, entries):
+        """Insert or replace entries in a single transaction."""
+
+        with self._connect() as conn, conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO crops ({', '.join(_MANIFEST_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(_MANIFEST_FIELDS))})",
+                [[e[f] for f in _MANIFEST_FIELDS] for e in entries])
+
+    def remove(self, sources):
+        """Remove entries in a single transaction."""
+
+        with self._connect() as conn, conn:
+            conn.executemany("DELETE FROM crops WHERE source=?", [(s,) for s in sources])
+
+
+def export_project(project_path, export_folder, source_folder_name='source',
+                   source_name_prefix='img_', source_name_suffix='',
+                   target_folder_name='target', target_name_prefix='target_',
+                   target_name_suffix='', num_workers=None, force=False):
+    """
+    Export cropped data of the images and the annotations of a project
+    using its rois. The output is identical to the export of the
+    ProjectWidget: a source and a target folder with one tif file per roi
+    and a rois_infos.csv file linking crops to their original file.
+
+    The export is incremental: an ExportManifest stored in the export folder
+    records the inputs of each crop. When exporting again to the same
+    folder, only crops whose inputs changed are written, crops that only
+    changed name are renamed and crops of deleted rois are removed. The
+    manifest is updated after each file so that an interrupted export
+    resumes from the last completed file.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    export_folder : str or Path
+        folder where to export the data
+    source_folder_name : str
+        name of the folder containing the image crops
+    source_name_prefix : str
+        prefix of the image crop names
+    source_name_suffix : str
+        suffix of the image crop names
+    target_folder_name : str
+        name of the folder containing the annotation crops
+    target_name_prefix : str
+        prefix of the annotation crop names
+    target_name_suffix : str
+        suffix of the annotation crop names
+    num_workers : int, optional
+        number of processes used for the export. Default is the number of
+        cpus. With num_workers=1 files are processed in the current process.
+    force : bool
+        if True, all crops are written again and crops no longer exported
+        are removed
+
+    Returns
+    -------
+    name_dict : list of dict
+        information on each exported roi as written in rois_infos.csv
+
+    """
+
+    exporter = iter_export_project(
+        project_path, export_folder, source_folder_name, source_name_prefix,
+        source_name_suffix, target_folder_name, target_name_prefix,
+        target_name_suffix, num_workers=num_workers, force=force)
+    # the generator returns the rows of rois_infos.csv once exhausted
+    while True:
+        try:
+            next(exporter)
+        except StopIteration as stop:
+            return stop.value
+
+
+def iter_export_project(project_path, export_folder, source_folder_name='source',
+                        source_name_prefix='img_', source_name_suffix='',
+                        target_folder_name='target', target_name_prefix='target_',
+                        target_name_suffix='', num_workers=None, force=False,
+                        cancel_event=None):
+    """
+    Export a project as export_project, as a generator reporting progress
+    after each written file. This is used to run the export in a background
+    thread.
+
+    Parameters
+    ----------
+    project_path, export_folder, source_folder_name, source_name_prefix,
+    source_name_suffix, target_folder_name, target_name_prefix,
+    target_name_suffix, num_workers, force :
+        see export_project
+    cancel_event : threading.Event, optional
+        event used to cancel the export. Files being processed are
+        completed, then crops that were not written are removed so that
+        the export folder and rois_infos.csv only contain up-to-date crops.
+        Exporting again resumes the export.
+
+    Yields
+    ------
+    crops_done : int
+        number of crops written so far
+    crops_total : int
+        number of crops to write, crops that are up-to-date or only
+        renamed are not counted
+    nbytes : int
+        number of bytes of the crops written so far
+
+    Returns
+    -------
+    name_dict : list of dict
+        information on each exported roi as written in rois_infos.csv
+
+    """
+
+    params = pr.load_project(project_path)
+    with MetadataCache(project_path) as metadata:
+        tasks = _plan_export(params, metadata)
+
+    export_folder = Path(export_folder)
+    images_path = export_folder.joinpath(source_folder_name)
+    labels_path = export_folder.joinpath(target_folder_name)
+    images_path.mkdir(parents=True, exist_ok=True)
+    labels_path.mkdir(parents=True, exist_ok=True)
+
+    manifest = ExportManifest(export_folder)
+    previous = manifest.read()
+    # with force no crop is reused, but crops of the previous export are
+    # still known so that those no longer exported are removed
+    reusable = {} if force else previous
+    for leftover in export_folder.glob(f'**/*{_MOVE_SUFFIX}'):
+        leftover.unlink()
+
+    # describe all crops of the export. Digests of rois whose inputs did not
+    # change are taken from the manifest, others are computed in parallel
+    known_digests = {_input_key(e): e['digest'] for e in reusable.values()}
+    crops = []
+    for task in tasks:
+        source_size, source_mtime = _file_stat(task['image_path'])
+        annotation_size, annotation_mtime = _file_stat(task['annotation_path'])
+        task['crops'] = {}
+        task['digest_rois'] = []
+        for j, roi in enumerate(task['rois']):
+            image_counter = task['first_index'] + j
+            crop = {
+                'source': f'{source_folder_name}/{source_name_prefix}{image_counter}{source_name_suffix}.tif',
+                'target': f'{target_folder_name}/{target_name_prefix}{image_counter}{target_name_suffix}.tif',
+                'file_name': task['file_name'],
+                'roi': _roi_key(roi, task['rgb'], task['channel']),
+                'source_size': source_size, 'source_mtime': source_mtime,
+                'annotation_size': annotation_size, 'annotation_mtime': annotation_mtime,
+                'digest': None}
+            crop['digest'] = known_digests.get(_input_key(crop))
+            if crop['digest'] is None:
+                task['digest_rois'].append(j)
+            task['crops'][j] = crop
+            crops.append(crop)
+
+    digest_tasks = [t for t in tasks if len(t['digest_rois']) > 0]
+    for task, digests in zip(digest_tasks, _map_tasks(_digest_file, digest_tasks, num_workers, cancel_event)):
+        for j, digest in digests.items():
+            task['crops'][j]['digest'] = digest
+    # nothing was modified yet
+    if _is_cancelled(cancel_event):
+        return None
+
+    # sort crops into up-to-date crops, crops that can be renamed from an
+    # existing crop and crops that have to be written
+    def exists(entry):
+        return export_folder.joinpath(entry['source']).exists() and export_folder.joinpath(entry['target']).exists()
+
+    available = {}
+    for entry in reusable.values():
+        if exists(entry):
+            available.setdefault(_content_key(entry), []).append(entry)
+    kept = []
+    for crop in crops:
+        old = reusable.get(crop['source'])
+        if ((old is not None) and (_content_key(old) == _content_key(crop))
+                and (old['target'] == crop['target']) and exists(old)):
+            kept.append(crop)
+            available[_content_key(crop)].remove(old)
+    kept_sources = {c['source'] for c in kept}
+    moves = []
+    for crop in crops:
+        candidates = available.get(_content_key(crop), [])
+        if (crop['source'] not in kept_sources) and (len(candidates) > 0):
+            moves.append((candidates.pop(), crop))
+    moved_sources = {crop['source'] for _, crop in moves}
+
+    # entries of all crops that will change are removed before touching
+    # files, so that an interruption never leaves a wrong entry
+    manifest.remove([s for s in previous if s not in kept_sources])
+    manifest.add(kept)
+
+    new_paths = {p for c in crops for p in (c['source'], c['target'])}
+    for old, crop in moves:
+        for name in ['source', 'target']:
+            os.replace(export_folder.joinpath(old[name]), export_folder.joinpath(old[name] + _MOVE_SUFFIX))
+    for old, crop in moves:
+        for name in ['source', 'target']:
+            os.replace(export_folder.joinpath(old[name] + _MOVE_SUFFIX), export_folder.joinpath(crop[name]))
+    moved = {p for old, _ in moves for p in (old['source'], old['target'])}
+    for entry in previous.values():
+        for name in ['source', 'target']:
+            path = entry[name]
+            if (path not in new_paths) and (path not in moved) and export_folder.joinpath(path).exists():
+                export_folder.joinpath(path).unlink()
+    manifest.add([crop for _, crop in moves])
+
+    write_tasks = []
+    for task in tasks:
+        task['writes'] = [
+            (j, export_folder.joinpath(c['source']), export_folder.joinpath(c['target']))
+            for j, c in task['crops'].items()
+            if (c['source'] not in kept_sources) and (c['source'] not in moved_sources)]
+        if len(task['writes']) > 0:
+            write_tasks.append(task)
+    crops_total = sum(len(t['writes']) for t in write_tasks)
+    crops_done, nbytes = 0, 0
+    yield crops_done, crops_total, nbytes
+    written_sources = set()
+    for task, (written, written_bytes) in zip(
+            write_tasks, _map_tasks(_export_file, write_tasks, num_workers, cancel_event)):
+        manifest.add([task['crops'][j] for j in written])
+        written_sources.update(task['crops'][j]['source'] for j in written)
+        crops_done += len(written)
+        nbytes += written_bytes
+        yield crops_done, crops_total, nbytes
+
+    # crops of a cancelled export that were not written may be outdated
+    complete = kept_sources | moved_sources | written_sources
+    if _is_cancelled(cancel_event):
+        for crop in crops:
+            if crop['source'] not in complete:
+                for name in ['source', 'target']:
+                    export_folder.joinpath(crop[name]).unlink(missing_ok=True)
+
+    name_dict = [
+        {'file_name': task['file_name'], 'image_index': task['first_index'] + j + 1, 'roi_index': j}
+        for task in tasks for j in range(len(task['rois']))
+        if task['crops'][j]['source'] in complete]
+    fieldnames = ['file_name', 'image_index', 'roi_index']
+    with open(export_folder.joinpath('rois_infos.csv'), 'w', encoding='UTF8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(name_dict)
+
+    return name_dict
+
+
+def _file_stat(path):
+    """Get size and modification time of a file, None if it does not exist."""
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None, None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _roi_key(roi, rgb, channel=None):
+    """Text representation of the geometry of a roi and of the exported
+    channel."""
+
+    key = [bool(rgb), np.asarray(roi, dtype=float).ravel().tolist()]
+    if channel is not None:
+        key.append(channel)
+    return json.dumps(key)
+
+
+def _input_key(crop):
+    """Inputs of a crop from which its digest can be reused."""
+
+    return (crop['file_name'], crop['roi'], crop['source_size'], crop['source_mtime'],
+            crop['annotation_size'], crop['annotation_mtime'])
+
+
+def _content_key(crop):
+    """Inputs determining the content of a crop."""
+
+    return (crop['file_name'], crop['source_size'], crop['source_mtime'], crop['digest'])
+
+
+def _plan_export(params, metadata=None):
+    """Create one export task per file with rois. Crops are numbered
+    continuously over all files, so the first index of each file is
+    computed beforehand and files can be processed in any order.
+
+    With a MetadataCache, the dimensions of the rois are checked against
+    the image headers, so that an invalid project fails before any file of
+    the export is touched.
+
+    Files are cropped region by region when their format supports it and
+    the exported channel is the image itself. Other files, and channels
+    selected among the layers opened by a napari reader, are read with
+    napari readers as in the viewer.
+
+    Rois are cropped plane by plane in the order given by the roi index of
+    the file, so that each plane of a file is decoded once."""
+
+    tasks = []
+    image_counter = 0
+    file_paths = params.file_paths if params.file_paths is not None else []
+    with_rois = [f for f in file_paths if len(params.rois.get(f, [])) > 0]
+    headers = metadata.update(with_rois) if metadata is not None else {}
+    for file_path in file_paths:
+        rois = params.rois.get(file_path, np.zeros((0, 4, 2)))
+        if len(rois) == 0:
+            continue
+        channel = params.channels.get(file_path)
+        if (Path(file_path).suffix.lower() in IMAGE_SUFFIXES) and (channel in [None, Path(file_path).stem]):
+            reader = 'region'
+        else:
+            reader = 'layers'
+        header = headers.get(file_path)
+        if (header is not None) and (reader == 'region'):
+            annotations_ndim = 2 if params.rgb else len(header['shape'])
+            if rois.shape[2] != annotations_ndim:
+                raise ValueError(
+                    f"Rois of {file_path} have {rois.shape[2]} dimensions, "
+                    f"its annotations have {annotations_ndim}.")
+        index = RoiIndex(rois)
+        tasks.append({
+            'file_name': file_path,
+            'image_path': pr.resolve_file_path(params.project_path, file_path),
+            'annotation_path': pr.get_annotation_path(params.project_path, file_path),
+            'rois': rois,
+            'rgb': params.rgb,
+            'channel': channel,
+            'reader': reader,
+            'roi_order': np.concatenate([index.in_plane(p) for p in index.planes]).tolist(),
+            'first_index': image_counter,
+        })
+        image_counter += len(rois)
+    return tasks
+
+
+@functools.lru_cache(maxsize=None)
+def _discover_readers():
+    """Register the reader plugins installed, once per process."""
+
+    import npe2
+
+    npe2.PluginManager.instance().discover()
+
+
+def _unique_name(name, names):
+    """Name of a layer as given by napari when layers have the same name."""
+
+    if name not in names:
+        return name
+    count = 1
+    while f'{name} [{count}]' in names:
+        count += 1
+    return f'{name} [{count}]'
+
+
+def read_layer(image_path, channel=None):
+    """
+    Read an image with napari readers. Layers are named as when the image
+    is opened in the viewer, without creating a viewer.
+
+    Parameters
+    ----------
+    image_path : str or Path
+        path of the image file
+    channel : str, optional
+        name of the layer to read if the reader opens several layers,
+        default is the first layer
+
+    Returns
+    -------
+    image : array
+        layer data, the full resolution level for multiscale layers
+
+    """
+
+    # napari is only imported when needed so that the export can run
+    # without it for files read region by region
+    from napari.plugins.io import read_data_with_plugins
+
+    _discover_readers()
+    layer_data, _ = read_data_with_plugins([str(image_path)], stack=False)
+    layers = {}
+    for layer in layer_data or []:
+        data = layer[0]
+        meta = layer[1] if len(layer) > 1 else {}
+        multiscale = meta.get('multiscale', isinstance(data, (list, tuple)))
+        if multiscale:
+            data = data[0]
+        name = meta.get('name', Path(image_path).stem)
+        channel_axis = meta.get('channel_axis')
+        if channel_axis is None:
+            layers[_unique_name(name, layers)] = data
+            continue
+        # channels are opened as separate layers
+        for i in range(data.shape[channel_axis]):
+            channel_name = name[i] if isinstance(name, (list, tuple)) else name
+            layers[_unique_name(channel_name, layers)] = np.take(data, i, axis=channel_axis)
+    if len(layers) == 0:
+        raise ValueError(f"No layer could be read from {image_path}")
+    if channel is None:
+        return np.asarray(next(iter(layers.values())))
+    if channel not in layers:
+        raise ValueError(f"{image_path} has no layer {channel}, layers are {list(layers)}")
+    return np.asarray(layers[channel])
+
+
+class _ArrayReader:
+    """Array read in memory with the interface of RegionReader."""
+
+    def __init__(self, array):
+
+        self.array = array
+        self.shape = array.shape
+        self.ndim = array.ndim
+
+    def read_roi(self, roi, annotations_ndim):
+
+        return np.asarray(crop_roi(self.array, roi, annotations_ndim))
+
+    def close(self):
+
+        self.array = None
+
+
+def iter_file_crops(task, roi_indices=None):
+    """
+    Crop rois of a single file.
+
+    Parameters
+    ----------
+    task : dict
+        export task as created by _plan_export
+    roi_indices : list of int, optional
+        indices of the rois to crop, default is all rois. Rois are cropped
+        plane by plane.
+
+    Yields
+    ------
+    roi_index : int
+        index of the roi in the file
+    plane : tuple
+        index of the plane containing the roi for nD images
+    image_roi : array
+        image crop
+    annotations_roi : array
+        annotation crop
+    """
+
+    if roi_indices is None:
+        roi_indices = task['roi_order']
+    else:
+        roi_indices = sorted(roi_indices, key=lambda j: tuple(np.asarray(task['rois'][j])[0, :-2].tolist()))
+
+    image, annotations = open_file_readers(task)
+    try:
+        for j in roi_indices:
+            yield (j,) + read_file_crop(task, j, image, annotations)
+    finally:
+        image.close()
+        if annotations is not None:
+            annotations.close()
+
+
+def open_file_readers(task):
+    """
+    Open the image and the annotations of an export task for cropping.
+    Only the region of each roi is read from the image and annotation
+    files, except for images that only napari readers can open, which are
+    loaded once.
+
+    Parameters
+    ----------
+    task : dict
+        export task as created by _plan_export
+
+    Returns
+    -------
+    image : RegionReader
+        reader of the image, to close after use
+    annotations : RegionReader or None
+        reader of the annotations, None if no annotation was saved
+
+    """
+
+    if task.get('reader', 'region') == 'region':
+        image = RegionReader(task['image_path'])
+    else:
+        image = _ArrayReader(read_layer(task['image_path'], task.get('channel')))
+    annotations = None
+    if task['annotation_path'].exists():
+        annotations = RegionReader(task['annotation_path'])
+    return image, annotations
+
+
+def read_file_crop(task, roi_index, image, annotations):
+    """
+    Crop a roi of a file opened with open_file_readers.
+
+    Returns
+    -------
+    plane : tuple
+        index of the plane containing the roi for nD images
+    image_roi : array
+        image crop
+    annotations_roi : array
+        annotation crop
+    """
+
+    annotations_ndim = 2 if task['rgb'] else image.ndim
+    roi = np.array(task['rois'][roi_index]).reshape(4, annotations_ndim)
+    image_roi = image.read_roi(roi, annotations_ndim)
+    if annotations is not None:
+        annotations_roi = annotations.read_roi(roi, annotations_ndim)
+    else:
+        # no annotation was saved, the widget exports an empty layer
+        annotations_roi = np.zeros(image_roi.shape[:2], dtype=np.uint16)
+    plane = tuple(roi[0, :annotations_ndim-2].astype(int).tolist())
+    return plane, image_roi, annotations_roi
+
+def _digest_file(task):
+    """Compute the digest of the geometry and annotation region of the
+    rois of a file listed in task['digest_rois']. Runs in a worker process."""
+
+    annotations = None
+    if task['annotation_path'].exists():
+        annotations = RegionReader(task['annotation_path'])
+
+    digests = {}
+    try:
+        for j in task['digest_rois']:
+            roi = task['rois'][j]
+            digest = hashlib.blake2b(_roi_key(roi, task['rgb'], task.get('channel')).encode(), digest_size=20)
+            if annotations is not None:
+                annotations_ndim = np.size(roi) // 4
+                region = np.ascontiguousarray(annotations.read_roi(
+                    np.array(roi).reshape(4, annotations_ndim), annotations_ndim))
+                digest.update(f'{region.shape}{region.dtype.str}'.encode())
+                digest.update(region.tobytes())
+            digests[j] = digest.hexdigest()
+    finally:
+        if annotations is not None:
+            annotations.close()
+    return digests
+
+
+def _encode_tif(data):
+    """Encode an array as tif file in memory."""
+
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, data)
+    return buffer.getvalue()
+
+
+def _write_files(files):
+
+    for path, data in files:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def _export_file(task):
+    """Write the crops of a file listed in task['writes']. Runs in a worker
+    process and returns the indices of the written rois and the number of
+    bytes written. Crops are read and encoded while previous crops are
+    written to disk by a writer thread, through a queue of at most
+    _WRITE_QUEUE_SIZE crops."""
+
+    writes = {j: (image_file, label_file) for j, image_file, label_file in task['writes']}
+    written = []
+    nbytes = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for j, _, image_roi, annotations_roi in iter_file_crops(task, list(writes)):
+            files = list(zip(writes[j], [_encode_tif(image_roi), _encode_tif(annotations_roi)]))
+            nbytes += sum(len(data) for _, data in files)
+            pending.append((j, writer.submit(_write_files, files)))
+            while len(pending) > _WRITE_QUEUE_SIZE:
+                j, future = pending.popleft()
+                future.result()
+                written.append(j)
+        while len(pending) > 0:
+            j, future = pending.popleft()
+            future.result()
+            written.append(j)
+
+    return written, nbytes
+
+
+def _crop_file(task):
+    """Get all crops of a single file. Runs in a worker process."""
+
+    crops = [(task['file_name'], task['first_index'] + j, j, plane, image_roi, annotations_roi)
+             for j, plane, image_roi, annotations_roi in iter_file_crops(task)]
+    return sorted(crops, key=lambda crop: crop[2])
+
+
+def _is_cancelled(cancel_event):
+
+    return (cancel_event is not None) and cancel_event.is_set()
+
+
+def _map_tasks(function, tasks, num_workers, cancel_event=None):
+    """Apply function to tasks in worker processes, yielding results in
+    order. Once cancel_event is set, no new task is started and the results
+    of started tasks are yielded."""
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(tasks)))
+
+    if num_workers == 1:
+        for t in tasks:
+            if _is_cancelled(cancel_event):
+                return
+            yield function(t)
+    else:
+        # a few tasks are queued per worker so that workers are never idle
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            pending = deque()
+            for t in tasks:
+                if _is_cancelled(cancel_event):
+                    break
+                pending.append(executor.submit(function, t))
+                if len(pending) >= 2 * num_workers:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
+
+SHARD_INDEX_NAME = 'shards_index.csv'
+_SHARD_FIELDS = [
+    'crop_index', 'file_name', 'roi_index', 'plane', 'shard',
+    'image_offset', 'image_shape', 'image_dtype',
+    'label_offset', 'label_shape', 'label_dtype']
+# crops are aligned in shards so that they can be viewed with any dtype
+_SHARD_ALIGNMENT = 64
+
+
+class _ShardWriter:
+    """Pack crops into uncompressed .npy byte arrays of bounded size."""
+
+    def __init__(self, folder, shard_size):
+
+        self.folder = folder
+        self.shard_size = shard_size
+        self.shard_index = 0
+        self._buffer = []
+        self._nbytes = 0
+        self.rows = []
+
+    def add(self, file_name, crop_index, roi_index, plane, image_roi, annotations_roi):
+
+        row = {'crop_index': crop_index, 'file_name': file_name,
+               'roi_index': roi_index, 'plane': ' '.join(str(p) for p in plane),
+               'shard': self.shard_index}
+        for name, data in [('image', image_roi), ('label', annotations_roi)]:
+            data = np.ascontiguousarray(data)
+            row[f'{name}_offset'] = self._nbytes
+            row[f'{name}_shape'] = ' '.join(str(x) for x in data.shape)
+            row[f'{name}_dtype'] = data.dtype.str
+            self._buffer.append((self._nbytes, data))
+            self._nbytes += -(-data.nbytes // _SHARD_ALIGNMENT) * _SHARD_ALIGNMENT
+        self.rows.append(row)
+        if self._nbytes >= self.shard_size:
+            self.close_shard()
+
+    def close_shard(self):
+
+        if len(self._buffer) == 0:
+            return
+        shard = np.lib.format.open_memmap(
+            self.folder.joinpath(f'shard_{self.shard_index:05d}.npy'),
+            mode='w+', dtype=np.uint8, shape=(self._nbytes,))
+        for offset, data in self._buffer:
+            shard[offset:offset+data.nbytes] = data.reshape(-1).view(np.uint8)
+        shard.flush()
+        del shard
+        self.shard_index += 1
+        self._buffer = []
+        self._nbytes = 0
+
+
+def export_project_shards(project_path, export_folder, shard_size=2**28, num_workers=None):
+    """
+    Export cropped data of the images and the annotations of a project
+    packed into a few large shard files instead of one tif file per crop.
+    Each shard is an uncompressed .npy file of bytes containing both image
+    and annotation crops. The shards_index.csv file gives for each crop its
+    source file, roi index, plane, shard, offset, shape and dtype. Use
+    ShardedCrops to access the crops.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    export_folder : str or Path
+        folder where to export the data
+    shard_size : int
+        approximate size of each shard in bytes
+    num_workers : int, optional
+        number of processes used to crop files. Default is the number of cpus.
+
+    Returns
+    -------
+    rows : list of dict
+        information on each exported crop as written in shards_index.csv
+
+    """
+
+    params = pr.load_project(project_path)
+    with MetadataCache(project_path) as metadata:
+        tasks = _plan_export(params, metadata)
+
+    export_folder = Path(export_folder)
+    export_folder.mkdir(parents=True, exist_ok=True)
+    # shards of a previous export would not be referenced by the new index
+    for old_shard in export_folder.glob('shard_*.npy'):
+        old_shard.unlink()
+
+    writer = _ShardWriter(export_folder, shard_size)
+    for crops in _map_tasks(_crop_file, tasks, num_workers):
+        for crop in crops:
+            writer.add(*crop)
+    writer.close_shard()
+
+    with open(export_folder.joinpath(SHARD_INDEX_NAME), 'w', encoding='UTF8', newline='') as f:
+        csv_writer = csv.DictWriter(f, fieldnames=_SHARD_FIELDS)
+        csv_writer.writeheader()
+        csv_writer.writerows(writer.rows)
+
+    return writer.rows
+
+
+class ShardedCrops:
+    """
+    Random access to crops exported with export_project_shards. Shards
+    are memory-mapped so that only the accessed crops are read.
+
+    Parameters
+    ----------
+    folder : str or Path
+        export folder containing the shards and their index
+
+    """
+
+    def __init__(self, folder):
+
+        self.folder = Path(folder)
+        with open(self.folder.joinpath(SHARD_INDEX_NAME), encoding='UTF8', newline='') as f:
+            self.index = list(csv.DictReader(f))
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard):
+
+        if shard not in self._shards:
+            self._shards[shard] = np.load(
+                self.folder.joinpath(f'shard_{int(shard):05d}.npy'), mmap_mode='r')
+        return self._shards[shard]
+
+    def _read(self, row, name):
+
+        shape = tuple(int(x) for x in row[f'{name}_shape'].split())
+        dtype = np.dtype(row[f'{name}_dtype'])
+        offset = int(row[f'{name}_offset'])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self._shard(row['shard'])[offset:offset+nbytes].view(dtype).reshape(shape)
+
+    def __getitem__(self, index):
+        """
+        Get a crop.
+
+        Returns
+        -------
+        image : array
+            image crop, a read-only view of the shard
+        label : array
+            annotation crop, a read-only view of the shard
+        metadata : dict
+            crop_index, file_name, roi_index and plane of the crop
+        """
+
+        row = self.index[index]
+        metadata = {
+            'crop_index': int(row['crop_index']),
+            'file_name': row['file_name'],
+            'roi_index': int(row['roi_index']),
+            'plane': tuple(int(p) for p in row['plane'].split()),
+        }
+        return self._read(row, 'image'), self._read(row, 'label'), metadata
+
+
+def main(argv=None):
+    """Command line entry point for the headless export."""
+
+    parser = argparse.ArgumentParser(
+        description='Export the rois of a napari-annotation-project as cropped images and annotations.')
+    parser.add_argument('project_path', help='folder containing the Parameters.yml file')
+    parser.add_argument('export_folder', help='folder where to export the data')
+    parser.add_argument('--source-folder-name', default='source')
+    parser.add_argument('--source-name-prefix', default='img_')
+    parser.add_argument('--source-name-suffix', default='')
+    parser.add_argument('--target-folder-name', default='target')
+    parser.add_argument('--target-name-prefix', default='target_')
+    parser.add_argument('--target-name-suffix', default='')
+    parser.add_argument('-j', '--num-workers', type=int, default=None,
+                        help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--force', action='store_true',
+                        help='write all crops again instead of only the ones that changed')
+    parser.add_argument('--format', choices=['tif', 'shards'], default='tif',
+                        help='one tif file per crop or crops packed in .npy shards')
+    parser.add_argument('--shard-size', type=int, default=256,
+                        help='approximate size of each shard in MB')
+    args = parser.parse_args(argv)
+
+    if args.format == 'shards':
+        rows = export_project_shards(
+            project_path=args.project_path,
+            export_folder=args.export_folder,
+            shard_size=args.shard_size * 2**20,
+            num_workers=args.num_workers)
+        print(f"Exported {len(rows)} rois to {args.export_folder}")
+        return
+
+    name_dict = export_project(
+        project_path=args.project_path,
+        export_folder=args.export_folder,
+        source_folder_name=args.source_folder_name,
+        source_name_prefix=args.source_name_prefix,
+        source_name_suffix=args.source_name_suffix,
+        target_folder_name=args.target_folder_name,
+        target_name_prefix=args.target_name_prefix,
+        target_name_suffix=args.target_name_suffix,
+        num_workers=args.num_workers,
+        force=args.force)
+    print(f"Exported {len(name_dict)} rois to {args.export_folder}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,428 @@
-import shutil
+import bisect
+import fnmatch
 import os
 from pathlib import Path
-from qtpy.QtWidgets import QListWidget
-from qtpy.QtCore import Qt
+import numpy as np
+from qtpy.QtWidgets import QListView, QAbstractItemView
+from qtpy.QtCore import (Qt, Signal, QAbstractListModel, QModelIndex,
+                         QPersistentModelIndex, QItemSelectionModel, QSize)
+from qtpy.QtGui import QIcon, QImage, QPixmap
 
 
-class FolderList(QListWidget):
+DEFAULT_FILE_PATTERNS = ['*.tif', '*.tiff', '*.png', '*.jpg', '*.jpeg', '*.bmp']
+
+
+def find_files(folder, patterns=None):
+    """Recursively find files in a folder.
+
+    Parameters
+    ----------
+    folder : str or Path
+        folder to search
+    patterns : list of str, optional
+        glob patterns (e.g. '*.tif') that file names have to match. If
+        None, all files are returned.
+
+    Returns
+    -------
+    files : list of str
+        sorted list of files
+    """
+
+    files = []
+    for root, dirs, names in os.walk(folder):
+        # skip hidden folders
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            if (patterns is None) or any(fnmatch.fnmatch(name.lower(), p.lower()) for p in patterns):
+                files.append(Path(root).joinpath(name).as_posix())
+    return files
+
+
+def array_to_icon(array):
+    """Convert an (height, width, 3) uint8 array to a QIcon."""
+
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    height, width = array.shape[:2]
+    image = QImage(array.data, width, height, 3 * width, QImage.Format_RGB888)
+    # the image does not own the array data
+    return QIcon(QPixmap.fromImage(image.copy()))
+
+
+class FileListModel(QAbstractListModel):
+    """
+    Ordered table of the files of a project. Each file appears once and
+    the row of a file is found in constant time. Once set_params is
+    called, the files are stored in the file_paths list of the project
+    parameters, which is modified in place.
+
+    Attributes
+    ----------
+    icon_provider : callable or None
+        function returning the icon of a file path or None. It is only
+        called for rows being displayed.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self._paths = []
+        self._rows = {}
+        # rows in _rows from this row on are outdated by removals
+        self._valid_rows = 0
+        self.icon_provider = None
+
+    def rowCount(self, parent=QModelIndex()):
+
+        return 0 if parent.isValid() else len(self._paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+
+        if not index.isValid():
+            return None
+        if role in [Qt.DisplayRole, Qt.EditRole, Qt.ToolTipRole]:
+            return self._paths[index.row()]
+        if (role == Qt.DecorationRole) and (self.icon_provider is not None):
+            return self.icon_provider(self._paths[index.row()])
+        return None
+
+    def refresh_icons(self, path=None):
+        """Request icons again, for a single file or for all files."""
+
+        if path is None:
+            first, last = 0, len(self._paths) - 1
+        else:
+            first = last = self.row_of(path)
+        if 0 <= first <= last:
+            self.dataChanged.emit(self.index(first), self.index(last), [Qt.DecorationRole])
+
+    def setData(self, index, value, role=Qt.EditRole):
+
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        self.set_path(index.row(), value)
+        return True
+
+    def flags(self, index):
+
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    @property
+    def paths(self):
+        """Paths of all files. The list must not be modified."""
+
+        return self._paths
+
+    def row_of(self, path):
+        """Get the row of a file, -1 if it is not in the list."""
+
+        row = self._rows.get(path, -1)
+        if row >= self._valid_rows:
+            # rows after removed files are only renumbered when needed
+            self._rows.update((self._paths[i], i) for i in range(self._valid_rows, len(self._paths)))
+            self._valid_rows = len(self._paths)
+            row = self._rows[path]
+        return row
+
+    def set_params(self, params):
+        """
+        Store the files in params.file_paths. If params has no files, the
+        files of the list are copied to it, otherwise the list shows the
+        files of params, which must each appear once.
+
+        Parameters
+        ----------
+        params : Param
+            project parameters
+        """
+
+        if params.file_paths is self._paths:
+            return
+        if params.file_paths is None:
+            params.file_paths = list(self._paths)
+            self._paths = params.file_paths
+            return
+        self.clear()
+        if len(params.file_paths) > 0:
+            self.beginInsertRows(QModelIndex(), 0, len(params.file_paths) - 1)
+            self._paths = params.file_paths
+            self._rows = {f: i for i, f in enumerate(self._paths)}
+            self._valid_rows = len(self._paths)
+            self.endInsertRows()
+        else:
+            self._paths = params.file_paths
+
+    def add_files(self, files):
+        """Append files not yet in the list in a single insertion. Returns
+        the added files."""
+
+        added = []
+        seen = set()
+        for file in files:
+            if (file not in self._rows) and (file not in seen):
+                seen.add(file)
+                added.append(file)
+        if len(added) > 0:
+            first = len(self._paths)
+            self.beginInsertRows(QModelIndex(), first, first + len(added) - 1)
+            self._paths.extend(added)
+            self._rows.update((f, first + i) for i, f in enumerate(added))
+            if self._valid_rows == first:
+                self._valid_rows = len(self._paths)
+            self.endInsertRows()
+        return added
+
+    def remove_row(self, row):
+
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._rows[self._paths.pop(row)]
+        self._valid_rows = min(self._valid_rows, row)
+        self.endRemoveRows()
+
+    def set_path(self, row, path):
+        """Change the path of a file. Raises ValueError if the path is
+        already used by another row."""
+
+        if (path in self._rows) and (self.row_of(path) != row):
+            raise ValueError(f"{path} is already in the list.")
+        del self._rows[self._paths[row]]
+        self._paths[row] = path
+        self._rows[path] = row
+        self.dataChanged.emit(self.index(row), self.index(row))
+
+    def clear(self):
+
+        self.beginResetModel()
+        # the files of the project parameters are left untouched
+        self._paths = []
+        self._rows = {}
+        self._valid_rows = 0
+        self.endResetModel()
+
+
+class FileFilterModel(QAbstractListModel):
+    """
+    Rows of a FileListModel whose file name contains a text and whose path
+    is in an optional set of allowed paths. Without filter, rows are those
+    of the source model and no mapping is stored.
+
+    Parameters
+    ----------
+    source : FileListModel
+        model of all files
+    """
+
+    def __init__(self, source, parent=None):
+        super().__init__(parent)
+
+        self.source = source
+        self._text = ''
+        self._allowed = None
+        # sorted source rows shown, None if all rows are shown
+        self._rows = None
+        self._removed = None
+
+        source.rowsAboutToBeInserted.connect(self._on_rows_about_to_be_inserted)
+        source.rowsInserted.connect(self._on_rows_inserted)
+        source.rowsAboutToBeRemoved.connect(self._on_rows_about_to_be_removed)
+        source.rowsRemoved.connect(self._on_rows_removed)
+        source.dataChanged.connect(self._on_data_changed)
+        source.modelAboutToBeReset.connect(self.beginResetModel)
+        source.modelReset.connect(self._on_reset)
+
+    def rowCount(self, parent=QModelIndex()):
+
+        if parent.isValid():
+            return 0
+        return self.source.rowCount() if self._rows is None else len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+
+        if not index.isValid():
+            return None
+        return self.source.data(self.source.index(self.map_to_source(index.row())), role)
+
+    def flags(self, index):
+
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    @property
+    def is_filtered(self):
+
+        return self._rows is not None
+
+    def map_to_source(self, row):
+
+        return row if self._rows is None else self._rows[row]
+
+    def map_from_source(self, row):
+        """Get the row of a source row, -1 if it is filtered out."""
+
+        if self._rows is None or row < 0:
+            return row
+        i = bisect.bisect_left(self._rows, row)
+        return i if (i < len(self._rows)) and (self._rows[i] == row) else -1
+
+    def _accepted(self, rows):
+
+        paths = self.source.paths
+        text = self._text
+        allowed = self._allowed
+        return [r for r in rows
+                if ((text == '') or (text in paths[r].rsplit('/', 1)[-1].lower()))
+                and ((allowed is None) or (paths[r] in allowed))]
+
+    def set_filter(self, text='', allowed=None):
+        """
+        Show only files whose name contains text (case insensitive) and
+        whose path is in allowed.
+
+        Parameters
+        ----------
+        text : str
+            text searched in file names, '' to show all names
+        allowed : set of str, optional
+            paths of files that can be shown, None to show all files
+        """
+
+        text = text.lower()
+        # narrowing the text only needs to test rows shown so far
+        narrowing = (self._rows is not None) and (allowed is self._allowed) and text.startswith(self._text)
+        candidates = self._rows if narrowing else range(self.source.rowCount())
+        self.beginResetModel()
+        self._text = text
+        self._allowed = allowed
+        if (text == '') and (allowed is None):
+            self._rows = None
+        else:
+            self._rows = self._accepted(candidates)
+        self.endResetModel()
+
+    def _on_rows_about_to_be_inserted(self, parent, first, last):
+
+        if self._rows is None:
+            self.beginInsertRows(QModelIndex(), first, last)
+
+    def _on_rows_inserted(self, parent, first, last):
+
+        if self._rows is None:
+            self.endInsertRows()
+            return
+        # files are always appended to the source
+        added = self._accepted(range(first, last + 1))
+        if len(added) > 0:
+            self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(added) - 1)
+            self._rows.extend(added)
+            self.endInsertRows()
+
+    def _on_rows_about_to_be_removed(self, parent, first, last):
+
+        if self._rows is None:
+            self.beginRemoveRows(QModelIndex(), first, last)
+            return
+        low = bisect.bisect_left(self._rows, first)
+        high = bisect.bisect_right(self._rows, last)
+        self._removed = (low, high)
+        if high > low:
+            self.beginRemoveRows(QModelIndex(), low, high - 1)
+
+    def _on_rows_removed(self, parent, first, last):
+
+        if self._rows is None:
+            self.endRemoveRows()
+            return
+        low, high = self._removed
+        count = last - first + 1
+        self._rows = self._rows[:low] + [r - count for r in self._rows[high:]]
+        if high > low:
+            self.endRemoveRows()
+
+    def _on_data_changed(self, top_left, bottom_right, roles=()):
+
+        if self._rows is None:
+            low, high = top_left.row(), bottom_right.row() + 1
+        else:
+            low = bisect.bisect_left(self._rows, top_left.row())
+            high = bisect.bisect_right(self._rows, bottom_right.row())
+        if high > low:
+            self.dataChanged.emit(self.index(low), self.index(high - 1), roles)
+
+    def _on_reset(self):
+
+        if self._rows is not None:
+            self._rows = self._accepted(range(self.source.rowCount()))
+        self.endResetModel()
+
+
+class FileItem:
+    """
+    Entry of a FolderList providing the text and setText methods of
+    QListWidgetItem. The item follows its file when rows are added or
+    removed, the text of a removed item is its last known path.
+    """
+
+    def __init__(self, model, row):
+
+        self._index = QPersistentModelIndex(model.index(row))
+        self._path = model.paths[row]
+
+    def row(self):
+        """Row of the file, -1 if it was removed from the list."""
+
+        return self._index.row() if self._index.isValid() else -1
+
+    def text(self):
+
+        if self._index.isValid():
+            self._path = self._index.data()
+        return self._path
+
+    def setText(self, text):
+
+        if self._index.isValid():
+            self._index.model().set_path(self._index.row(), text)
+        self._path = text
+
+
+class FolderList(QListView):
+    """
+    List of the files of a project. Files are held in a FileListModel and
+    rows are only rendered when visible, so that projects with many files
+    stay responsive. The list provides the QListWidget methods used by the
+    plugin (count, item, addItems, takeItem, currentRow...) with rows of
+    the complete list, independently of the filter set with set_filter.
+    The current file can be hidden by the filter.
+    """
+
+    currentItemChanged = Signal(object, object)
+    # emitted from any thread when the icon of a file changed
+    iconChanged = Signal(str)
+
     # be able to pass the Napari viewer name (viewer)
-    def __init__(self, viewer, parent=None, local_copy=False, local_folder=None):
+    def __init__(self, viewer, parent=None):
         super().__init__(parent)
 
         self.viewer = viewer
         self.setAcceptDrops(True)
-        self.setDragEnabled(True)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setUniformItemSizes(True)
+
+        # files matching these patterns are added when dropping a folder
+        self.file_patterns = DEFAULT_FILE_PATTERNS
 
-        self.local_copy = local_copy
-        self.local_folder = local_folder
+        self.file_model = FileListModel(self)
+        self.filter_model = FileFilterModel(self.file_model, self)
+        self.setModel(self.filter_model)
+        self._current = None
+        self._removing_current = False
+        self._sync_selection = False
 
-        #self.model().rowsInserted.connect(self.addFileEvent())
+        self.selectionModel().currentChanged.connect(self._on_view_current_changed)
+        self.filter_model.modelReset.connect(self._select_current_in_view)
+        self.file_model.rowsAboutToBeRemoved.connect(self._on_rows_about_to_be_removed)
+        self.file_model.rowsRemoved.connect(self._on_rows_removed)
+        self.file_model.modelReset.connect(self._on_reset)
+        self.iconChanged.connect(self.file_model.refresh_icons)
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls:
@@ -37,21 +442,160 @@ class FolderList(QListWidget):
             event.setDropAction(Qt.CopyAction)
             event.accept()
             
+            files = []
             for url in event.mimeData().urls():
                 file = str(url.toLocalFile())
                 if Path(file).is_dir():
-                    raise NotImplementedError("Folder drag and drop not implemented yet")
+                    files += find_files(file, self.file_patterns)
                 else:
-                    if self.local_copy:
-                        copy_to = self.local_folder.joinpath(Path(file).name)
-                        shutil.copy(Path(file), copy_to)
-                        self.addItem(copy_to.as_posix())
-                    else:
-                        self.addItem(file)
-    
+                    files.append(file)
+            self.add_files(files)
+
+    def add_files(self, files):
+        """Add multiple files to the list in a single insertion.
+
+        Files already in the list or duplicated in files are skipped.
+
+        Parameters
+        ----------
+        files : list of str or Path
+            files to add
+
+        Returns
+        -------
+        added : list of str
+            entries added to the list
+        """
+
+        return self.file_model.add_files([Path(file).as_posix() for file in files])
+
+    def addItem(self, file):
+
+        self.file_model.add_files([file])
+
+    def addItems(self, files):
+
+        self.file_model.add_files(files)
+
+    def files(self):
+        """Get a copy of the list of files."""
+
+        return list(self.file_model.paths)
+
+    def count(self):
+
+        return self.file_model.rowCount()
+
+    def item(self, row):
+
+        if not 0 <= row < self.count():
+            return None
+        return FileItem(self.file_model, row)
+
+    def row_of(self, file):
+        """Get the row of a file, -1 if it is not in the list."""
+
+        return self.file_model.row_of(file)
+
+    def set_params(self, params):
+        """Store the files in the project parameters, see
+        FileListModel.set_params."""
+
+        self.file_model.set_params(params)
+
+    def takeItem(self, row):
+
+        item = self.item(row)
+        if item is not None:
+            self.file_model.remove_row(row)
+        return item
+
+    def clear(self):
+
+        self.file_model.clear()
+
+    def currentItem(self):
+
+        if (self._current is None) or (self._current.row() < 0):
+            return None
+        return self._current
+
+    def currentRow(self):
+
+        return self._current.row() if self._current is not None else -1
+
+    def setCurrentRow(self, row):
+
+        self._set_current(row if 0 <= row < self.count() else -1)
+
+    def set_icon_provider(self, provider, size=64):
+        """
+        Show icons next to file names.
+
+        Parameters
+        ----------
+        provider : callable or None
+            function returning the icon of a file path, or None if it is not
+            available yet, in which case iconChanged has to be emitted once
+            it is. None to hide icons.
+        size : int
+            size of the icons
+        """
+
+        self.file_model.icon_provider = provider
+        self.setIconSize(QSize(size, size) if provider is not None else QSize())
+        self.file_model.refresh_icons()
+
+    def set_filter(self, text='', allowed=None):
+        """Show only some files, see FileFilterModel.set_filter."""
+
+        self.filter_model.set_filter(text, allowed)
+
+    def _set_current(self, row):
+
+        previous = self._current
+        previous_row = previous.row() if previous is not None else -1
+        if (previous_row == row) and ((row >= 0) or (previous is None)):
+            return
+        self._current = self.item(row) if row >= 0 else None
+        self._select_current_in_view()
+        self.currentItemChanged.emit(self._current, previous)
+
+    def _select_current_in_view(self):
+        """Select the current file in the view if it is not filtered out."""
+
+        row = self.filter_model.map_from_source(self.currentRow())
+        index = self.filter_model.index(row) if row >= 0 else QModelIndex()
+        self._sync_selection = True
+        try:
+            self.selectionModel().setCurrentIndex(index, QItemSelectionModel.ClearAndSelect)
+        finally:
+            self._sync_selection = False
+
+    def _on_view_current_changed(self, current, previous):
+
+        if self._sync_selection or self._removing_current or not current.isValid():
+            return
+        self._set_current(self.filter_model.map_to_source(current.row()))
+
+    def _on_rows_about_to_be_removed(self, parent, first, last):
+
+        self._removing_current = first <= self.currentRow() <= last
+
+    def _on_rows_removed(self, parent, first, last):
+
+        # as in QListWidget, the next file becomes current
+        if self._removing_current:
+            self._removing_current = False
+            self._set_current(min(first, self.count() - 1))
+
+    def _on_reset(self):
+
+        self._current = None
+
     def addFileEvent(self):
         pass
 
     def select_first_file(self):
         
-        self.setCurrentRow(0)
\ No newline at end of file
+        self.setCurrentRow(0)
@@ -0,0 +1,201 @@
+"""
+Memory-bounded cache of image arrays filled in the background, used to
+prefetch the neighbours of the selected file.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .image_io import read_image, IMAGE_SUFFIXES
+
+
+class ImageCache:
+    """
+    Least recently used cache of image arrays. Entries are keyed by path,
+    modification time and size, so that modified files are re-read.
+
+    Parameters
+    ----------
+    max_bytes : int
+        maximum memory used by cached arrays
+    num_threads : int
+        number of threads used for prefetching
+    reader : callable, optional
+        function reading a file into an array, default is image_io.read_image
+
+    Attributes
+    ----------
+    hits : int
+        number of requests served from the cache or from a running prefetch
+    misses : int
+        number of requests that required reading the file
+
+    """
+
+    def __init__(self, max_bytes=2**30, num_threads=2, reader=None):
+
+        self.max_bytes = max_bytes
+        self.reader = reader if reader is not None else read_image
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    @staticmethod
+    def supports(path):
+        """Check if the cache can read a file."""
+
+        return Path(path).suffix.lower() in IMAGE_SUFFIXES
+
+    @staticmethod
+    def _key(path):
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    @property
+    def nbytes(self):
+        """Memory used by cached arrays."""
+
+        return self._nbytes
+
+    def stats(self):
+        """Get cache statistics as dict."""
+
+        with self._lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'entries': len(self._cache),
+                'nbytes': self._nbytes, 'max_bytes': self.max_bytes, 'pending': len(self._pending)}
+
+    def get(self, path):
+        """
+        Get the array of a file, reading it if needed.
+
+        Parameters
+        ----------
+        path : str or Path
+            path of the file
+
+        Returns
+        -------
+        data : array
+        """
+
+        key = self._key(path)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            future = self._pending.get(key)
+            if future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if future is not None:
+            try:
+                data = future.result()
+            except Exception:
+                data = self.reader(key[0])
+        else:
+            data = self.reader(key[0])
+            self._insert(key, data)
+        return data
+
+    def pop(self, path):
+        """
+        Get the array of a file and remove it from the cache. Use this for
+        data that is going to be modified.
+
+        Parameters
+        ----------
+        path : str or Path
+            path of the file
+
+        Returns
+        -------
+        data : array
+        """
+
+        data = self.get(path)
+        self.invalidate(path)
+        return data
+
+    def invalidate(self, path):
+        """Remove all entries of a file."""
+
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == path]:
+                self._nbytes -= self._cache.pop(key).nbytes
+
+    def clear(self):
+        """Remove all entries."""
+
+        with self._lock:
+            self._cache.clear()
+            self._nbytes = 0
+
+    def prefetch(self, paths):
+        """
+        Read files in the background. Prefetches requested earlier that did
+        not start yet and are not part of paths are cancelled.
+
+        Parameters
+        ----------
+        paths : list of str or Path
+            files to prefetch, in order of priority
+        """
+
+        keys = []
+        for p in paths:
+            try:
+                if self.supports(p):
+                    keys.append(self._key(p))
+            except OSError:
+                continue
+
+        with self._lock:
+            for key, future in list(self._pending.items()):
+                if key not in keys and future.cancel():
+                    del self._pending[key]
+            for key in keys:
+                if (key in self._cache) or (key in self._pending):
+                    continue
+                self._pending[key] = self._executor.submit(self._load, key)
+
+    def _load(self, key):
+
+        try:
+            data = self.reader(key[0])
+            self._insert(key, data)
+            return data
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _insert(self, key, data):
+
+        if data.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._nbytes += data.nbytes
+            while self._nbytes > self.max_bytes:
+                _, removed = self._cache.popitem(last=False)
+                self._nbytes -= removed.nbytes
+
+    def close(self):
+        """Stop prefetching and clear the cache."""
+
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.clear()
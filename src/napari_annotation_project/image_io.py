@@ -0,0 +1,488 @@
+"""
+Reading and writing of project images and annotations.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from pathlib import Path
+import numpy as np
+import tifffile
+
+from .instrumentation import timed
+
+
+# formats read directly by the plugin, other formats are opened by napari readers
+IMAGE_SUFFIXES = ['.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp']
+
+
+@timed('read_image', nbytes=lambda image, *args, **kwargs: image.nbytes)
+def read_image(path):
+    """
+    Read a complete image file, using tifffile for tif files.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the image file
+
+    Returns
+    -------
+    image : array
+
+    """
+
+    if Path(path).suffix.lower() in ['.tif', '.tiff']:
+        return tifffile.imread(path)
+    from skimage.io import imread
+    return imread(path)
+
+
+@timed('write_annotations', nbytes=lambda result, path, data, *args, **kwargs: data.nbytes)
+def write_annotations(path, data, compression=None, tile_size=256):
+    """
+    Write an annotation array as tif file.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the annotation file
+    data : array
+        annotations
+    compression : str, optional
+        compression used by tifffile e.g. 'zlib' or 'zstd' (the latter
+        requires imagecodecs). By default, files are not compressed.
+    tile_size : int
+        size of the tiles of compressed files, must be a multiple of 16.
+        Each 2D plane is stored as a separate tiled page.
+
+    The file is written to a temporary file first, synced to disk and then
+    renamed, so that an interrupted write never leaves a corrupt file.
+
+    """
+
+    path = Path(path)
+    temp_path = path.with_name(path.name + '.tmp')
+    try:
+        with open(temp_path, 'wb') as f:
+            if compression is None:
+                tifffile.imwrite(f, data, photometric='minisblack')
+            else:
+                tifffile.imwrite(
+                    f, data, photometric='minisblack', compression=compression,
+                    tile=(tile_size, tile_size))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+class AnnotationWriter:
+    """
+    Write annotation files in a background thread. A snapshot of the data
+    is taken when a write is submitted so that the annotations can be
+    modified while they are written. Writes are executed in submission
+    order. Errors of writes are kept until they are raised by wait or
+    drain, unless a later write of the same file succeeds.
+    """
+
+    def __init__(self):
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path):
+
+        return os.path.abspath(path)
+
+    def submit(self, path, data, compression=None, tile_size=256):
+        """
+        Schedule writing annotations.
+
+        Parameters
+        ----------
+        path : str or Path
+            path of the annotation file
+        data : array
+            annotations, copied before returning
+        compression : str, optional
+            compression of the file, see write_annotations
+        tile_size : int
+            tile size of compressed files
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+        """
+
+        snapshot = np.array(data, copy=True)
+        key = self._key(path)
+        with self._lock:
+            future = self._executor.submit(
+                self._write, key, path, snapshot, compression, tile_size)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._on_done(key, f))
+        return future
+
+    def _write(self, key, *args):
+        """Write a file, recording the error before the future completes so
+        that it cannot be missed by wait or drain."""
+
+        try:
+            write_annotations(*args)
+        except Exception as error:
+            with self._lock:
+                self._errors[key] = error
+            raise
+        with self._lock:
+            # the file holds a newer snapshot than the failed write
+            self._errors.pop(key, None)
+
+    def _on_done(self, key, future):
+
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def is_pending(self, path):
+        """Check if a write of path is scheduled or running."""
+
+        with self._lock:
+            return self._key(path) in self._pending
+
+    def wait(self, path):
+        """Wait for the pending write of a file to complete. An error of a
+        write of the file that was not reported yet is raised."""
+
+        key = self._key(path)
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None:
+            wait_futures([future])
+        with self._lock:
+            error = self._errors.pop(key, None)
+        if error is not None:
+            raise error
+
+    def drain(self):
+        """Wait for all pending writes to complete. The first error not
+        reported yet is raised once all writes are done."""
+
+        with self._lock:
+            futures = list(self._pending.values())
+        wait_futures(futures)
+        with self._lock:
+            errors = list(self._errors.values())
+            self._errors.clear()
+        if len(errors) > 0:
+            raise errors[0]
+
+
+def read_annotations(path):
+    """
+    Read an annotation file, compressed or not.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the annotation file
+
+    Returns
+    -------
+    annotations : array
+
+    """
+
+    return tifffile.imread(path)
+
+
+def memmap_image(path):
+    """
+    Open an image file as read-only memory map so that only the parts
+    accessed are read from disk.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the image file
+
+    Returns
+    -------
+    image : numpy.memmap or None
+        None if the file is not an uncompressed contiguous tif file
+
+    """
+
+    if Path(path).suffix.lower() not in ['.tif', '.tiff']:
+        return None
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError:
+        return None
+
+
+def memmap_annotations(path, shape):
+    """
+    Open an existing annotation file as writable memory map. Only the parts
+    of the file that are accessed are loaded and flushing the map only
+    writes the pages modified since the last flush. The file is not
+    modified until data is written to the map.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the annotation file
+    shape : tuple
+        shape of the annotations
+
+    Returns
+    -------
+    annotations : numpy.memmap or None
+        None if the file does not exist or is not an uncompressed
+        contiguous tif file
+
+    """
+
+    if not Path(path).exists():
+        return None
+    try:
+        data = tifffile.memmap(path, mode='r+')
+    except ValueError:
+        return None
+    if data.shape != tuple(shape):
+        raise ValueError(f"Annotations {path} have shape {data.shape} instead of {tuple(shape)}")
+    return data
+
+
+def create_annotations_memmap(path, data):
+    """
+    Write annotations to an uncompressed annotation file, replacing any
+    existing file, and open it as writable memory map. This is used to
+    create missing files and to convert compressed files once annotations
+    are modified.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the annotation file
+    data : array
+        annotations
+
+    Returns
+    -------
+    annotations : numpy.memmap
+
+    """
+
+    path = Path(path)
+    # create the new file next to the old one and replace it once complete
+    temp_path = path.with_name(path.name + '.tmp')
+    memmap = tifffile.memmap(temp_path, shape=data.shape, dtype=data.dtype, photometric='minisblack')
+    memmap[:] = data
+    memmap.flush()
+    del memmap
+    os.replace(temp_path, path)
+    return tifffile.memmap(path, mode='r+')
+
+
+def roi_index(roi, annotations_ndim):
+    """
+    Get the index selecting the region of a roi in an array. For nD data,
+    the roi is located in the plane defined by the first coordinates of its
+    first corner.
+
+    Parameters
+    ----------
+    roi : array
+        roi corners of shape (4, annotations_ndim)
+    annotations_ndim : int
+        number of dimensions of the annotations
+
+    Returns
+    -------
+    index : tuple
+        plane indices followed by the row and column slices
+
+    """
+
+    limits = np.asarray(roi).astype(int)
+    plane = tuple(limits[0, :annotations_ndim-2].tolist())
+    return plane + (
+        slice(limits[0,-2], limits[2,-2]),
+        slice(limits[0,-1], limits[1,-1]))
+
+
+def crop_roi(data, roi, annotations_ndim):
+    """
+    Crop an array using a roi. This returns a view of the data.
+
+    Parameters
+    ----------
+    data : array
+        image or annotation array
+    roi : array
+        roi corners of shape (4, annotations_ndim)
+    annotations_ndim : int
+        number of dimensions of the annotations
+
+    Returns
+    -------
+    crop : array
+        cropped data
+
+    """
+
+    return data[roi_index(roi, annotations_ndim)]
+
+
+class RegionReader:
+    """
+    Read regions of an image file without loading the full array.
+
+    Uncompressed contiguous tif files are memory-mapped so that only the
+    bytes inside a region are read. For tiled tif files only the tiles
+    intersecting the region are decoded, and other tif files are read page
+    by page so that only the page containing the requested plane is
+    decoded. The last decoded page is kept, so that consecutive regions of
+    the same plane decode it once. Files in other formats are loaded
+    completely once.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the image file
+
+    """
+
+    def __init__(self, path):
+
+        self.path = Path(path)
+        self._tif = None
+        self._series = None
+        self._array = None
+        # index of the last decoded page, None for the whole series, and its data
+        self._decoded = None
+
+        if self.path.suffix.lower() in ['.tif', '.tiff']:
+            try:
+                self._array = tifffile.memmap(self.path, mode='r')
+            except ValueError:
+                self._tif = tifffile.TiffFile(self.path)
+                self._series = self._tif.series[0]
+        else:
+            from skimage.io import imread
+            self._array = imread(self.path)
+
+    @property
+    def shape(self):
+        if self._array is not None:
+            return self._array.shape
+        return self._series.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def read_roi(self, roi, annotations_ndim):
+        """
+        Read the region of a roi.
+
+        Parameters
+        ----------
+        roi : array
+            roi corners of shape (4, annotations_ndim)
+        annotations_ndim : int
+            number of dimensions of the annotations
+
+        Returns
+        -------
+        crop : array
+            cropped data
+
+        """
+
+        if self._array is not None:
+            return np.array(crop_roi(self._array, roi, annotations_ndim))
+
+        index = roi_index(roi, annotations_ndim)
+        plane, region = index[:-2], index[-2:]
+        page, plane = self._find_page(plane)
+        if (page is not None) and (len(plane) == 0) and page.keyframe.is_tiled:
+            crop = self._read_tiles(page, *region)
+            if crop is not None:
+                return crop
+        key = page.index if page is not None else None
+        if (self._decoded is None) or (self._decoded[0] != key):
+            self._decoded = (key, self._series.asarray() if page is None else page.asarray())
+        return np.array(self._decoded[1][plane + region])
+
+    def _read_tiles(self, page, rows, cols):
+        """Decode only the tiles of a 2D tiled page intersecting a region.
+        Returns None if the page layout is not supported."""
+
+        keyframe = page.keyframe
+        height, width = keyframe.imagelength, keyframe.imagewidth
+        r0, r1 = rows.start, min(rows.stop, height)
+        c0, c1 = cols.start, min(cols.stop, width)
+        if (r0 < 0) or (c0 < 0) or (r1 <= r0) or (c1 <= c0) or (
+            keyframe.imagedepth > 1) or (keyframe.planarconfig == 2):
+            return None
+
+        tile_length, tile_width = keyframe.tilelength, keyframe.tilewidth
+        tiles_across = -(-width // tile_width)
+        crop = np.zeros((r1 - r0, c1 - c0) + keyframe.shape[2:], dtype=keyframe.dtype)
+        filehandle = self._tif.filehandle
+        for tile_row in range(r0 // tile_length, (r1 - 1) // tile_length + 1):
+            for tile_col in range(c0 // tile_width, (c1 - 1) // tile_width + 1):
+                tile_index = tile_row * tiles_across + tile_col
+                if page.databytecounts[tile_index] == 0:
+                    continue
+                filehandle.seek(page.dataoffsets[tile_index])
+                data = filehandle.read(page.databytecounts[tile_index])
+                tile, _, _ = keyframe.decode(data, tile_index, jpegtables=keyframe.jpegtables)
+                tile = tile.reshape((tile_length, tile_width) + keyframe.shape[2:])
+
+                y0, x0 = tile_row * tile_length, tile_col * tile_width
+                ys = slice(max(r0, y0), min(r1, y0 + tile_length))
+                xs = slice(max(c0, x0), min(c1, x0 + tile_width))
+                crop[ys.start-r0:ys.stop-r0, xs.start-c0:xs.stop-c0] = tile[
+                    ys.start-y0:ys.stop-y0, xs.start-x0:xs.stop-x0]
+        return crop
+
+    def _find_page(self, plane):
+        """Find the page containing a plane. Return the page and the
+        remaining index within that page."""
+
+        pages = self._series.pages
+        page_shape = pages[0].shape
+        num_page_dims = len(self.shape) - len(page_shape)
+        page_dims = self.shape[:num_page_dims]
+        if (num_page_dims < 0) or (num_page_dims > len(plane)
+            ) or (tuple(self.shape[num_page_dims:]) != tuple(page_shape)
+            ) or (int(np.prod(page_dims)) != len(pages)):
+            return None, plane
+        page_index = int(np.ravel_multi_index(plane[:num_page_dims], page_dims)) if num_page_dims > 0 else 0
+        page = pages[page_index]
+        if page is None:
+            return None, plane
+        return page, plane[num_page_dims:]
+
+    def close(self):
+        """Release the file."""
+
+        if self._tif is not None:
+            self._tif.close()
+        self._tif = None
+        self._series = None
+        self._array = None
+        self._decoded = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
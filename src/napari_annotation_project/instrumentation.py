@@ -0,0 +1,142 @@
+"""
+Lightweight timing of the hot paths of the plugin. Instrumented functions
+record their duration and the number of bytes they read or wrote into a
+ring buffer. Recording is disabled by default, in which case an
+instrumented call only costs a check of a global flag. It can be enabled
+with enable() or by setting the NAPARI_ANNOTATION_PROFILE environment
+variable.
+"""
+import csv
+import functools
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+
+DEFAULT_CAPACITY = 10000
+
+_enabled = False
+_records = deque(maxlen=DEFAULT_CAPACITY)
+_lock = threading.Lock()
+
+
+def enable(capacity=None):
+    """
+    Start recording timings.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        number of records kept in the ring buffer. If None, the current
+        capacity is kept.
+    """
+
+    global _enabled, _records
+    if capacity is not None and capacity != _records.maxlen:
+        with _lock:
+            _records = deque(_records, maxlen=capacity)
+    _enabled = True
+
+
+def disable():
+    """Stop recording timings. Existing records are kept."""
+
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear():
+    """Remove all records."""
+
+    with _lock:
+        _records.clear()
+
+
+def record(name, duration, nbytes=0):
+    """Add a record to the ring buffer."""
+
+    with _lock:
+        _records.append((name, time.time(), duration, nbytes))
+
+
+def records():
+    """Get a copy of the records as list of (name, time, duration, nbytes) tuples."""
+
+    with _lock:
+        return list(_records)
+
+
+def timed(name, nbytes=None):
+    """
+    Decorator recording the duration of each call of a function.
+
+    Parameters
+    ----------
+    name : str
+        name of the record
+    nbytes : callable, optional
+        function called as nbytes(result, *args, **kwargs) returning the
+        number of bytes read or written by the call
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            duration = time.perf_counter() - start
+            record(name, duration, nbytes(result, *args, **kwargs) if nbytes is not None else 0)
+            return result
+
+        return wrapper
+    return decorator
+
+
+def summary():
+    """
+    Summarize records by name.
+
+    Returns
+    -------
+    summary : dict
+        for each name the number of calls, the 50th, 90th and 99th
+        percentiles and the maximum of durations in seconds, the total
+        number of bytes and the throughput in MB/s
+    """
+
+    by_name = {}
+    for name, _, duration, nbytes in records():
+        by_name.setdefault(name, []).append((duration, nbytes))
+
+    result = {}
+    for name, values in by_name.items():
+        values = np.array(values, dtype=float)
+        durations, nbytes = values[:, 0], values[:, 1]
+        p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+        total_time = durations.sum()
+        result[name] = {
+            'count': len(durations), 'p50': p50, 'p90': p90, 'p99': p99, 'max': durations.max(),
+            'bytes': int(nbytes.sum()),
+            'mb_per_s': nbytes.sum() / 2**20 / total_time if total_time > 0 else 0.0}
+    return result
+
+
+def export_log(path):
+    """Save all records as csv file."""
+
+    with open(path, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'time', 'duration', 'bytes'])
+        writer.writerows(records())
+
+
+if os.environ.get('NAPARI_ANNOTATION_PROFILE'):
+    enable()
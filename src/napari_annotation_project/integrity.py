@@ -0,0 +1,429 @@
+"""
+Consistency checks of a project against the files on disk and bulk repair
+of the problems found. Image and annotation headers are read in parallel
+and only headers are read, so that large projects are checked quickly.
+Checks and repairs only rely on the project parameters and on the files on
+disk, so that they can run without a napari viewer.
+"""
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import tifffile
+
+from . import project as pr
+from .image_io import IMAGE_SUFFIXES
+from .metadata import MetadataCache, read_metadata
+from .rois import RoiIndex, roi_bounds
+
+
+ISSUE_KINDS = [
+    'missing_source', 'unreadable_source', 'annotation_shape', 'annotation_dtype',
+    'roi_dimensions', 'roi_out_of_bounds', 'orphaned_annotation', 'stem_collision']
+
+# folder of the annotation folder where orphaned annotations are moved
+ORPHAN_FOLDER = 'orphaned'
+
+
+def _issue(kind, file_path, message, path=None, rois=None):
+
+    return {'kind': kind, 'file_path': file_path, 'path': path, 'message': message, 'rois': rois}
+
+
+def _read_header(path):
+    """Read the metadata of a file, None if it is missing or unreadable."""
+
+    try:
+        return read_metadata(path)
+    except (OSError, ValueError, tifffile.TiffFileError):
+        return None
+
+
+def _rois_out_of_bounds(rois, shape):
+    """Get the indices of rois that are not contained in an array of a given
+    shape. Plane coordinates index planes, the last two coordinates are the
+    limits of the region. Rois of the planes of the array are looked up in
+    the roi index, all rois of other planes are outside."""
+
+    index = RoiIndex(rois)
+    shape = np.asarray(shape)
+    inside = []
+    for plane in index.planes:
+        if (np.asarray(plane) >= 0).all() and (np.asarray(plane) < shape[:-2]).all():
+            inside.append(index.contained((0, 0), shape[-2:], plane=plane))
+    inside = np.concatenate(inside) if inside else np.zeros(0, dtype=int)
+    # planes are indexed by the truncated plane coordinates of the first
+    # corner, the exact plane coordinates of all corners are checked
+    lower, upper = roi_bounds(rois)
+    outside = np.ones(len(upper), dtype=bool)
+    outside[inside] = False
+    outside |= (lower[:, :-2] < 0).any(axis=1) | (upper[:, :-2] >= shape[:-2]).any(axis=1)
+    return np.flatnonzero(outside).tolist()
+
+
+def check_project(project_path, params=None, metadata=None, num_threads=8):
+    """
+    Check that a project is consistent with the files on disk.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    params : Param, optional
+        parameters of the project, loaded from project_path if None
+    metadata : MetadataCache, optional
+        cache of the image headers of the project, a cache is opened and
+        closed if None
+    num_threads : int
+        number of threads reading headers
+
+    Returns
+    -------
+    issues : list of dict
+        one dict per problem with its kind (see ISSUE_KINDS), the project
+        file concerned (None for orphaned annotations), the path of the
+        file on disk concerned, a message and for roi problems the indices
+        of the rois concerned
+
+    """
+
+    project_path = Path(project_path)
+    if params is None:
+        params = pr.load_project(project_path)
+    file_paths = params.file_paths if params.file_paths is not None else []
+    annotation_paths = {f: pr.get_annotation_path(project_path, f) for f in file_paths}
+
+    own_metadata = metadata is None
+    if own_metadata:
+        metadata = MetadataCache(project_path, num_threads=num_threads)
+    try:
+        headers = metadata.update(file_paths)
+    finally:
+        if own_metadata:
+            metadata.close()
+
+    # only files without header can be missing or unreadable
+    without_header = [f for f in file_paths if f not in headers]
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        exists = dict(zip(without_header, executor.map(
+            lambda f: pr.resolve_file_path(project_path, f).exists(), without_header)))
+        annotation_headers = dict(zip(file_paths, executor.map(_read_header, annotation_paths.values())))
+
+    issues = []
+    for file_path in file_paths:
+        header = headers.get(file_path)
+        if header is None:
+            if not exists[file_path]:
+                issues.append(_issue(
+                    'missing_source', file_path, f"{file_path} not found.",
+                    path=pr.resolve_file_path(project_path, file_path)))
+            elif Path(file_path).suffix.lower() in IMAGE_SUFFIXES:
+                issues.append(_issue(
+                    'unreadable_source', file_path, f"{file_path} cannot be read.",
+                    path=pr.resolve_file_path(project_path, file_path)))
+            # without header, the shape of files opened by napari readers is unknown
+            shape = None
+        else:
+            shape = tuple(header['shape'][:-1]) if params.rgb else tuple(header['shape'])
+
+        annotation_header = annotation_headers[file_path]
+        annotation_path = annotation_paths[file_path]
+        if annotation_header is not None:
+            if not np.issubdtype(np.dtype(annotation_header['dtype']), np.integer):
+                issues.append(_issue(
+                    'annotation_dtype', file_path,
+                    f"Annotations of {file_path} have type {annotation_header['dtype']}, "
+                    f"labels have to be integers.", path=annotation_path))
+            if shape is None:
+                shape = tuple(annotation_header['shape'])
+            elif tuple(annotation_header['shape']) != shape:
+                issues.append(_issue(
+                    'annotation_shape', file_path,
+                    f"Annotations of {file_path} have shape {tuple(annotation_header['shape'])}, "
+                    f"its image {shape}.", path=annotation_path))
+
+        rois = params.rois.get(file_path, [])
+        if (len(rois) == 0) or (shape is None):
+            continue
+        if rois.shape[2] != len(shape):
+            issues.append(_issue(
+                'roi_dimensions', file_path,
+                f"Rois of {file_path} have {rois.shape[2]} dimensions, its annotations have {len(shape)}.",
+                rois=list(range(len(rois)))))
+            continue
+        outside = _rois_out_of_bounds(rois, shape)
+        if len(outside) > 0:
+            issues.append(_issue(
+                'roi_out_of_bounds', file_path,
+                f"{len(outside)} rois of {file_path} are outside of its shape {shape}.", rois=outside))
+
+    # annotation files are named after the file stem, files with the same
+    # stem share an annotation file
+    by_annotation = {}
+    for file_path, annotation_path in annotation_paths.items():
+        by_annotation.setdefault(annotation_path.name, []).append(file_path)
+    for name, same_stem in by_annotation.items():
+        if len(same_stem) > 1:
+            for file_path in same_stem:
+                issues.append(_issue(
+                    'stem_collision', file_path,
+                    f"{file_path} shares the annotation file {name} with "
+                    f"{', '.join(f for f in same_stem if f != file_path)}.",
+                    path=annotation_paths[file_path]))
+
+    annotations_folder = project_path.joinpath('annotations')
+    if annotations_folder.is_dir():
+        for entry in sorted(os.scandir(annotations_folder), key=lambda e: e.name):
+            if entry.is_file() and entry.name.endswith('.tif') and (entry.name not in by_annotation):
+                issues.append(_issue(
+                    'orphaned_annotation', None,
+                    f"{entry.name} does not belong to any project file.", path=Path(entry.path)))
+
+    return issues
+
+
+def _index_files(search_roots, names):
+    """Find files with given names in folders, searched recursively. Hidden
+    folders are skipped."""
+
+    found = {}
+    for search_root in search_roots:
+        for root, dirs, files in os.walk(search_root):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in files:
+                if name in names:
+                    found.setdefault(name, []).append(Path(root).joinpath(name).absolute().as_posix())
+    return found
+
+
+def _common_tail(path1, path2):
+    """Number of identical trailing components of two paths."""
+
+    count = 0
+    for part1, part2 in zip(reversed(Path(path1).parts), reversed(Path(path2).parts)):
+        if part1 != part2:
+            break
+        count += 1
+    return count
+
+
+def rename_file(params, old_path, new_path):
+    """Replace a project file by another one, keeping its position in the
+    file list, its rois and its channel."""
+
+    params.file_paths[params.file_paths.index(old_path)] = new_path
+    if old_path in params.rois:
+        params.rois[new_path] = params.rois.pop(old_path)
+    if old_path in params.channels:
+        params.channels[new_path] = params.channels.pop(old_path)
+
+
+def relink_files(params, search_roots, file_paths=None):
+    """
+    Relink missing files to files with the same name found in search roots.
+    If several files match, the one whose path has the most trailing
+    folders in common with the missing file is chosen, files with ties are
+    not relinked. As annotations are named after the file stem, they stay
+    attached to the relinked files.
+
+    Parameters
+    ----------
+    params : Param
+        parameters of the project, modified in place
+    search_roots : list of str or Path
+        folders searched recursively
+    file_paths : list of str, optional
+        files to relink, default is all missing files
+
+    Returns
+    -------
+    relinked : dict
+        new path of each relinked file
+
+    """
+
+    project_files = params.file_paths if params.file_paths is not None else []
+    if file_paths is None:
+        file_paths = [f for f in project_files if not pr.resolve_file_path(params.project_path, f).exists()]
+    found = _index_files(search_roots, {Path(f).name for f in file_paths})
+
+    relinked = {}
+    for file_path in file_paths:
+        candidates = [c for c in found.get(Path(file_path).name, []) if c not in project_files]
+        if len(candidates) == 0:
+            continue
+        tails = [_common_tail(file_path, c) for c in candidates]
+        best = max(tails)
+        if tails.count(best) > 1:
+            continue
+        new_path = candidates[tails.index(best)]
+        rename_file(params, file_path, new_path)
+        relinked[file_path] = new_path
+    return relinked
+
+
+def remove_files(params, file_paths):
+    """Remove files from a project with their rois and channels. Annotation
+    files are kept."""
+
+    file_paths = set(file_paths)
+    params.file_paths = [f for f in params.file_paths if f not in file_paths]
+    for file_path in file_paths:
+        params.rois.pop(file_path, None)
+        params.channels.pop(file_path, None)
+
+
+def clip_rois(params, issues):
+    """
+    Clip the rois found outside of their file by check_project to the
+    shape of the file. Rois without any pixel inside the file are removed.
+
+    Parameters
+    ----------
+    params : Param
+        parameters of the project, modified in place
+    issues : list of dict
+        issues returned by check_project
+
+    Returns
+    -------
+    num_changed : int
+        number of rois clipped or removed
+
+    """
+
+    num_changed = 0
+    for issue in issues:
+        if issue['kind'] != 'roi_out_of_bounds':
+            continue
+        file_path = issue['file_path']
+        annotation_path = pr.get_annotation_path(params.project_path, file_path)
+        header = _read_header(pr.resolve_file_path(params.project_path, file_path))
+        if header is not None:
+            shape = np.array(header['shape'][:-1] if params.rgb else header['shape'])
+        else:
+            shape = np.array(_read_header(annotation_path)['shape'])
+
+        rois = params.rois[file_path].copy()
+        upper = np.concatenate([shape[:-2] - 1, shape[-2:]])
+        rois[issue['rois']] = np.clip(rois[issue['rois']], 0, upper)
+        lower, higher = roi_bounds(rois)
+        keep = ((higher[:, -2:] - lower[:, -2:]) > 0).all(axis=1)
+        params.set_rois(file_path, rois[keep])
+        num_changed += len(issue['rois'])
+    return num_changed
+
+
+def move_orphaned_annotations(project_path, issues):
+    """Move the orphaned annotations found by check_project to the
+    annotations/orphaned folder. Returns the new paths."""
+
+    orphan_folder = Path(project_path).joinpath('annotations', ORPHAN_FOLDER)
+    moved = []
+    for issue in issues:
+        if issue['kind'] != 'orphaned_annotation':
+            continue
+        orphan_folder.mkdir(exist_ok=True)
+        moved.append(orphan_folder.joinpath(issue['path'].name))
+        os.replace(issue['path'], moved[-1])
+    return moved
+
+
+def repair_project(project_path, search_roots=None, remove_missing=False, clip=False,
+                   move_orphans=False, num_threads=8):
+    """
+    Check a project, repair the problems found and save its parameters.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    search_roots : list of str or Path, optional
+        folders where missing files are searched, see relink_files
+    remove_missing : bool
+        remove files that are still missing after relinking
+    clip : bool
+        clip rois to the shape of their file, see clip_rois
+    move_orphans : bool
+        move orphaned annotations, see move_orphaned_annotations
+    num_threads : int
+        number of threads reading headers
+
+    Returns
+    -------
+    actions : dict
+        relinked files, removed files, number of clipped rois and moved
+        annotations
+    issues : list of dict
+        issues remaining after the repair, see check_project
+
+    """
+
+    project_path = Path(project_path)
+    params = pr.load_project(project_path)
+    issues = check_project(project_path, params, num_threads=num_threads)
+    actions = {'relinked': {}, 'removed': [], 'clipped': 0, 'moved': []}
+
+    missing = [i['file_path'] for i in issues if i['kind'] == 'missing_source']
+    if search_roots and missing:
+        actions['relinked'] = relink_files(params, search_roots, missing)
+    if remove_missing:
+        actions['removed'] = [f for f in missing if f not in actions['relinked']]
+        remove_files(params, actions['removed'])
+    if actions['relinked'] or actions['removed']:
+        # relinked files can have other problems
+        issues = check_project(project_path, params, num_threads=num_threads)
+    if clip:
+        actions['clipped'] = clip_rois(params, issues)
+    if move_orphans:
+        actions['moved'] = move_orphaned_annotations(project_path, issues)
+
+    if actions['relinked'] or actions['removed'] or actions['clipped']:
+        params.save_parameters()
+    if any(actions.values()):
+        issues = check_project(project_path, params, num_threads=num_threads)
+    return actions, issues
+
+
+def main(argv=None):
+    """Command line entry point of the check and repair of a project."""
+
+    parser = argparse.ArgumentParser(
+        description='Check that a napari-annotation-project is consistent with the files on disk.')
+    parser.add_argument('project_path', help='folder containing the project')
+    parser.add_argument('--relink', nargs='+', default=None, metavar='SEARCH_ROOT',
+                        help='search missing files by name in these folders')
+    parser.add_argument('--remove-missing', action='store_true',
+                        help='remove files still missing from the project')
+    parser.add_argument('--clip-rois', action='store_true',
+                        help='clip rois to the shape of their file')
+    parser.add_argument('--move-orphans', action='store_true',
+                        help=f'move orphaned annotations to annotations/{ORPHAN_FOLDER}')
+    parser.add_argument('-j', '--num-threads', type=int, default=8,
+                        help='number of threads reading headers')
+    args = parser.parse_args(argv)
+
+    if args.relink or args.remove_missing or args.clip_rois or args.move_orphans:
+        actions, issues = repair_project(
+            args.project_path, search_roots=args.relink, remove_missing=args.remove_missing,
+            clip=args.clip_rois, move_orphans=args.move_orphans, num_threads=args.num_threads)
+        for old_path, new_path in actions['relinked'].items():
+            print(f"Relinked {old_path} to {new_path}")
+        for file_path in actions['removed']:
+            print(f"Removed {file_path}")
+        if actions['clipped']:
+            print(f"Clipped {actions['clipped']} rois")
+        for path in actions['moved']:
+            print(f"Moved {path.name} to {path.parent}")
+    else:
+        issues = check_project(args.project_path, num_threads=args.num_threads)
+
+    for issue in issues:
+        print(f"{issue['kind']}: {issue['message']}")
+    print(f"{len(issues)} problems found in {args.project_path}")
+    return 1 if issues else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,302 @@
+"""
+Copy of project files to the local project folder. Files are identified
+by a hash of their content so that identical files are only stored once,
+and copies get collision-free names.
+"""
+import hashlib
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import yaml
+
+INDEX_NAME = '.copy_index.yml'
+CHUNK_SIZE = 2**22
+
+
+class CopyCancelled(Exception):
+    """Raised when a copy is cancelled."""
+
+
+def file_digest(path, cancel_event=None):
+    """
+    Compute the content hash of a file.
+
+    Parameters
+    ----------
+    path : str or Path
+        file to hash
+    cancel_event : threading.Event, optional
+        if set during hashing, CopyCancelled is raised
+
+    Returns
+    -------
+    digest : str
+        hexadecimal blake2b digest
+    """
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            if cancel_event is not None and cancel_event.is_set():
+                raise CopyCancelled()
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CopyIndex:
+    """
+    Index of the files of a local folder by content hash. The index is
+    stored in the folder itself.
+
+    Parameters
+    ----------
+    folder : str or Path
+        folder containing the copied files
+
+    """
+
+    def __init__(self, folder):
+
+        self.folder = Path(folder)
+        self._lock = threading.Lock()
+        self._names = {}
+        index_path = self.folder.joinpath(INDEX_NAME)
+        if index_path.exists():
+            with open(index_path) as f:
+                self._names = yaml.safe_load(f) or {}
+        self._digests = {v: k for k, v in self._names.items()}
+        # names reserved by copies in progress and events set when the
+        # copy of a content completes
+        self._reserved = {}
+        self._in_progress = {}
+
+    def reserve(self, name, digest):
+        """
+        Get the name under which a file should be stored in the folder.
+
+        Parameters
+        ----------
+        name : str
+            original file name
+        digest : str
+            content hash of the file
+
+        Returns
+        -------
+        name : str
+            name of the file in the folder
+        exists : bool
+            True if a file with the same content is already stored
+        """
+
+        while True:
+            with self._lock:
+                copy_done = self._in_progress.get(digest)
+                if copy_done is None:
+                    return self._reserve(name, digest)
+            # a copy of the same content is running, wait for its outcome
+            copy_done.wait()
+
+    def _reserve(self, name, digest):
+
+        if digest in self._digests:
+            existing = self._digests[digest]
+            if self.folder.joinpath(existing).exists():
+                return existing, True
+
+        stem, suffix = Path(name).stem, Path(name).suffix
+        candidate = name
+        counter = 0
+        while True:
+            if candidate not in self._reserved:
+                target = self.folder.joinpath(candidate)
+                if not target.exists():
+                    break
+                # files copied before the index existed are hashed on demand
+                if candidate not in self._names:
+                    self._names[candidate] = file_digest(target)
+                    self._digests[self._names[candidate]] = candidate
+                if self._names[candidate] == digest:
+                    return candidate, True
+            counter += 1
+            candidate = f'{stem}_{counter}{suffix}'
+        self._reserved[candidate] = digest
+        self._in_progress[digest] = threading.Event()
+        return candidate, False
+
+    def register(self, name, digest):
+        """Record a completed copy."""
+
+        with self._lock:
+            self._reserved.pop(name, None)
+            self._names[name] = digest
+            self._digests[digest] = name
+            self._in_progress.pop(digest).set()
+
+    def release(self, name):
+        """Release a name reserved by a failed or cancelled copy."""
+
+        with self._lock:
+            digest = self._reserved.pop(name, None)
+            if digest is not None:
+                self._in_progress.pop(digest).set()
+
+    def save(self):
+        """Save the index in the folder."""
+
+        with self._lock:
+            names = {k: v for k, v in self._names.items() if self.folder.joinpath(k).exists()}
+        temp_path = self.folder.joinpath(INDEX_NAME + '.tmp')
+        with open(temp_path, 'w') as f:
+            yaml.safe_dump(names, f)
+        os.replace(temp_path, self.folder.joinpath(INDEX_NAME))
+
+
+def _reflink(source, target):
+    """Create a copy-on-write clone of source. Only supported on Linux
+    filesystems like btrfs or xfs. Returns True on success."""
+
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    FICLONE = 0x40049409
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if Path(target).exists():
+            Path(target).unlink()
+        return False
+
+
+def transfer_file(source, target, cancel_event=None):
+    """
+    Store source at target. A reflink is used if the filesystem supports
+    it, then a hard link if both files are on the same filesystem and
+    a regular copy otherwise.
+
+    Parameters
+    ----------
+    source : str or Path
+        file to copy
+    target : str or Path
+        location of the copy
+    cancel_event : threading.Event, optional
+        if set during the copy, CopyCancelled is raised and no file is left
+    """
+
+    source, target = Path(source), Path(target)
+    temp_target = target.with_name(target.name + '.part')
+    if _reflink(source, temp_target):
+        os.replace(temp_target, target)
+        return
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+
+    try:
+        with open(source, 'rb') as src, open(temp_target, 'wb') as dst:
+            while chunk := src.read(CHUNK_SIZE):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise CopyCancelled()
+                dst.write(chunk)
+        shutil.copystat(source, temp_target)
+        os.replace(temp_target, target)
+    finally:
+        if temp_target.exists():
+            temp_target.unlink()
+
+
+def copy_to_folder(source, folder, index, cancel_event=None):
+    """
+    Copy a file to a folder unless a file with identical content is
+    already stored there.
+
+    Parameters
+    ----------
+    source : str or Path
+        file to copy
+    folder : Path
+        destination folder
+    index : CopyIndex
+        index of the destination folder
+    cancel_event : threading.Event, optional
+        event used to cancel the copy
+
+    Returns
+    -------
+    name : str
+        name of the file in the folder
+    """
+
+    digest = file_digest(source, cancel_event)
+    name, exists = index.reserve(Path(source).name, digest)
+    if exists:
+        return name
+    try:
+        transfer_file(source, Path(folder).joinpath(name), cancel_event)
+    except BaseException:
+        index.release(name)
+        raise
+    index.register(name, digest)
+    return name
+
+
+def copy_files(files, folder, index=None, max_workers=4, cancel_event=None):
+    """
+    Copy files to a folder in parallel. This is a generator yielding
+    results as copies complete.
+
+    Parameters
+    ----------
+    files : list of str or Path
+        files to copy
+    folder : str or Path
+        destination folder
+    index : CopyIndex, optional
+        index of the destination folder, created if None
+    max_workers : int
+        number of parallel copies
+    cancel_event : threading.Event, optional
+        event used to cancel the copies. Copies in progress are interrupted
+        and pending copies are skipped.
+
+    Yields
+    ------
+    source : str
+        copied file as given in files
+    name : str or None
+        name of the file in the folder, None if the copy failed
+    error : Exception or None
+        error raised by the copy
+    """
+
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    if index is None:
+        index = CopyIndex(folder)
+    if cancel_event is None:
+        cancel_event = threading.Event()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(copy_to_folder, f, folder, index, cancel_event): f for f in files}
+        for future in as_completed(futures):
+            if cancel_event.is_set():
+                break
+            try:
+                yield futures[future], future.result(), None
+            except CopyCancelled:
+                break
+            except Exception as e:
+                yield futures[future], None, e
+    finally:
+        cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        index.save()
@@ -0,0 +1,244 @@
+"""
+Cache of the metadata of the images of a project (shape, dtype, axes,
+channels), read from file headers only, so that dimensions can be checked
+and layers sized without loading pixels.
+"""
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+import tifffile
+
+from . import project as pr
+from .image_io import read_image, IMAGE_SUFFIXES
+
+
+METADATA_NAME = 'metadata.sqlite'
+
+_METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    file_path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    shape TEXT NOT NULL,
+    dtype TEXT NOT NULL,
+    axes TEXT NOT NULL,
+    channels INTEGER NOT NULL,
+    rgb INTEGER NOT NULL
+);
+"""
+_METADATA_FIELDS = ['file_path', 'size', 'mtime', 'shape', 'dtype', 'axes', 'channels', 'rgb']
+
+# pillow modes whose header gives the array returned by read_image
+_PIL_MODES = {
+    'L': ('uint8', 1), 'LA': ('uint8', 2), 'RGB': ('uint8', 3), 'RGBA': ('uint8', 4),
+    'I;16': ('uint16', 1), 'I': ('int32', 1), 'F': ('float32', 1)}
+
+
+def read_metadata(path):
+    """
+    Read the metadata of an image from its header. Only formats read by the
+    plugin itself (see image_io.IMAGE_SUFFIXES) are supported.
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the image file
+
+    Returns
+    -------
+    metadata : dict or None
+        shape, dtype and axes of the image as returned by read_image, number
+        of channels, whether the image is RGB(A) and size and modification
+        time of the file. None for unsupported formats.
+    """
+
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix not in IMAGE_SUFFIXES:
+        return None
+    stat = os.stat(path)
+
+    mode = None
+    if suffix in ['.tif', '.tiff']:
+        with tifffile.TiffFile(path) as tif:
+            series = tif.series[0]
+            shape, dtype, axes = tuple(series.shape), series.dtype.name, series.axes
+    else:
+        try:
+            from PIL import Image
+            with Image.open(path) as image:
+                mode, size = image.mode, image.size
+        except ImportError:
+            pass
+        if mode in _PIL_MODES:
+            dtype, bands = _PIL_MODES[mode]
+            shape = (size[1], size[0]) + ((bands,) if bands > 1 else ())
+        else:
+            # palette and other modes are converted when read
+            image = read_image(path)
+            shape, dtype = image.shape, image.dtype.name
+        axes = 'YXS' if len(shape) == 3 else 'YX'
+
+    if axes.endswith('S'):
+        channels = shape[-1]
+    elif 'C' in axes:
+        channels = shape[axes.index('C')]
+    else:
+        channels = 1
+    return {
+        'shape': shape, 'dtype': dtype, 'axes': axes, 'channels': channels,
+        'rgb': axes.endswith('S') and shape[-1] in [3, 4],
+        'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+class MetadataCache:
+    """
+    Metadata of the images of a project, stored in the cache folder of the
+    project. Entries are read from file headers in parallel and are read
+    again when the size or modification time of a file changes.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    num_threads : int
+        number of threads reading headers
+
+    """
+
+    def __init__(self, project_path, num_threads=8):
+
+        self.project_path = Path(project_path).absolute()
+        self.db_path = pr.get_cache_folder(self.project_path).joinpath(METADATA_NAME)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._background = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            with self._connect() as conn, conn:
+                conn.executescript(_METADATA_SCHEMA)
+                rows = conn.execute(f"SELECT {', '.join(_METADATA_FIELDS)} FROM metadata").fetchall()
+        except (OSError, sqlite3.Error):
+            # read-only project, the cache is only kept in memory
+            self.db_path = None
+            rows = []
+        for row in rows:
+            entry = dict(zip(_METADATA_FIELDS, row))
+            entry['shape'] = tuple(json.loads(entry['shape']))
+            entry['rgb'] = bool(entry['rgb'])
+            self._entries[entry.pop('file_path')] = entry
+
+    def _connect(self):
+
+        return closing(sqlite3.connect(self.db_path))
+
+    def _stat(self, file_path):
+        """Get size and modification time of a file, None if it does not exist."""
+
+        try:
+            stat = os.stat(pr.resolve_file_path(self.project_path, file_path))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _is_valid(self, file_path):
+
+        entry = self._entries.get(file_path)
+        return (entry is not None) and (self._stat(file_path) == (entry['size'], entry['mtime']))
+
+    def _read(self, file_path):
+
+        try:
+            return read_metadata(pr.resolve_file_path(self.project_path, file_path))
+        except (OSError, ValueError, tifffile.TiffFileError):
+            return None
+
+    def get(self, file_path):
+        """
+        Get the metadata of a project file, reading its header if it is not
+        cached or if the file changed.
+
+        Parameters
+        ----------
+        file_path : str
+            path of the file as stored in the parameters
+
+        Returns
+        -------
+        metadata : dict or None
+            see read_metadata. None if the file is missing, unreadable or of
+            a format opened by napari readers.
+        """
+
+        with self._lock:
+            if self._is_valid(file_path):
+                return self._entries[file_path]
+        return self.update([file_path]).get(file_path)
+
+    def update(self, file_paths):
+        """
+        Read the headers of files that are not cached or changed, in parallel.
+
+        Returns
+        -------
+        metadata : dict
+            metadata of the files keyed by file path, files without metadata
+            are omitted
+        """
+
+        with self._lock:
+            stale = [f for f in dict.fromkeys(file_paths) if not self._is_valid(f)]
+        read = dict(zip(stale, self._executor.map(self._read, stale)))
+        with self._lock:
+            for file_path, entry in read.items():
+                if entry is None:
+                    self._entries.pop(file_path, None)
+                else:
+                    self._entries[file_path] = entry
+            self._store(read)
+            return {f: self._entries[f] for f in file_paths if f in self._entries}
+
+    def update_async(self, file_paths):
+        """Update entries in the background. Returns a Future."""
+
+        return self._background.submit(self.update, list(file_paths))
+
+    def invalidate(self, file_path):
+        """Remove the entry of a file, its header is read on next access."""
+
+        with self._lock:
+            self._entries.pop(file_path, None)
+            self._store({file_path: None})
+
+    def _store(self, entries):
+        """Write entries, removing those set to None."""
+
+        if self.db_path is None or len(entries) == 0:
+            return
+        rows = [
+            [f, e['size'], e['mtime'], json.dumps([int(x) for x in e['shape']]), e['dtype'],
+             e['axes'], int(e['channels']), int(e['rgb'])]
+            for f, e in entries.items() if e is not None]
+        with self._connect() as conn, conn:
+            conn.executemany("DELETE FROM metadata WHERE file_path=?", [(f,) for f in entries])
+            conn.executemany(
+                f"INSERT INTO metadata ({', '.join(_METADATA_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(_METADATA_FIELDS))})", rows)
+
+    def close(self):
+        """Wait for background updates and stop the threads."""
+
+        self._background.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
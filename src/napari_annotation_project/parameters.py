@@ -1,9 +1,18 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
 import dataclasses
+import atexit
+import copy
+import os
+import threading
+import time
+import warnings
 from pathlib import Path
 import yaml
 
+from .rois import as_roi_array, rois_to_list
+from .instrumentation import timed
+
 @dataclass
 class Param:
     """
@@ -18,11 +27,23 @@ class Param:
     channels: dict of str
         channel getting exported as source for each file
     rois: dict of arrays
-        flat list of rois for each file
+        (N, 4, ndim) array of rois for each file
     local_project: bool
         if True, images are saved in local folder
     rgb: bool
         if True, images are assumed to be RGB XYC
+    annotation_compression: str
+        compression of annotation files e.g. 'zlib' or 'zstd'. If None,
+        annotations are saved uncompressed
+    annotation_tile_size: int
+        tile size of compressed annotation files
+    out_of_core: bool
+        if True, uncompressed tif images and annotation files are
+        memory-mapped instead of being loaded in memory. Annotations are
+        then stored uncompressed
+    use_pyramids: bool
+        if True, large images are opened as multiscale layers from
+        pyramids built in the cache folder of the project
     
     """
     project_path: str = None
@@ -31,7 +52,53 @@ class Param:
     rois: dict = field(default_factory=dict)
     local_project: bool = False
     rgb: bool = False
+    annotation_compression: str = None
+    annotation_tile_size: int = 256
+    out_of_core: bool = False
+    use_pyramids: bool = False
+
+    def __post_init__(self):
+
+        self.rois = {k: as_roi_array(v) for k, v in self.rois.items()}
+
+    def set_rois(self, file_path, rois):
+        """Set the rois of a file.
+
+        Parameters
+        ----------
+        file_path : str
+            file of the project
+        rois : array or list
+            (N, 4, ndim) array of rois or list of flat rois
+        """
+
+        self.rois[file_path] = as_roi_array(rois)
+
+    def set_channel(self, file_path, channel):
+        """Set the channel exported as source for a file.
+
+        Parameters
+        ----------
+        file_path : str
+            file of the project
+        channel : str
+            name of the channel
+        """
+
+        self.channels[file_path] = channel
+
+    def copy(self):
+        """Copy the parameters so that the copy can be saved while the
+        original is modified. Roi arrays are shared as they are replaced
+        and never modified in place."""
+
+        param = copy.copy(self)
+        param.file_paths = list(self.file_paths) if self.file_paths is not None else None
+        param.channels = dict(self.channels)
+        param.rois = dict(self.rois)
+        return param
 
+    @timed('save_parameters')
     def save_parameters(self, alternate_path=None):
         """Save parameters as yml file.
 
@@ -46,12 +113,161 @@ class Param:
         else:
             save_path = Path(self.project_path).joinpath("Parameters.yml")
     
-        with open(save_path, "w") as file:
-            dict_to_save = dataclasses.asdict(self)
-            if dict_to_save['project_path'] is not None:
-                if not isinstance(dict_to_save['project_path'], str):
-                    dict_to_save['project_path'] = dict_to_save['project_path'].as_posix()
-            if dict_to_save['file_paths'] is not None:
-                if not isinstance(dict_to_save['file_paths'][0], str):
-                    dict_to_save['file_paths'] = [x.as_posix() for x in dict_to_save['file_paths']]
-            yaml.dump(dict_to_save, file)
+        # fields are taken as they are, dataclasses.asdict would deep-copy
+        # the roi arrays that are converted to lists below anyway
+        dict_to_save = {f.name: getattr(self, f.name) for f in dataclasses.fields(self)}
+        if dict_to_save['project_path'] is not None:
+            if not isinstance(dict_to_save['project_path'], str):
+                dict_to_save['project_path'] = dict_to_save['project_path'].as_posix()
+        if dict_to_save['file_paths'] is not None:
+            dict_to_save['file_paths'] = [x if isinstance(x, str) else x.as_posix() for x in dict_to_save['file_paths']]
+        # each roi is written on a single line
+        dict_to_save['rois'] = {k: [_FlowList(r) for r in rois_to_list(v)] for k, v in self.rois.items()}
+
+        # write to a temporary file and replace the old one so that an
+        # interrupted save never leaves a truncated parameters file
+        temp_path = save_path.with_name(save_path.name + '.tmp')
+        with open(temp_path, "w") as file:
+            yaml.dump(dict_to_save, file, Dumper=_ParamDumper)
+        os.replace(temp_path, save_path)
+
+
+class _FlowList(list):
+    pass
+
+
+class _ParamDumper(yaml.Dumper):
+    pass
+
+
+_ParamDumper.add_representer(
+    _FlowList, lambda dumper, data: dumper.represent_sequence('tag:yaml.org,2002:seq', data, flow_style=True))
+
+
+class ParamSaver:
+    """
+    Write-behind saving of Param objects. Save requests only mark the
+    parameters as dirty and a background thread writes them once no new
+    request arrived during a quiet period, so that many successive
+    changes (e.g. while dragging a roi) result in a single write.
+    Parameters are copied once by the writer, under the lock taken by
+    requests, so a request never copies the parameters and a change made
+    during the copy is followed by a request saving it again. Parameters
+    whose write failed stay pending and are written again after the
+    quiet period.
+
+    Parameters
+    ----------
+    delay: float
+        quiet period in seconds after the last request before saving
+    
+    """
+
+    def __init__(self, delay=1.0):
+
+        self.delay = delay
+        self._param = None
+        self._deadline = None
+        self._closed = False
+        self._thread = None
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def request_save(self, param):
+        """Mark param as modified and schedule saving it.
+
+        Parameters
+        ----------
+        param: Param
+            parameters to save
+        """
+
+        previous = None
+        with self._condition:
+            if self._param is not None and self._param is not param:
+                previous = self._param
+            self._param = param
+            self._deadline = time.monotonic() + self.delay
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        # parameters of a different project are written immediately
+        if previous is not None:
+            self._write(previous, previous)
+
+    def flush(self):
+        """Write pending parameters immediately."""
+
+        with self._condition:
+            param, snapshot = self._take()
+        # also wait for a write in progress in the background thread
+        if param is not None:
+            self._write(param, snapshot)
+        else:
+            with self._write_lock:
+                pass
+
+    def close(self):
+        """Flush pending parameters and stop the background thread."""
+
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify()
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+            atexit.unregister(self.flush)
+
+    @property
+    def pending(self):
+        """True if some parameters have not been saved yet."""
+
+        return self._param is not None
+
+    def _take(self):
+        """Clear the pending parameters and return them with the copy to
+        write. Called with the condition held."""
+
+        param = self._param
+        self._param = None
+        return param, None if param is None else param.copy()
+
+    def _run(self):
+
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if self._param is None:
+                        self._condition.wait()
+                        continue
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed:
+                    return
+                param, snapshot = self._take()
+            try:
+                self._write(param, snapshot)
+            except Exception as e:
+                warnings.warn(f"Parameters could not be saved: {e}")
+
+    def _write(self, param, snapshot):
+        """Save the snapshot of param. If the write fails, param is pending
+        again unless other parameters were requested in the meantime."""
+
+        try:
+            with self._write_lock:
+                snapshot.save_parameters()
+        except Exception:
+            with self._condition:
+                if self._param is None:
+                    self._param = param
+                    self._deadline = time.monotonic() + self.delay
+                    self._condition.notify()
+            raise
@@ -1,8 +1,38 @@
 from pathlib import Path
 from .parameters import Param
+from .rois import as_roi_array
+from .instrumentation import timed
+from . import sqlite_store
 import yaml
 
-def create_project(project_path, file_paths=None, channels=None, rois=None):
+BACKENDS = ['yaml', 'sqlite']
+
+
+def get_project_backend(project_path):
+    """
+    Find how the parameters of a project are stored.
+
+    Parameters
+    ----------
+    project_path : str
+        path where the project is saved
+
+    Returns
+    -------
+    backend : str or None
+        'sqlite' or 'yaml', None if no project exists at that location
+
+    """
+
+    project_path = Path(project_path)
+    if project_path.joinpath(sqlite_store.DB_NAME).exists():
+        return 'sqlite'
+    if project_path.joinpath('Parameters.yml').exists():
+        return 'yaml'
+    return None
+
+
+def create_project(project_path, file_paths=None, channels=None, rois=None, backend=None):
     """
     Create a project.
 
@@ -15,7 +45,11 @@ def create_project(project_path, file_paths=None, channels=None, rois=None):
     channels : dict of str
         channel getting exported as source for each file
     rois : dict of arrays
-        flat list of rois for each file
+        (N, 4, ndim) array or list of flat rois for each file
+    backend : str, optional
+        'yaml' to store parameters in Parameters.yml or 'sqlite' to store
+        them in an SQLite database. By default, the backend of an existing
+        project at that location is kept, and 'yaml' is used otherwise.
 
     Returns
     -------
@@ -28,11 +62,17 @@ def create_project(project_path, file_paths=None, channels=None, rois=None):
     if not project_path.exists():
         project_path.mkdir()
 
+    if backend is None:
+        backend = get_project_backend(project_path) or 'yaml'
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}. Use one of {BACKENDS}")
+
     if rois is None:
         rois = {}
     if channels is None:
         channels = {}
-    project = Param(
+    param_class = sqlite_store.SQLiteParam if backend == 'sqlite' else Param
+    project = param_class(
         project_path=project_path,
         file_paths=file_paths,
         channels=channels,
@@ -44,6 +84,8 @@ def create_project(project_path, file_paths=None, channels=None, rois=None):
 
     return project
 
+
+@timed('load_project')
 def load_project(project_path):
     """
     Load a project.
@@ -60,15 +102,139 @@ def load_project(project_path):
 
     """
 
-    project = Param()
     project_path = Path(project_path)
-    if not project_path.joinpath('Parameters.yml').exists():
+    backend = get_project_backend(project_path)
+    if backend is None:
         raise FileNotFoundError(f"Project {project_path} does not exist")
+    if backend == 'sqlite':
+        return sqlite_store.load_sqlite_project(project_path)
+
+    project = Param()
 
     with open(project_path.joinpath('Parameters.yml')) as file:
         documents = yaml.full_load(file)
     for k in documents.keys():
         setattr(project, k, documents[k])
+    project.rois = {k: as_roi_array(v) for k, v in project.rois.items()}
     project.project_path = project_path
 
-    return project
\ No newline at end of file
+    return project
+
+
+def migrate_project(project_path, backend):
+    """
+    Convert the parameters of a project to a different storage backend.
+    The previous parameters file is kept with a .bak extension.
+
+    Parameters
+    ----------
+    project_path : str
+        path where the project is saved
+    backend : str
+        'yaml' or 'sqlite'
+
+    Returns
+    -------
+    project : Project
+        project object using the new backend
+
+    """
+
+    project_path = Path(project_path)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}. Use one of {BACKENDS}")
+    current_backend = get_project_backend(project_path)
+    old_project = load_project(project_path)
+    if current_backend == backend:
+        return old_project
+
+    param_class = sqlite_store.SQLiteParam if backend == 'sqlite' else Param
+    project = param_class(**{
+        k: getattr(old_project, k) for k in old_project.__dataclass_fields__})
+    project.save_parameters()
+
+    if current_backend == 'sqlite':
+        old_file = project_path.joinpath(sqlite_store.DB_NAME)
+    else:
+        old_file = project_path.joinpath('Parameters.yml')
+    old_file.replace(old_file.with_name(old_file.name + '.bak'))
+    if current_backend == 'sqlite':
+        # remove leftovers of the sqlite write-ahead log
+        for suffix in ['-wal', '-shm']:
+            extra = project_path.joinpath(sqlite_store.DB_NAME + suffix)
+            if extra.exists():
+                extra.unlink()
+
+    return project
+
+
+def get_annotation_path(project_path, file_path, extension='_annot.tif'):
+    """
+    Get the path of the annotation file of a project file.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    file_path : str or Path
+        path of the project file
+    extension : str
+        suffix of the annotation file name
+
+    Returns
+    -------
+    annotation_path : Path
+        path of the annotation file
+
+    """
+
+    return Path(project_path).joinpath('annotations', Path(file_path).stem + extension)
+
+
+def get_cache_folder(project_path):
+    """
+    Get the folder of a project where caches derived from the project files
+    (e.g. image metadata) are stored. Its content can be deleted at any time.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+
+    Returns
+    -------
+    cache_folder : Path
+        path of the cache folder
+
+    """
+
+    return Path(project_path).joinpath('cache')
+
+
+def resolve_file_path(project_path, file_path):
+    """
+    Find the location of a project file. Relative paths (e.g. of files
+    copied to the project folder) are resolved with respect to the project
+    folder first and to the current directory otherwise.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    file_path : str or Path
+        path of the project file as stored in the parameters
+
+    Returns
+    -------
+    file_path : Path
+        resolved path of the file
+
+    """
+
+    file_path = Path(file_path)
+    if file_path.is_absolute():
+        return file_path
+    in_project = Path(project_path).joinpath(file_path)
+    if in_project.exists():
+        return in_project
+    return file_path
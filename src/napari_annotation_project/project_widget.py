@@ -1,17 +1,25 @@
-import csv
 import os
-import shutil
+import threading
+import time
 from pathlib import Path
 import numpy as np
-from skimage.io import imread
-import tifffile
 
 from qtpy.QtWidgets import (QWidget, QHBoxLayout, QVBoxLayout,
 QGroupBox, QGridLayout, QListWidget, QPushButton, QFileDialog,
-QTabWidget, QLabel, QLineEdit, QScrollArea, QCheckBox, QSpinBox)
-from qtpy.QtCore import Qt
-from .folder_list_widget import FolderList
+QTabWidget, QLabel, QLineEdit, QScrollArea, QCheckBox, QSpinBox, QApplication,
+QProgressBar, QComboBox, QTableWidget, QTableWidgetItem)
+from qtpy.QtCore import Qt, QTimer
+from napari.qt.threading import thread_worker
+from napari.utils.notifications import show_error, show_warning
+from .folder_list_widget import FolderList, find_files, array_to_icon
 from . import project as pr
+from .parameters import ParamSaver
+from .image_cache import ImageCache
+from .image_io import (memmap_image, memmap_annotations, create_annotations_memmap,
+                       AnnotationWriter, read_annotations)
+from .rois import as_roi_array
+from . import instrumentation
+from .instrumentation import timed
 
 
 class ProjectWidget(QWidget):
@@ -53,14 +61,33 @@ class ProjectWidget(QWidget):
         self._project_layout.addWidget(self.files_vgroup.gbox)
         self.file_list = FolderList(napari_viewer)
         self.files_vgroup.glayout.addWidget(self.file_list, 0, 0, 1, 2)
+        self.file_filter = QLineEdit()
+        self.file_filter.setPlaceholderText('Filter by name')
+        self.files_vgroup.glayout.addWidget(self.file_filter, 1, 0, 1, 1)
+        self.file_status_filter = QComboBox()
+        self.file_status_filter.addItems(['All files', 'Annotated', 'Has ROIs', 'Missing file'])
+        self.files_vgroup.glayout.addWidget(self.file_status_filter, 1, 1, 1, 1)
         self.btn_add_file = QPushButton('Add file')
-        self.files_vgroup.glayout.addWidget(self.btn_add_file, 1, 0, 1, 2)
+        self.files_vgroup.glayout.addWidget(self.btn_add_file, 2, 0, 1, 2)
         self.btn_remove_file = QPushButton('Remove selected file')
-        self.files_vgroup.glayout.addWidget(self.btn_remove_file, 2, 0, 1, 2)
+        self.files_vgroup.glayout.addWidget(self.btn_remove_file, 3, 0, 1, 2)
         self.check_copy_files = QCheckBox('Copy files to project folder')
-        self.files_vgroup.glayout.addWidget(self.check_copy_files, 3, 0, 1, 2)
+        self.files_vgroup.glayout.addWidget(self.check_copy_files, 4, 0, 1, 2)
         self.images_are_rgb = QCheckBox('Images are RGB')
-        self.files_vgroup.glayout.addWidget(self.images_are_rgb, 4, 0, 1, 2)
+        self.files_vgroup.glayout.addWidget(self.images_are_rgb, 5, 0, 1, 2)
+        self.check_compress_annotations = QCheckBox('Compress annotations')
+        self.files_vgroup.glayout.addWidget(self.check_compress_annotations, 6, 0, 1, 2)
+        self.check_out_of_core = QCheckBox('Keep data on disk (memory-mapped)')
+        self.files_vgroup.glayout.addWidget(self.check_out_of_core, 7, 0, 1, 2)
+        self.copy_progress = QProgressBar(visible=False)
+        self.copy_progress.setMaximum(0)
+        self.files_vgroup.glayout.addWidget(self.copy_progress, 8, 0, 1, 1)
+        self.btn_cancel_copy = QPushButton('Cancel copy', visible=False)
+        self.files_vgroup.glayout.addWidget(self.btn_cancel_copy, 8, 1, 1, 1)
+        self.check_show_thumbnails = QCheckBox('Show thumbnails')
+        self.files_vgroup.glayout.addWidget(self.check_show_thumbnails, 9, 0, 1, 2)
+        self.check_use_pyramids = QCheckBox('Open large images as pyramids')
+        self.files_vgroup.glayout.addWidget(self.check_use_pyramids, 10, 0, 1, 2)
         
         # Keep track of the channel selection for annotations
         self.channel_group = VHGroup('Layer to annotate', orientation='V')
@@ -77,6 +104,34 @@ class ProjectWidget(QWidget):
         self._project_layout.addWidget(self.roi_size)
         self.btn_add_roi = QPushButton('Add ROI', visible=False)
         self._project_layout.addWidget(self.btn_add_roi)
+
+        # Create many rois at once by tiling or sampling images
+        self.tiling_group = VHGroup('Automatic ROIs', orientation='G')
+        self._project_layout.addWidget(self.tiling_group.gbox)
+        self.tiling_mode = QComboBox()
+        self.tiling_mode.addItems(['Grid', 'Random', 'Labelled regions'])
+        self.tiling_group.glayout.addWidget(self.tiling_mode, 0, 0, 1, 2)
+        self.tiling_group.glayout.addWidget(QLabel('ROI size'), 1, 0)
+        self.tile_size = QSpinBox()
+        self.tile_size.setMaximum(10000)
+        self.tile_size.setValue(128)
+        self.tiling_group.glayout.addWidget(self.tile_size, 1, 1)
+        self.tiling_group.glayout.addWidget(QLabel('Grid stride'), 2, 0)
+        self.tile_stride = QSpinBox()
+        self.tile_stride.setRange(1, 10000)
+        self.tile_stride.setValue(128)
+        self.tiling_group.glayout.addWidget(self.tile_stride, 2, 1)
+        self.tiling_group.glayout.addWidget(QLabel('Number of samples'), 3, 0)
+        self.tile_number = QSpinBox()
+        self.tile_number.setRange(1, 100000)
+        self.tile_number.setValue(100)
+        self.tiling_group.glayout.addWidget(self.tile_number, 3, 1)
+        self.check_tile_all_files = QCheckBox('All files and planes')
+        self.tiling_group.glayout.addWidget(self.check_tile_all_files, 4, 0, 1, 2)
+        self.check_tile_no_overlap = QCheckBox('Skip ROIs overlapping existing ROIs')
+        self.tiling_group.glayout.addWidget(self.check_tile_no_overlap, 5, 0, 1, 2)
+        self.btn_add_tiles = QPushButton('Add ROIs')
+        self.tiling_group.glayout.addWidget(self.btn_add_tiles, 6, 0, 1, 2)
         
         # Select a folder where to save the project
         self.btn_project_folder = QPushButton("Create project")
@@ -133,31 +188,115 @@ class ProjectWidget(QWidget):
 
         self.btn_export_data = QPushButton("Export annotations")
         self._export_layout.addWidget(self.btn_export_data)
+        self.export_progress = QProgressBar(visible=False)
+        self._export_layout.addWidget(self.export_progress)
+        self.export_info = QLabel('', visible=False)
+        self._export_layout.addWidget(self.export_info)
+        self.btn_cancel_export = QPushButton('Cancel export', visible=False)
+        self._export_layout.addWidget(self.btn_cancel_export)
+
+        # performance tab showing timings of instrumented operations
+        self.performance = QWidget()
+        self._performance_layout = QVBoxLayout()
+        self.performance.setLayout(self._performance_layout)
+        self.tabs.addTab(self.performance, 'Performance')
+        self.check_record_timings = QCheckBox('Record timings')
+        self.check_record_timings.setChecked(instrumentation.is_enabled())
+        self._performance_layout.addWidget(self.check_record_timings)
+        self.timings_table = QTableWidget(0, 7)
+        self.timings_table.setHorizontalHeaderLabels(
+            ['Operation', 'Calls', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'Max (ms)', 'MB/s'])
+        self._performance_layout.addWidget(self.timings_table)
+        self.btn_clear_timings = QPushButton('Clear timings')
+        self._performance_layout.addWidget(self.btn_clear_timings)
+        self.btn_save_timings = QPushButton('Save timings log')
+        self._performance_layout.addWidget(self.btn_save_timings)
+        self._timings_timer = QTimer(self)
+        self._timings_timer.setInterval(1000)
 
         self._add_connections()
+        if instrumentation.is_enabled():
+            self._timings_timer.start()
 
         self.export_folder = None
+        self._annotations_modified = False
+        self._annotations_out_of_core = False
         self.ndim = None
         self.annotations_ndim = None
         self.params = None
+        # header-only metadata of the project images
+        self._metadata = None
+        # files shown by the status filter of the file list, None for all
+        self._status_filter = None
+        # thumbnails shown in the file list, created in the background
+        self._thumbnails = None
+        self.thumbnail_size = 64
+        # multiscale pyramids of images whose planes are larger than
+        # pyramid_min_size, built in the background
+        self._pyramids = None
+        self.pyramid_min_size = 1024
+
+        # cache of images and annotations. prefetch_count files before and
+        # after the selected one are loaded in the background
+        self.image_cache = ImageCache(max_bytes=2**30)
+        self.prefetch_count = 2
+
+        # background copies of files to the project folder
+        self._copy_workers = []
+        self._copy_index = None
+
+        # background creation of rois in other files
+        self._tiling_worker = None
+
+        # background export
+        self._export_worker = None
+        self._export_cancel = None
+        self._export_start = None
+        self._export_nbytes = 0
+
+        # parameters are saved in the background after a quiet period
+        # and annotations are written by a background writer
+        self.param_saver = ParamSaver(delay=1.0)
+        self.annotation_writer = AnnotationWriter()
+        # prefetching threads are stopped once pending writes are done. The
+        # cache is replaced when a project is closed, so it is looked up
+        # when the widget closes
+        for flush in [self.param_saver.flush, self.annotation_writer.drain, lambda: self.image_cache.close()]:
+            self.destroyed.connect(flush)
+            if QApplication.instance() is not None:
+                QApplication.instance().aboutToQuit.connect(flush)
 
     def _add_connections(self):
         
-        self.file_list.model().rowsInserted.connect(self._on_add_file)
+        self.file_list.file_model.rowsInserted.connect(self._on_add_file)
         self.file_list.currentItemChanged.connect(self._on_select_file)
+        self.file_filter.textChanged.connect(self._on_filter_files)
+        self.file_status_filter.currentIndexChanged.connect(self._on_filter_status)
+        self.check_show_thumbnails.stateChanged.connect(self._on_show_thumbnails)
         self.btn_add_file.clicked.connect(self._on_click_add_file)
         self.btn_remove_file.clicked.connect(self._on_remove_file)
         self.check_copy_files.stateChanged.connect(self._on_check_copy_files)
+        self.btn_cancel_copy.clicked.connect(self._on_cancel_copy)
         self.images_are_rgb.stateChanged.connect(self._on_images_are_rgb)
+        self.check_compress_annotations.stateChanged.connect(self._on_compress_annotations)
+        self.check_out_of_core.stateChanged.connect(self._on_out_of_core)
+        self.check_use_pyramids.stateChanged.connect(self._on_use_pyramids)
         self.sel_channel.currentItemChanged.connect(self._update_channels_param)
         self.check_fixed_roi_size.stateChanged.connect(self._on_fixed_roi_size)
         self.btn_add_roi.clicked.connect(self._on_click_add_roi_fixed)
+        self.btn_add_tiles.clicked.connect(self._on_click_add_tiles)
         self.btn_project_folder.clicked.connect(self._on_click_select_project)
-        self.btn_save_annotation.clicked.connect(self.save_annotations)
+        self.btn_save_annotation.clicked.connect(lambda: self.save_annotations(force=True))
         self.btn_load_project.clicked.connect(self._on_click_load_project)
         self.btn_export_data.clicked.connect(self._export_data)
         self.btn_export_folder.clicked.connect(self._on_click_select_export_folder)
+        self.btn_cancel_export.clicked.connect(self._on_cancel_export)
+        self.check_record_timings.stateChanged.connect(self._on_record_timings)
+        self.btn_clear_timings.clicked.connect(self._on_clear_timings)
+        self.btn_save_timings.clicked.connect(self._on_save_timings)
+        self._timings_timer.timeout.connect(self._update_timings_table)
 
+    @timed('open_file')
     def open_file(self):
         """Open file selected in list. Returns True if file was opened."""
         
@@ -170,15 +309,33 @@ class ProjectWidget(QWidget):
         if self.file_list.currentItem() is None:
             return False
         
-        # open image and make sure dimensions match previous images
+        # open image and make sure dimensions match previous images. Images
+        # with a pyramid are opened as multiscale layers, other formats
+        # supported by the cache are read from it, others by napari readers
         image_name = self.file_list.currentItem().text()
-        self.viewer.open(Path(image_name))
+        header = self._get_metadata().get(image_name)
+        if header is not None:
+            if self.ndim is None and header['rgb'] and not self.params.rgb:
+                self.images_are_rgb.setChecked(True)
+            if self.ndim is not None and len(header['shape']) != self.ndim:
+                raise Exception(f"Image dimension changed. Only ndim={self.ndim} accepted.")
+        levels = self._get_pyramids().get(image_name) if self.params.use_pyramids else None
+        image = memmap_image(image_name) if self.params.out_of_core else None
+        if levels is not None:
+            self.viewer.add_image(levels, multiscale=True, name=Path(image_name).stem)
+        elif image is not None:
+            self.viewer.add_image(image, name=Path(image_name).stem)
+        elif self.image_cache.supports(image_name):
+            self.viewer.add_image(self.image_cache.get(image_name), name=Path(image_name).stem)
+        else:
+            self.viewer.open(Path(image_name))
+        # multiscale data has no ndim attribute
         if self.ndim is not None:
-            newdim = self.viewer.layers[0].data.ndim
+            newdim = len(self.viewer.layers[0].data.shape)
             if newdim != self.ndim:
                 raise Exception(f"Image dimension changed. Only ndim={self.ndim} accepted.")
         else:
-            self.ndim = self.viewer.layers[0].data.ndim
+            self.ndim = len(self.viewer.layers[0].data.shape)
             self.annotations_ndim = 2 if self.params.rgb else self.ndim
 
         return True
@@ -195,21 +352,53 @@ class ProjectWidget(QWidget):
 
     def _close_project(self, clear_files=True):
         
+        # copies belong to the closed project, stop updating the file list
+        for worker, cancel_event in self._copy_workers:
+            cancel_event.set()
+            worker.yielded.disconnect(self._on_file_copied)
+        self._copy_workers = []
+        self._on_copy_finished(None)
+        # rois created in the background belong to the closed project
+        if self._tiling_worker is not None:
+            self._tiling_worker.returned.disconnect(self._on_tiles_created)
+        self.param_saver.flush()
+        self._wait_annotations()
+        if self._metadata is not None:
+            self._metadata.close()
+            self._metadata = None
+        if self._thumbnails is not None:
+            self._thumbnails.close()
+            self._thumbnails = None
+        if self._pyramids is not None:
+            self._pyramids.close()
+            self._pyramids = None
+        # prefetches of the closed project are cancelled and its arrays released
+        self.image_cache.close()
+        self.image_cache = ImageCache(max_bytes=self.image_cache.max_bytes)
         self.viewer.layers.clear()
         self.sel_channel.clear()
         if clear_files:
             self.file_list.clear()
+            self.file_filter.clear()
+            self.file_status_filter.setCurrentIndex(0)
 
     def _on_remove_file(self):
         """Remove selected file and accompanying rois and annotations"""
 
         file_index = self._get_current_file()
         self.file_list.takeItem(self.file_list.currentRow())
-        self._update_params_file_list()
         self.params.channels.pop(file_index)
         self.params.rois.pop(file_index)
-        self.params.save_parameters()
+        self.param_saver.request_save(self.params)
         annotation_file = Path(self._create_annotation_filename_current(file_index))
+        # selecting another file saves the annotations of the removed file in
+        # the background, the write has to complete before the file is deleted
+        try:
+            self.annotation_writer.wait(annotation_file)
+        except Exception:
+            # the annotations are deleted anyway
+            pass
+        self.image_cache.invalidate(annotation_file)
         if annotation_file.exists():
             annotation_file.unlink()
 
@@ -219,9 +408,34 @@ class ProjectWidget(QWidget):
         if self.params is None:
             self._on_click_select_project()
 
-        file = Path(str(QFileDialog.getOpenFileName(self, "Select file to add", options=QFileDialog.DontUseNativeDialog)[0]))
-        self.file_list.addItem(file.as_posix())
-                           
+        files = QFileDialog.getOpenFileNames(self, "Select files to add", options=QFileDialog.DontUseNativeDialog)[0]
+        self.add_files(files)
+
+    def add_files(self, files):
+        """Add files to the project in a single batch.
+
+        Parameters
+        ----------
+        files : list of str or Path
+            files to add. Folders are searched recursively for files matching
+            the patterns of the file list.
+
+        Returns
+        -------
+        added : list of str
+            entries added to the file list
+        """
+
+        if self.params is None:
+            self._on_click_select_project()
+
+        all_files = []
+        for f in files:
+            if Path(f).is_dir():
+                all_files += find_files(f, self.file_list.file_patterns)
+            else:
+                all_files.append(f)
+        return self.file_list.add_files(all_files)
 
     def _on_add_file(self, parent, first, last):
         """Update params when adding or removing a file"""
@@ -229,37 +443,103 @@ class ProjectWidget(QWidget):
         if self.params is None:
             self._on_click_select_project()
         if self.check_copy_files.checkState() == 2:
-            file = Path(self.file_list.item(last).text())
-            if file.parts[0] != 'images':
-                copy_to = Path("images") / file.name
-                shutil.copy(file, copy_to)
-                self.file_list.item(last).setText(copy_to.as_posix())
-
-        self._update_params_file_list()
+            to_copy = []
+            for row in range(first, last+1):
+                file = Path(self.file_list.item(row).text())
+                if file.parts[0] != 'images':
+                    to_copy.append(file.as_posix())
+            if len(to_copy) > 0:
+                self._copy_to_project(to_copy)
+
+        # the file list stores its files in the parameters
+        self.file_list.set_params(self.params)
+        self._get_metadata().update_async([self.file_list.item(row).text() for row in range(first, last+1)])
         for f in self.params.file_paths:
             if f not in self.params.channels.keys():
                 self.params.channels[f] = None
             if f not in self.params.rois.keys():
-                self.params.rois[f] = []
-        self.params.save_parameters()
+                self.params.rois[f] = as_roi_array([])
+        self.param_saver.request_save(self.params)
 
     def _on_check_copy_files(self):
         """Update file list adding mode when checkbox is toggled"""
 
         if self.check_copy_files.checkState() == 2:
-            self.file_list.local_copy = True
             if self.params is None:
                 self._on_click_select_project()
             os.chdir(self.params.project_path)
-            self.file_list.local_folder = Path("images/")
-            if not self.file_list.local_folder.exists():
-                self.file_list.local_folder.mkdir(parents=True)
+            self.params.project_path.joinpath('images').mkdir(parents=True, exist_ok=True)
             self.params.local_project = True
         else:
-            self.file_list.local_copy = False
-            self.file_list.local_folder = None
             self.params.local_project = False
 
+    def _copy_to_project(self, files):
+        """Copy files to the images folder of the project in the background.
+        List entries are replaced by their local copy once copied."""
+
+        from .local_copy import CopyIndex
+
+        images_folder = Path(self.params.project_path).absolute().joinpath('images')
+        if (self._copy_index is None) or (self._copy_index.folder != images_folder):
+            self._copy_index = CopyIndex(images_folder)
+
+        cancel_event = threading.Event()
+        worker = _copy_files_worker(files, images_folder, self._copy_index, cancel_event)
+        worker.yielded.connect(self._on_file_copied)
+        worker.finished.connect(lambda: self._on_copy_finished(worker))
+        self._copy_workers.append((worker, cancel_event))
+
+        self.copy_progress.setMaximum(self.copy_progress.maximum() + len(files))
+        self.copy_progress.setVisible(True)
+        self.btn_cancel_copy.setVisible(True)
+        worker.start()
+
+    def _on_file_copied(self, result):
+        """Replace a file list entry by its local copy."""
+
+        source, name, error = result
+        self.copy_progress.setValue(self.copy_progress.value() + 1)
+        if error is not None:
+            show_warning(f"Could not copy {source}: {error}")
+            return
+
+        local_file = Path('images', name).as_posix()
+        row = self.file_list.row_of(source)
+        if row < 0:
+            return
+        # move rois, channel and annotations from the source to the copy
+        for d in [self.params.channels, self.params.rois]:
+            if source in d:
+                value = d.pop(source)
+                if local_file not in d:
+                    d[local_file] = value
+        source_annotation = Path(self._create_annotation_filename_current(source))
+        local_annotation = Path(self._create_annotation_filename_current(local_file))
+        if source_annotation.exists() and not local_annotation.exists():
+            source_annotation.rename(local_annotation)
+
+        if self.file_list.row_of(local_file) >= 0:
+            # identical content is already part of the project
+            self.file_list.takeItem(row)
+        else:
+            self.file_list.item(row).setText(local_file)
+        self.param_saver.request_save(self.params)
+
+    def _on_copy_finished(self, worker):
+
+        self._copy_workers = [w for w in self._copy_workers if w[0] is not worker]
+        if len(self._copy_workers) == 0:
+            self.copy_progress.setVisible(False)
+            self.btn_cancel_copy.setVisible(False)
+            self.copy_progress.setMaximum(0)
+            self.copy_progress.setValue(0)
+
+    def _on_cancel_copy(self):
+        """Cancel pending copies. Files not yet copied keep their original path."""
+
+        for _, cancel_event in self._copy_workers:
+            cancel_event.set()
+
     def _on_images_are_rgb(self):
         """Update params when images are rgb or grayscale"""
 
@@ -268,31 +548,84 @@ class ProjectWidget(QWidget):
         else:
             self.params.rgb = False
 
-    def _update_params_file_list(self):
-        """Update params file list when adding or removing a file"""
+    def _on_compress_annotations(self):
+        """Update params when annotation compression is toggled. Only
+        annotations saved afterwards are affected."""
 
-        self.params.file_paths = []
-        if self.file_list.count() == 0:
-            self.params.file_paths = None
+        if self.params is None:
+            return
+        if self.check_compress_annotations.isChecked():
+            # keep a compression already chosen for the project e.g. zstd
+            if self.params.annotation_compression is None:
+                self.params.annotation_compression = 'zlib'
         else:
-            for i in range(self.file_list.count()):
-                if self.file_list.item(i).text() not in self.params.file_paths:
-                    self.params.file_paths.append(self.file_list.item(i).text())
+            self.params.annotation_compression = None
+        self.param_saver.request_save(self.params)
+
+    def _on_out_of_core(self):
+        """Update params when out-of-core mode is toggled. This applies to
+        the next opened file."""
+
+        if self.params is None:
+            return
+        self.params.out_of_core = self.check_out_of_core.isChecked()
+        self.param_saver.request_save(self.params)
+
+    def _on_use_pyramids(self):
+        """Update params when pyramids are toggled. This applies to the next
+        opened file. Pyramids of the current file and of its neighbours are
+        built in the background."""
+
+        if self.params is None:
+            return
+        self.params.use_pyramids = self.check_use_pyramids.isChecked()
+        self.param_saver.request_save(self.params)
+        if self.params.use_pyramids and (self.file_list.currentItem() is not None):
+            self._get_pyramids().get(self.file_list.currentItem().text())
+            self._prefetch_neighbours()
+
+    def _files_with_status(self, status):
+        """Get the set of project files with a status of the status filter,
+        None for all files."""
+
+        files = self.file_list.files()
+        if status == 'Annotated':
+            # the annotation folder is listed once instead of testing each file
+            self._wait_annotations()
+            annotations_path = self.params.project_path.joinpath('annotations')
+            names = set(os.listdir(annotations_path)) if annotations_path.is_dir() else set()
+            return {f for f in files if pr.get_annotation_path(self.params.project_path, f).name in names}
+        elif status == 'Has ROIs':
+            return {f for f in files if len(self.params.rois.get(f, [])) > 0}
+        elif status == 'Missing file':
+            return {f for f in files if not pr.resolve_file_path(self.params.project_path, f).exists()}
+        return None
+
+    def _on_filter_status(self):
+        """Compute the files with the selected status and filter the list."""
+
+        self._status_filter = None
+        if self.params is not None:
+            self._status_filter = self._files_with_status(self.file_status_filter.currentText())
+        self._on_filter_files()
+
+    def _on_filter_files(self):
+
+        self.file_list.set_filter(self.file_filter.text(), self._status_filter)
 
     def _update_channels_param(self):
 
         if self.sel_channel.currentItem() is not None:
-            self.params.channels[self._get_current_file()] = self.sel_channel.currentItem().text()
-            self.params.save_parameters()
+            self.params.set_channel(self._get_current_file(), self.sel_channel.currentItem().text())
+            self.param_saver.request_save(self.params)
 
+    @timed('roi_sync')
     def _update_roi_param(self, event):
         """Live update rois in the params object and the saved parameters file"""
         
-        rois = [list(x.flatten()) for x in self.viewer.layers['rois'].data]
-        rois = [[x.item() for x in y] for y in rois]
-        
-        self.params.rois[self._get_current_file()] = rois
-        self.params.save_parameters()
+        rois = as_roi_array(self.viewer.layers['rois'].data, self.annotations_ndim)
+        self.params.set_rois(self._get_current_file(), rois)
+        self.param_saver.request_save(self.params)
 
     def _on_fixed_roi_size(self):
         """Display roi options when fixed roi size is selected"""
@@ -333,11 +666,129 @@ class ProjectWidget(QWidget):
             [self.roi_size.value(),0]])
         self.viewer.layers['rois'].add_rectangles(new_roi, edge_color='r', edge_width=10)
 
+    def _tiling_settings(self):
+        """Options of the selected tiling or sampling mode, see
+        tiling.generate_rois."""
+
+        from .tiling import MODES
+
+        return {
+            'mode': MODES[self.tiling_mode.currentIndex()],
+            'roi_size': self.tile_size.value(),
+            'stride': self.tile_stride.value(),
+            'num_rois': self.tile_number.value()}
+
+    def _on_click_add_tiles(self):
+        """Add rois covering the current plane of the current image or all
+        images of the project, depending on the All files option. Rois of
+        other files are created in the background, the worker is returned,
+        or None if only the current file is tiled or rois are already
+        being created."""
+
+        from .tiling import generate_rois, remove_overlapping
+
+        if self._tiling_worker is not None:
+            return None
+        settings = self._tiling_settings()
+        skip_overlap = self.check_tile_no_overlap.isChecked()
+
+        # current file: rois are added to the layer in a single call, which
+        # updates the parameters once
+        current = self.file_list.currentItem().text() if self.file_list.currentItem() is not None else None
+        if 'annotations' in [x.name for x in self.viewer.layers]:
+            labels = self.viewer.layers['annotations'].data
+            planes = [tuple(self.viewer.dims.current_step[:self.annotations_ndim-2])]
+            if self.check_tile_all_files.isChecked():
+                planes = None
+            rois = generate_rois(
+                shape=labels.shape, labels=labels if settings['mode'] == 'labels' else None,
+                planes=planes, **settings)
+            if skip_overlap:
+                existing = as_roi_array(self.viewer.layers['rois'].data, rois.shape[2])
+                rois = remove_overlapping(rois, existing)
+            if len(rois) > 0:
+                self.viewer.layers['rois'].add_rectangles(rois, edge_color='r', edge_width=10)
+
+        if not self.check_tile_all_files.isChecked():
+            return None
+
+        # other files: only their header, and their annotations when sampling
+        # labelled regions, are read in a background thread
+        files = [f for f in self.params.file_paths or [] if f != current]
+        worker = _tiling_worker(
+            files, {f: self.params.rois.get(f) for f in files}, self._get_metadata(),
+            self.params.project_path, self.params.rgb, self.annotation_writer,
+            settings, skip_overlap)
+        worker.returned.connect(self._on_tiles_created)
+        worker.errored.connect(lambda e: show_error(f"Could not create ROIs: {e}"))
+        worker.finished.connect(self._on_tiling_finished)
+        self._tiling_worker = worker
+        self.btn_add_tiles.setEnabled(False)
+        worker.start()
+        return worker
+
+    def _on_tiles_created(self, new_rois):
+        """Add the rois created for other files. They are set at once and
+        saved in a single save, i.e. a single transaction for SQLite
+        projects. Files removed in the meantime are ignored."""
+
+        new_rois = {f: r for f, r in new_rois.items() if self.file_list.row_of(f) >= 0}
+        for file_path, rois in new_rois.items():
+            existing = as_roi_array(self.params.rois.get(file_path, []), rois.shape[2])
+            new_rois[file_path] = np.concatenate([existing, rois])
+        self.params.rois.update(new_rois)
+        self.param_saver.request_save(self.params)
+
+    def _on_tiling_finished(self):
+
+        self._tiling_worker = None
+        self.btn_add_tiles.setEnabled(True)
+
+    def _on_record_timings(self):
+        """Start or stop recording timings. The table is refreshed
+        periodically while recording."""
+
+        if self.check_record_timings.isChecked():
+            instrumentation.enable()
+            self._timings_timer.start()
+        else:
+            instrumentation.disable()
+            self._timings_timer.stop()
+        self._update_timings_table()
+
+    def _update_timings_table(self):
+        """Show percentiles of recorded timings."""
+
+        summary = instrumentation.summary()
+        self.timings_table.setRowCount(len(summary))
+        for row, (name, stats) in enumerate(sorted(summary.items())):
+            values = [name, str(stats['count'])] + [
+                f"{1000 * stats[k]:.1f}" for k in ['p50', 'p90', 'p99', 'max']] + [
+                f"{stats['mb_per_s']:.1f}" if stats['bytes'] > 0 else '']
+            for col, value in enumerate(values):
+                self.timings_table.setItem(row, col, QTableWidgetItem(value))
+
+    def _on_clear_timings(self):
+
+        instrumentation.clear()
+        self._update_timings_table()
+
+    def _on_save_timings(self, event=None, path=None):
+        """Save recorded timings as csv file."""
+
+        if path is None:
+            path, _ = QFileDialog.getSaveFileName(
+                self, "Save timings log", "timings.csv", "CSV (*.csv)",
+                options=QFileDialog.DontUseNativeDialog)
+            if not path:
+                return
+        instrumentation.export_log(path)
+
     def _get_current_param_file_index(self):
         """Get the index of the current file in the list of files."""
 
-        file_index = self.params.file_paths.index(self.file_list.currentItem().text())
-        return file_index
+        # params.file_paths follows the order of the file list
+        return self.file_list.currentRow()
 
     def _get_current_file(self):
         """Get current file as text"""
@@ -359,6 +810,7 @@ class ProjectWidget(QWidget):
         else:
             project_path = Path(project_path)
         self.params = pr.create_project(project_path)
+        self.file_list.set_params(self.params)
         os.chdir(project_path)
         self._on_check_copy_files()
 
@@ -371,24 +823,112 @@ class ProjectWidget(QWidget):
             self.export_folder = Path(export_folder)
         self.display_export_folder.setText(self.export_folder.as_posix())
 
-    def _add_annotation_layer(self):
+    def _get_metadata(self):
+        """Get the metadata cache of the current project, created on first use."""
+
+        project_path = Path(self.params.project_path).absolute()
+        if (self._metadata is None) or (self._metadata.project_path != project_path):
+            from .metadata import MetadataCache
+            if self._metadata is not None:
+                self._metadata.close()
+            self._metadata = MetadataCache(project_path)
+        return self._metadata
+
+    def _get_thumbnail(self, file_path):
+        """Get the icon of a file for the file list. Thumbnails are created
+        by a ThumbnailCache of the current project, which is created again
+        if the project or the RGB option changed."""
+
+        if self.params is None:
+            return None
+        project_path = Path(self.params.project_path).absolute()
+        if ((self._thumbnails is None) or (self._thumbnails.project_path != project_path)
+                or (self._thumbnails.rgb != self.params.rgb)):
+            from .thumbnails import ThumbnailCache
+            if self._thumbnails is not None:
+                self._thumbnails.close()
+            self._thumbnails = ThumbnailCache(
+                project_path, size=self.thumbnail_size, rgb=self.params.rgb,
+                callback=self.file_list.iconChanged.emit, convert=array_to_icon)
+        return self._thumbnails.get(file_path)
+
+    def _get_pyramids(self):
+        """Get the pyramid cache of the current project, created again if
+        the project or the RGB option changed."""
+
+        project_path = Path(self.params.project_path).absolute()
+        if ((self._pyramids is None) or (self._pyramids.project_path != project_path)
+                or (self._pyramids.rgb != self.params.rgb)):
+            from .pyramid import PyramidCache
+            if self._pyramids is not None:
+                self._pyramids.close()
+            self._pyramids = PyramidCache(
+                project_path, rgb=self.params.rgb, min_size=self.pyramid_min_size)
+        return self._pyramids
+
+    def _on_show_thumbnails(self):
+        """Show or hide thumbnails in the file list."""
+
+        if self.check_show_thumbnails.isChecked():
+            self.file_list.set_icon_provider(self._get_thumbnail, self.thumbnail_size)
+        else:
+            self.file_list.set_icon_provider(None)
+
+    def _get_image_shape(self, file_path=None):
+        """Get the shape of the annotations of a file from the image header.
+        For the current file, the shape of the image layer is used if the
+        header cannot be read. Returns None for other unreadable files."""
 
-        if self.params.rgb is False:
-            target_dims = self.viewer.layers[0].data.shape
+        if file_path is None:
+            file_path = self.file_list.currentItem().text()
+            header = self._get_metadata().get(file_path)
+            shape = header['shape'] if header is not None else self.viewer.layers[0].data.shape
         else:
-            target_dims = self.viewer.layers[0].data.shape[:-1]
+            header = self._get_metadata().get(file_path)
+            if header is None:
+                return None
+            shape = header['shape']
+        return tuple(shape[:-1]) if self.params.rgb else tuple(shape)
 
-        self.viewer.add_labels(
-            data=np.zeros(target_dims, dtype=np.uint16),
+    def _add_annotation_layer(self):
+
+        target_dims = self._get_image_shape()
+
+        # in out-of-core mode, the layer directly edits an existing
+        # uncompressed annotation file. Missing and compressed files are
+        # only created or converted once annotations are modified
+        self._annotations_out_of_core = self.params.out_of_core
+        data = None
+        if self.params.out_of_core:
+            annotation_file = self._create_annotation_filename_current()
+            data = memmap_annotations(annotation_file, target_dims)
+            if (data is None) and annotation_file.exists():
+                data = self.image_cache.pop(annotation_file)
+        if data is None:
+            data = np.zeros(target_dims, dtype=np.uint16)
+        annotation_layer = self.viewer.add_labels(
+            data=data,
             name='annotations'
             )
+        # track modifications (painting, filling, erasing or replacing data)
+        # so that unchanged annotations are not written again
+        annotation_layer.events.paint.connect(self._on_annotations_modified)
+        annotation_layer.events.data.connect(self._on_annotations_modified)
+        self._annotations_modified = False
+
+    def _on_annotations_modified(self, event=None):
+
+        self._annotations_modified = True
+        if self._annotations_out_of_core:
+            layer = self.viewer.layers['annotations']
+            if not isinstance(layer.data, np.memmap):
+                annotation_file = self._create_annotation_filename_current()
+                self.image_cache.invalidate(annotation_file)
+                layer.data = create_annotations_memmap(annotation_file, layer.data)
 
     def _add_roi_layer(self):
         
-        if self.params.rgb is False:
-            target_ndims = self.viewer.layers[0].data.ndim
-        else:
-            target_ndims = 2
+        target_ndims = len(self._get_image_shape())
 
         self.roi_layer = self.viewer.add_shapes(
             ndim = target_ndims,
@@ -419,10 +959,8 @@ class ProjectWidget(QWidget):
         #if self.params.project_path.joinpath('annotations') is None:
         #    self._on_click_select_project()
         if filename is None:
-            filename = Path(self.file_list.currentItem().text()).stem
-        else:
-            filename = Path(filename).stem
-        complete_name = self.params.project_path.joinpath('annotations', filename + extension)
+            filename = self.file_list.currentItem().text()
+        complete_name = pr.get_annotation_path(self.params.project_path, filename, extension)
 
         return complete_name
 
@@ -442,85 +980,155 @@ class ProjectWidget(QWidget):
         os.chdir(project_path)
 
         self.params = pr.load_project(project_path)
-        for f in self.params.file_paths:
-            self.file_list.addItem(f)
+        if self.params.file_paths is not None:
+            self.file_list.set_params(self.params)
         if self.params.local_project:
             self.check_copy_files.setChecked(True)
         if self.params.rgb:
             self.images_are_rgb.setChecked(True)
+        self.check_compress_annotations.setChecked(self.params.annotation_compression is not None)
+        self.check_out_of_core.setChecked(self.params.out_of_core)
+        self.check_use_pyramids.setChecked(self.params.use_pyramids)
             
 
-    def save_annotations(self, event=None, filename=None):
-        """Save annotations in default location or in the specified location."""
+    @timed('save_annotations')
+    def save_annotations(self, event=None, filename=None, force=False, background=False):
+        """Save annotations in default location or in the specified location.
+        Annotations are only written if they were modified since they were
+        loaded or last saved, unless force is True. With background=True,
+        the file is written in a background thread. Returns False if the
+        annotations could not be saved."""
 
         if 'annotations' in [x.name for x in self.viewer.layers]:    
+            if not (force or self._annotations_modified):
+                return True
             data = self.viewer.layers['annotations'].data
-            tifffile.imwrite(self._create_annotation_filename_current(filename), data)
+            annotation_file = self._create_annotation_filename_current(filename)
+            if isinstance(data, np.memmap) and (Path(data.filename).resolve() == Path(annotation_file).resolve()):
+                # out-of-core layer: only pages modified since the last flush are written
+                data.flush()
+                self.image_cache.invalidate(annotation_file)
+            else:
+                self.image_cache.invalidate(annotation_file)
+                future = self.annotation_writer.submit(
+                    annotation_file, data, compression=self.params.annotation_compression,
+                    tile_size=self.params.annotation_tile_size)
+                future.add_done_callback(lambda f: self.image_cache.invalidate(annotation_file))
+                if not (background or self._wait_annotations(annotation_file)):
+                    return False
+            self._annotations_modified = False
+        return True
     
-    def _export_data(self, event=None):
-        """Export cropped data of the images and the annotations using the rois."""
+    def _wait_annotations(self, annotation_file=None):
+        """Wait for the background write of an annotation file, or of all
+        files if annotation_file is None. Returns False and reports the
+        error if a write failed."""
+
+        try:
+            if annotation_file is None:
+                self.annotation_writer.drain()
+            else:
+                self.annotation_writer.wait(annotation_file)
+        except Exception as e:
+            show_error(f"Annotations could not be saved: {e}")
+            return False
+        return True
 
+    def _export_data(self, event=None):
+        """Export cropped data of the images and the annotations using the rois.
+        The export runs on the saved project, so the current annotations
+        and parameters are saved first. Exporting again to the same folder
+        only writes the crops that changed. The export runs in the background
+        and returns the worker, or None if an export is already running."""
+
+        if self._export_worker is not None:
+            return None
         if self.export_folder is None:
             self._on_click_select_export_folder()
 
-        images_path = self.export_folder.joinpath(self._source_folder_name.text())
-        if not images_path.exists():
-            images_path.mkdir()
-        labels_path = self.export_folder.joinpath(self._target_folder_name.text())
-        if not labels_path.exists():
-            labels_path.mkdir()
-        
-        image_counter = 0
-        fieldnames = ['file_name', 'image_index', 'roi_index']
-        name_dict = []
-        for i in range(self.file_list.count()):
-            self.file_list.setCurrentRow(i)
-            for j in range(len(self.viewer.layers['rois'].data)):
-                limits = self.viewer.layers['rois'].data[j].astype(int)
-                annotations_roi = self.viewer.layers['annotations'].data.copy()
-                channel = self.params.channels[self._get_current_file()]
-                image_roi = self.viewer.layers[channel].data.copy()
-                
-                for n in range(self.annotations_ndim-2):
-                    annotations_roi = annotations_roi[limits[0,n]]
-                    image_roi = image_roi[limits[0,n]]
-
-                annotations_roi = annotations_roi[
-                    limits[0,-2]:limits[2,-2],
-                    limits[0,-1]:limits[1,-1]
-                ]
-                
-                image_roi = image_roi[
-                    limits[0,-2]:limits[2,-2],
-                    limits[0,-1]:limits[1,-1]
-                ]
-
-                tifffile.imwrite(images_path.joinpath(
-                    f'{self._source_name_prefix.text()}{image_counter}{self._source_name_suffix.text()}.tif'),
-                    image_roi)
-                tifffile.imwrite(labels_path.joinpath(
-                    f'{self._target_name_prefix.text()}{image_counter}{self._target_name_suffix.text()}.tif'),
-                    annotations_roi)
-                image_counter += 1
-                temp_dict = {'file_name': self.file_list.currentItem().text(), 'image_index': image_counter, 'roi_index': j}
-                name_dict.append(temp_dict)
-        
-        # export information for rois e.g. from which image they were extracted
-        with open(self.export_folder.joinpath('rois_infos.csv'), 'w', encoding='UTF8', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(name_dict)
+        if not (self.save_annotations() and self._wait_annotations()):
+            return None
+        self.param_saver.flush()
+        self.params.save_parameters()
 
+        # workers are not forked from the GUI process
+        self._export_cancel = threading.Event()
+        worker = _export_worker(
+            self._export_cancel,
+            project_path=self.params.project_path,
+            export_folder=self.export_folder,
+            source_folder_name=self._source_folder_name.text(),
+            source_name_prefix=self._source_name_prefix.text(),
+            source_name_suffix=self._source_name_suffix.text(),
+            target_folder_name=self._target_folder_name.text(),
+            target_name_prefix=self._target_name_prefix.text(),
+            target_name_suffix=self._target_name_suffix.text(),
+            num_workers=1)
+        worker.yielded.connect(self._on_export_progress)
+        worker.finished.connect(self._on_export_finished)
+        self._export_worker = worker
+        self._export_start = time.perf_counter()
+        self._export_nbytes = 0
+
+        self.btn_export_data.setEnabled(False)
+        self.export_progress.setMaximum(0)
+        self.export_progress.setValue(0)
+        self.export_info.setText('Preparing export...')
+        for w in [self.export_progress, self.export_info, self.btn_cancel_export]:
+            w.setVisible(True)
+        worker.start()
+        return worker
+
+    def _on_export_progress(self, progress):
+        """Show the number of written crops and the throughput of the export."""
+
+        crops_done, crops_total, nbytes = progress
+        self._export_nbytes = nbytes
+        elapsed = max(time.perf_counter() - self._export_start, 1e-6)
+        self.export_progress.setMaximum(max(crops_total, 1))
+        self.export_progress.setValue(crops_done if crops_total > 0 else 1)
+        self.export_info.setText(
+            f'{crops_done}/{crops_total} crops, {crops_done / elapsed:.1f} crops/s, '
+            f'{nbytes / 2**20 / elapsed:.1f} MB/s')
+
+    def _on_export_finished(self):
+
+        if instrumentation.is_enabled():
+            instrumentation.record('export', time.perf_counter() - self._export_start, self._export_nbytes)
+        self._export_worker = None
+        self.btn_export_data.setEnabled(True)
+        for w in [self.export_progress, self.btn_cancel_export]:
+            w.setVisible(False)
+        if self._export_cancel.is_set():
+            self.export_info.setText('Export cancelled.')
+        else:
+            self.export_info.setText('Export finished.')
+
+    def _on_cancel_export(self):
+        """Cancel the export. Files being exported are completed and crops
+        not yet written are removed, exporting again resumes the export."""
+
+        if self._export_cancel is not None:
+            self._export_cancel.set()
+            self.export_info.setText('Cancelling export...')
+
+    @timed('select_file')
     def _on_select_file(self, current_item, previous_item):
         """Update the viewer with the selected file and its corresponding
         annotations and rois."""
 
         # when switching from an open file, save the annatations of the previous file
         if previous_item is not None:
-            self.save_annotations(filename=previous_item.text())
+            self.save_annotations(filename=previous_item.text(), background=True)
         
         self.sel_channel.clear()
 
+        # a background write of the annotations of the file has to be
+        # complete before reading them. Errors are reported before the
+        # layers are replaced
+        if self.file_list.currentItem() is not None:
+            self._wait_annotations(self._create_annotation_filename_current())
+
         # open file and add annotations and roi layers. If no image could 
         # be opened because file list is empty, do nothing.
         success = self.open_file()
@@ -541,15 +1149,88 @@ class ProjectWidget(QWidget):
         else:
             self.sel_channel.setCurrentRow(0)
         
-        # add annoations if any exist
-        if self._create_annotation_filename_current().exists():
-            self.viewer.layers['annotations'].data = imread(self._create_annotation_filename_current())
+        # add annoations if any exist. The cached array is handed over to
+        # the layer and removed from the cache as it gets modified
+        if (not self.params.out_of_core) and self._create_annotation_filename_current().exists():
+            self.viewer.layers['annotations'].data = self.image_cache.pop(self._create_annotation_filename_current())
+        self._annotations_modified = False
         
         # add rois if any exist
         if current_item.text() in self.params.rois.keys():
             rois = self.params.rois[current_item.text()]
-            rois = [np.array(x).reshape(4,self.annotations_ndim) for x in rois]
-            self.viewer.layers['rois'].add_rectangles(rois, edge_color='r', edge_width=10)
+            if len(rois) > 0:
+                self.viewer.layers['rois'].add_rectangles(rois, edge_color='r', edge_width=10)
+
+        self._prefetch_neighbours()
+
+    def _prefetch_neighbours(self):
+        """Load images and annotations next to the current file in the
+        background. With pyramids, images are not loaded but their pyramids
+        are built."""
+
+        current_row = self.file_list.currentRow()
+        rows = []
+        for shift in range(1, self.prefetch_count + 1):
+            rows += [current_row + shift, current_row - shift]
+        paths = []
+        for row in rows:
+            if 0 <= row < self.file_list.count():
+                file = self.file_list.item(row).text()
+                header = self._get_metadata().get(file) if self.params.use_pyramids else None
+                if (header is not None) and self._get_pyramids().is_large(header['shape']):
+                    # large images are not loaded, their pyramid is built
+                    self._get_pyramids().get(file)
+                else:
+                    paths.append(file)
+                annotation_file = self._create_annotation_filename_current(file)
+                if annotation_file.exists():
+                    paths.append(annotation_file)
+        self.image_cache.prefetch(paths)
+
+
+@thread_worker
+def _export_worker(cancel_event, **kwargs):
+    """Export a project in a background thread, yielding the progress."""
+
+    from .export import iter_export_project
+    return (yield from iter_export_project(cancel_event=cancel_event, **kwargs))
+
+
+@thread_worker
+def _tiling_worker(files, existing_rois, metadata, project_path, rgb, annotation_writer,
+                   settings, skip_overlap):
+    """Create rois in files in a background thread. Returns a dict of the
+    new rois of each file."""
+
+    from .tiling import generate_rois, remove_overlapping
+
+    headers = metadata.update(files)
+    new_rois = {}
+    for file_path in files:
+        header = headers.get(file_path)
+        if header is None:
+            continue
+        shape = tuple(header['shape'][:-1]) if rgb else tuple(header['shape'])
+        labels = None
+        if settings['mode'] == 'labels':
+            annotation_path = pr.get_annotation_path(project_path, file_path)
+            annotation_writer.wait(annotation_path)
+            labels = read_annotations(annotation_path) if annotation_path.exists() else None
+        rois = generate_rois(shape=shape, labels=labels, **settings)
+        if skip_overlap and (existing_rois.get(file_path) is not None):
+            rois = remove_overlapping(rois, as_roi_array(existing_rois[file_path], rois.shape[2]))
+        if len(rois) > 0:
+            new_rois[file_path] = rois
+    return new_rois
+
+
+@thread_worker
+def _copy_files_worker(files, folder, index, cancel_event):
+    """Copy files in a background thread, yielding each completed copy."""
+
+    from .local_copy import copy_files
+
+    yield from copy_files(files, folder, index, cancel_event=cancel_event)
 
 
 class VHGroup():
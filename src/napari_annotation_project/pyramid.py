@@ -0,0 +1,266 @@
+"""
+Multiscale pyramids of the large images of a project, built once in the
+background and stored as memory-mapped .npy files in the cache folder of
+the project, so that large images can be opened as multiscale layers.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+from . import project as pr
+from .image_io import read_image, memmap_image, IMAGE_SUFFIXES
+from .metadata import read_metadata
+
+
+PYRAMID_FOLDER = 'pyramids'
+
+# bytes of float data processed at once when downsampling a plane
+_CHUNK_BYTES = 2**26
+
+
+def _level_shape(shape, rgb):
+    """Shape of the level following a level of a given shape. The plane
+    is halved, rounding up, other dimensions are kept."""
+
+    plane_start = len(shape) - (3 if rgb else 2)
+    return tuple((s + 1) // 2 if plane_start <= i < plane_start + 2 else s for i, s in enumerate(shape))
+
+
+def _block_mean(block):
+    """Average 2x2 blocks of the first two dimensions of an array. Odd sizes
+    are padded by repeating the last row or column."""
+
+    pad = [(0, block.shape[0] % 2), (0, block.shape[1] % 2)] + [(0, 0)] * (block.ndim - 2)
+    if any(p[1] for p in pad):
+        block = np.pad(block, pad, mode='edge')
+    block = block.reshape((block.shape[0] // 2, 2, block.shape[1] // 2, 2) + block.shape[2:])
+    return block.mean(axis=(1, 3))
+
+
+def downsample_level(source, target, rgb=False):
+    """
+    Fill target with the 2x2 block mean of the planes of source. Planes are
+    processed in chunks of rows so that only a part of source is in memory.
+
+    Parameters
+    ----------
+    source : array
+        level to downsample, typically memory-mapped
+    target : array
+        array of shape _level_shape(source.shape, rgb)
+    rgb : bool
+        whether the last dimension holds RGB(A) channels
+
+    """
+
+    plane_dims = source.ndim - (3 if rgb else 2)
+    row_bytes = 8 * int(np.prod(source.shape[plane_dims + 1:]))
+    chunk_rows = max(1, _CHUNK_BYTES // (2 * row_bytes))
+    integer = np.issubdtype(target.dtype, np.integer)
+    for index in np.ndindex(source.shape[:plane_dims]):
+        plane = source[index]
+        out = target[index]
+        for start in range(0, out.shape[0], chunk_rows):
+            stop = min(start + chunk_rows, out.shape[0])
+            block = _block_mean(np.asarray(plane[2 * start:2 * stop], dtype=float))
+            out[start:stop] = np.rint(block) if integer else block
+
+
+def build_pyramid(image_path, folder, rgb=False, min_size=1024):
+    """
+    Build the levels of the pyramid of an image. Each level halves the
+    size of the planes of the previous one until they fit in min_size.
+
+    Parameters
+    ----------
+    image_path : str or Path
+        path of the image file
+    folder : str or Path
+        folder where levels are saved as level_<k>.npy. Level 0 is only
+        saved if the image cannot be memory-mapped.
+    rgb : bool
+        whether the image is RGB(A)
+    min_size : int
+        maximum side length of the planes of the last level
+
+    Returns
+    -------
+    num_levels : int
+        number of levels, including the full resolution level
+
+    """
+
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    level = memmap_image(image_path)
+    if level is None:
+        # the image is written once uncompressed so that it is never loaded
+        # in memory when viewed
+        image = read_image(image_path)
+        level = np.lib.format.open_memmap(
+            folder.joinpath('level_0.npy'), mode='w+', dtype=image.dtype, shape=image.shape)
+        level[:] = image
+        del image
+        level.flush()
+
+    num_levels = 1
+    plane_dims = level.ndim - (3 if rgb else 2)
+    while max(level.shape[plane_dims:plane_dims + 2]) > min_size:
+        target = np.lib.format.open_memmap(
+            folder.joinpath(f'level_{num_levels}.npy'), mode='w+', dtype=level.dtype,
+            shape=_level_shape(level.shape, rgb))
+        downsample_level(level, target, rgb)
+        target.flush()
+        level = target
+        num_levels += 1
+    return num_levels
+
+
+class PyramidCache:
+    """
+    Pyramids of the large images of a project. Pyramids are built by a pool
+    of threads and saved in the cache folder of the project under a name
+    made of the file path and of the size and modification time of the
+    image, so that they are only built again when the image changes.
+    Images whose planes fit in min_size have no pyramid.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    rgb : bool
+        whether the images are RGB(A)
+    min_size : int
+        maximum side length of the planes of the last level
+    num_threads : int
+        number of threads building pyramids
+    callback : callable, optional
+        called as callback(file_path) from a worker thread when the
+        pyramid of a file is ready
+
+    """
+
+    def __init__(self, project_path, rgb=False, min_size=1024, num_threads=1, callback=None):
+
+        self.project_path = Path(project_path).absolute()
+        self.folder = pr.get_cache_folder(self.project_path).joinpath(PYRAMID_FOLDER)
+        self.rgb = rgb
+        self.min_size = min_size
+        self.callback = callback
+        self._pending = set()
+        self._skipped = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    @staticmethod
+    def _digest(text):
+
+        return hashlib.blake2b(text.encode(), digest_size=10).hexdigest()
+
+    def _state(self, file_path):
+        """Size and modification time of the image, None if it does not exist."""
+
+        try:
+            stat = os.stat(pr.resolve_file_path(self.project_path, file_path))
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns, self.rgb, self.min_size)
+
+    def _pyramid_folder(self, file_path, state):
+
+        return self.folder.joinpath(f'{self._digest(file_path)}_{self._digest(repr(state))}')
+
+    def is_large(self, shape):
+        """Whether an image of a given shape gets a pyramid."""
+
+        plane_dims = len(shape) - (3 if self.rgb else 2)
+        return max(shape[plane_dims:plane_dims + 2]) > self.min_size
+
+    def get(self, file_path):
+        """
+        Get the levels of the pyramid of a file. If no up-to-date pyramid
+        exists, it is built in the background and None is returned.
+
+        Parameters
+        ----------
+        file_path : str
+            path of the file as stored in the parameters
+
+        Returns
+        -------
+        levels : list of arrays or None
+            read-only memory-mapped levels from full resolution to the
+            smallest. None if the pyramid is not built yet or if the image
+            is small or unreadable.
+
+        """
+
+        if Path(file_path).suffix.lower() not in IMAGE_SUFFIXES:
+            return None
+        state = self._state(file_path)
+        if state is None:
+            return None
+        pyramid_folder = self._pyramid_folder(file_path, state)
+        if not pyramid_folder.is_dir():
+            self._submit(file_path, state)
+            return None
+
+        level_paths = sorted(pyramid_folder.glob('level_*.npy'), key=lambda p: int(p.stem[6:]))
+        try:
+            levels = [np.load(p, mmap_mode='r') for p in level_paths]
+            if (len(levels) == 0) or (level_paths[0].stem != 'level_0'):
+                image = memmap_image(pr.resolve_file_path(self.project_path, file_path))
+                if image is None:
+                    return None
+                levels.insert(0, image)
+        except (OSError, ValueError):
+            return None
+        return levels
+
+    def _submit(self, file_path, state):
+
+        with self._lock:
+            if ((file_path, state) in self._pending) or ((file_path, state) in self._skipped):
+                return
+            self._pending.add((file_path, state))
+        self._executor.submit(self._create, file_path, state)
+
+    def _create(self, file_path, state):
+        """Build and save a pyramid, replacing outdated ones of the file."""
+
+        image_path = pr.resolve_file_path(self.project_path, file_path)
+        pyramid_folder = self._pyramid_folder(file_path, state)
+        # built in a temporary folder so that a partial pyramid is never read
+        temp_folder = pyramid_folder.with_suffix('.tmp')
+        try:
+            if not self.is_large(read_metadata(image_path)['shape']):
+                with self._lock:
+                    self._skipped.add((file_path, state))
+                return
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            build_pyramid(image_path, temp_folder, self.rgb, self.min_size)
+            for outdated in self.folder.glob(f'{self._digest(file_path)}_*'):
+                if outdated != temp_folder:
+                    shutil.rmtree(outdated, ignore_errors=True)
+            os.replace(temp_folder, pyramid_folder)
+        except Exception:
+            # unreadable files have no pyramid, they are not tried again
+            # until they change
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            with self._lock:
+                self._skipped.add((file_path, state))
+            return
+        finally:
+            with self._lock:
+                self._pending.discard((file_path, state))
+        if self.callback is not None:
+            self.callback(file_path)
+
+    def close(self):
+        """Stop building pyramids. Pyramids being built are completed."""
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,200 @@
+"""
+Array representation of the rois of a file. The rois of a file are held as
+a single (N, 4, ndim) float array with the four corners of each rectangle,
+as drawn in the rois layer. Corners are given in image coordinates, the
+first ndim-2 coordinates being the plane of the roi.
+"""
+import io
+import numpy as np
+
+
+def as_roi_array(rois, ndim=None):
+    """
+    Convert rois to an (N, 4, ndim) array.
+
+    Parameters
+    ----------
+    rois : array or list
+        rois as an (N, 4, ndim) array, a list of (4, ndim) arrays or a list
+        of flat lists of coordinates as stored in Parameters.yml
+    ndim : int, optional
+        number of dimensions of the rois. Only needed for empty rois,
+        which default to 2D.
+
+    Returns
+    -------
+    rois : array
+        (N, 4, ndim) float array
+    """
+
+    if len(rois) == 0:
+        if ndim is None:
+            ndim = rois.shape[2] if isinstance(rois, np.ndarray) and rois.ndim == 3 else 2
+        return np.zeros((0, 4, ndim))
+    if isinstance(rois, np.ndarray) and rois.ndim == 3 and rois.dtype == np.float64:
+        return rois
+    rois = np.asarray(rois, dtype=np.float64)
+    return np.ascontiguousarray(rois.reshape(len(rois), 4, -1))
+
+
+def rois_to_list(rois):
+    """Convert rois to a list of flat lists as stored in Parameters.yml.
+    Integer coordinates are stored as int."""
+
+    rois = as_roi_array(rois)
+    flat = rois.reshape(len(rois), 4 * rois.shape[2])
+    if np.array_equal(flat, np.round(flat)):
+        return flat.astype(np.int64).tolist()
+    return flat.tolist()
+
+
+def encode_rois(rois):
+    """Serialize rois to bytes in .npy format."""
+
+    buffer = io.BytesIO()
+    np.save(buffer, as_roi_array(rois), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_rois(data):
+    """Read rois serialized with encode_rois."""
+
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def roi_bounds(rois):
+    """
+    Get the bounding boxes of rois.
+
+    Returns
+    -------
+    lower : array
+        (N, ndim) array of lowest coordinates
+    upper : array
+        (N, ndim) array of highest coordinates
+    """
+
+    rois = as_roi_array(rois)
+    return rois.min(axis=1), rois.max(axis=1)
+
+
+
+class RoiIndex:
+    """
+    Spatial index of the rois of a file answering which rois overlap or are
+    contained in a region. Rois are grouped by plane, and within a plane
+    sorted both by first row and by first column, so that a query only
+    tests the rois whose start lies in the row window and in the column
+    window of the region.
+
+    Parameters
+    ----------
+    rois : array or list
+        rois of the file, see as_roi_array
+
+    """
+
+    def __init__(self, rois):
+
+        rois = as_roi_array(rois)
+        self.ndim = rois.shape[2]
+        self._lower, self._upper = roi_bounds(rois)
+        self._planes = {}
+        if len(rois) == 0:
+            return
+        planes, inverse = np.unique(self._lower[:, :-2], axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for p, plane in enumerate(planes):
+            indices = np.flatnonzero(inverse == p)
+            lower = self._lower[indices, -2:]
+            by_row = indices[np.argsort(lower[:, 0], kind='stable')]
+            by_col = indices[np.argsort(lower[:, 1], kind='stable')]
+            self._planes[tuple(plane.astype(int).tolist())] = {
+                'indices': indices,
+                'by_row': by_row, 'row_starts': self._lower[by_row, -2],
+                'by_col': by_col, 'col_starts': self._lower[by_col, -1],
+                'max_size': (self._upper[indices, -2:] - lower).max(axis=0)}
+
+    @property
+    def planes(self):
+        """Planes containing rois, sorted."""
+
+        return sorted(self._planes)
+
+    def in_plane(self, plane):
+        """Get the sorted indices of the rois of a plane."""
+
+        if tuple(plane) not in self._planes:
+            return np.zeros(0, dtype=int)
+        return self._planes[tuple(plane)]['indices']
+
+    @staticmethod
+    def _candidates(entry, first, last, side):
+        """Indices of the rois of a plane whose first row and column are
+        after first (included with side='left') and before last."""
+
+        rows = entry['by_row'][
+            np.searchsorted(entry['row_starts'], first[0], side=side):
+            np.searchsorted(entry['row_starts'], last[0], side='left')]
+        cols = entry['by_col'][
+            np.searchsorted(entry['col_starts'], first[1], side=side):
+            np.searchsorted(entry['col_starts'], last[1], side='left')]
+        return np.intersect1d(rows, cols, assume_unique=True)
+
+    def _search(self, lower, upper, plane, contained):
+
+        lower = np.asarray(lower, dtype=float)[-2:]
+        upper = np.asarray(upper, dtype=float)[-2:]
+        planes = self._planes.keys() if plane is None else [tuple(plane)]
+        found = []
+        for p in planes:
+            entry = self._planes.get(p)
+            if entry is None:
+                continue
+            if contained:
+                candidates = self._candidates(entry, lower, upper, side='left')
+                keep = np.all((self._lower[candidates, -2:] >= lower)
+                              & (self._upper[candidates, -2:] <= upper), axis=1)
+            else:
+                # rois overlapping the region start less than their size
+                # before it
+                candidates = self._candidates(entry, lower - entry['max_size'], upper, side='right')
+                keep = np.all((self._lower[candidates, -2:] < upper)
+                              & (self._upper[candidates, -2:] > lower), axis=1)
+            found.append(candidates[keep])
+        if len(found) == 0:
+            return np.zeros(0, dtype=int)
+        return np.sort(np.concatenate(found))
+
+    def query(self, lower, upper, plane=None):
+        """
+        Find the rois overlapping a rectangular region. Rois only touching
+        the region are not considered overlapping.
+
+        Parameters
+        ----------
+        lower : array
+            lowest (row, column) coordinates of the region
+        upper : array
+            highest (row, column) coordinates of the region
+        plane : tuple, optional
+            plane of the region. By default all planes are searched.
+
+        Returns
+        -------
+        indices : array
+            sorted indices of the overlapping rois
+        """
+
+        return self._search(lower, upper, plane, contained=False)
+
+    def contained(self, lower, upper, plane=None):
+        """Find the rois contained in a rectangular region, see query."""
+
+        return self._search(lower, upper, plane, contained=True)
+
+    def overlapping(self, roi):
+        """Find the rois overlapping a roi given as a (4, ndim) array."""
+
+        roi = np.asarray(roi, dtype=float).reshape(4, -1)
+        return self.query(roi.min(axis=0), roi.max(axis=0), plane=tuple(roi[0, :-2].astype(int).tolist()))
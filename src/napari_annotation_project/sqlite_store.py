@@ -0,0 +1,359 @@
+"""
+SQLite storage of the project parameters as an alternative to the
+Parameters.yml file. Files, channels and rois are kept in separate tables
+keyed by a stable file id so that single edits only touch single rows.
+"""
+from __future__ import annotations
+import dataclasses
+from dataclasses import dataclass
+import json
+import sqlite3
+import threading
+from contextlib import closing
+from pathlib import Path
+import numpy as np
+
+from .parameters import Param
+from .rois import as_roi_array, encode_rois, decode_rois
+from .instrumentation import timed
+
+DB_NAME = 'Parameters.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT UNIQUE NOT NULL,
+    position INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_position ON files(position);
+CREATE TABLE IF NOT EXISTS channels (
+    file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+    channel TEXT
+);
+CREATE TABLE IF NOT EXISTS rois (
+    file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+    coordinates BLOB NOT NULL
+);
+"""
+
+# fields of Param stored in dedicated tables. All other fields are settings
+_TABLE_FIELDS = ['file_paths', 'channels', 'rois']
+
+
+class ProjectDatabase:
+    """
+    Access to the SQLite database of a project. A connection is opened
+    for each operation so that the database can be used from any thread.
+    The database keeps the snapshot of the parameters it holds, used to
+    only write changes, and a lock serializing the writes updating it.
+
+    Parameters
+    ----------
+    db_path: str or Path
+        path of the database file
+
+    """
+
+    def __init__(self, db_path):
+
+        self.db_path = Path(db_path)
+        self.synced = None
+        self.lock = threading.RLock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA foreign_keys=ON")
+        # with write-ahead logging this keeps the database consistent while
+        # avoiding a disk sync for every single-row edit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return closing(conn)
+
+    def _file_id(self, conn, file_path):
+        """Get id of a file, creating an entry if needed."""
+
+        row = conn.execute("SELECT id FROM files WHERE path=?", (file_path,)).fetchone()
+        if row is not None:
+            return row[0]
+        return conn.execute("INSERT INTO files (path) VALUES (?)", (file_path,)).lastrowid
+
+    def read(self):
+        """Read the complete content of the database.
+
+        Returns
+        -------
+        settings: dict
+            scalar parameters
+        file_paths: list of str
+            ordered files of the project
+        channels: dict
+            channel of each file
+        rois: dict
+            rois of each file
+        """
+
+        with self._connect() as conn:
+            settings = {k: json.loads(v) for k, v in conn.execute("SELECT key, value FROM settings")}
+            file_paths = [x[0] for x in conn.execute(
+                "SELECT path FROM files WHERE position IS NOT NULL ORDER BY position")]
+            channels = dict(conn.execute(
+                "SELECT files.path, channels.channel FROM channels JOIN files ON files.id=channels.file_id"))
+            rois = {path: _decode(coords) for path, coords in conn.execute(
+                "SELECT files.path, rois.coordinates FROM rois JOIN files ON files.id=rois.file_id")}
+        return settings, file_paths, channels, rois
+
+    def set_rois(self, file_path, rois):
+        """Replace the rois of a file in a single transaction."""
+
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rois (file_id, coordinates) VALUES (?, ?)",
+                (self._file_id(conn, file_path), encode_rois(rois)))
+
+    def set_channel(self, file_path, channel):
+        """Set the channel of a file in a single transaction."""
+
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO channels (file_id, channel) VALUES (?, ?)",
+                (self._file_id(conn, file_path), channel))
+
+    def update(self, settings=None, file_paths=None, channels=None, rois=None,
+               added_files=(), removed_files=(), removed_channels=(), removed_rois=()):
+        """Write a set of changes in a single transaction. Arguments left to
+        None are not modified.
+
+        Parameters
+        ----------
+        settings: dict
+            scalar parameters to update
+        file_paths: list of str
+            complete ordered list of files, only given when files are
+            reordered as all positions are then written again
+        channels: dict
+            channels to insert or update
+        rois: dict
+            rois to insert or update
+        added_files: list of str
+            files appended at the end of the list
+        removed_files: list of str
+            files removed from the list
+        removed_channels: list of str
+            files whose channel entry is removed
+        removed_rois: list of str
+            files whose rois entry is removed
+        """
+
+        with self._connect() as conn, conn:
+            if settings:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                    [(k, json.dumps(v)) for k, v in settings.items()])
+            if file_paths is not None:
+                conn.execute("UPDATE files SET position=NULL")
+                conn.executemany(
+                    "UPDATE files SET position=? WHERE id=?",
+                    [(position, self._file_id(conn, path)) for position, path in enumerate(file_paths)])
+            conn.executemany(
+                "UPDATE files SET position=NULL WHERE path=?", [(path,) for path in removed_files])
+            if added_files:
+                # positions are only ordered, gaps left by removed files are kept
+                start = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM files").fetchone()[0]
+                conn.executemany(
+                    "UPDATE files SET position=? WHERE id=?",
+                    [(start + k, self._file_id(conn, path)) for k, path in enumerate(added_files)])
+            if channels:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO channels (file_id, channel) VALUES (?, ?)",
+                    [(self._file_id(conn, k), v) for k, v in channels.items()])
+            if rois:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rois (file_id, coordinates) VALUES (?, ?)",
+                    [(self._file_id(conn, k), encode_rois(v)) for k, v in rois.items()])
+            for path in removed_channels:
+                conn.execute(
+                    "DELETE FROM channels WHERE file_id=(SELECT id FROM files WHERE path=?)", (path,))
+            for path in removed_rois:
+                conn.execute(
+                    "DELETE FROM rois WHERE file_id=(SELECT id FROM files WHERE path=?)", (path,))
+            # drop files that are not referenced anymore
+            conn.executemany(
+                "DELETE FROM files WHERE path=? AND position IS NULL "
+                "AND NOT EXISTS (SELECT 1 FROM channels WHERE file_id=files.id) "
+                "AND NOT EXISTS (SELECT 1 FROM rois WHERE file_id=files.id)",
+                [(path,) for path in {*removed_files, *removed_channels, *removed_rois}])
+
+
+@dataclass
+class SQLiteParam(Param):
+    """
+    Project parameters stored in an SQLite database instead of a yml file.
+    Saving only writes the entries that changed since the last save and
+    set_rois/set_channel write a single row immediately.
+    """
+
+    def __post_init__(self):
+
+        super().__post_init__()
+        self._db = None
+
+    @property
+    def database(self):
+        """Database of the project."""
+
+        if self._db is None or self._db.db_path != Path(self.project_path).joinpath(DB_NAME):
+            self._db = ProjectDatabase(Path(self.project_path).joinpath(DB_NAME))
+        return self._db
+
+    def set_rois(self, file_path, rois):
+
+        rois = as_roi_array(rois)
+        self.rois[file_path] = rois
+        database = self.database
+        with database.lock:
+            database.set_rois(file_path, rois)
+            if database.synced is not None:
+                database.synced['rois'][file_path] = rois
+
+    def set_channel(self, file_path, channel):
+
+        self.channels[file_path] = channel
+        database = self.database
+        with database.lock:
+            database.set_channel(file_path, channel)
+            if database.synced is not None:
+                database.synced['channels'][file_path] = channel
+
+    @timed('save_parameters')
+    def save_parameters(self, alternate_path=None):
+        """Save parameters in the database of the project.
+
+        Parameters
+        ----------
+        alternate_path : str or Path, optional
+            place where to save the parameters database.
+        """
+
+        # the snapshot that is written is the one recorded as synced, so
+        # that changes made during the write are found by the next save
+        snapshot = _snapshot(self)
+        if alternate_path is not None:
+            database = ProjectDatabase(Path(alternate_path).joinpath(DB_NAME))
+            database.update(**_changes(_read_snapshot(database), snapshot))
+            return
+
+        database = self.database
+        with database.lock:
+            if database.synced is None:
+                database.synced = _read_snapshot(database)
+            database.update(**_changes(database.synced, snapshot))
+            database.synced = snapshot
+
+
+def _settings(param):
+
+    settings = {}
+    for f in dataclasses.fields(param):
+        if f.name in _TABLE_FIELDS:
+            continue
+        value = getattr(param, f.name)
+        if isinstance(value, Path):
+            value = value.as_posix()
+        settings[f.name] = value
+    return settings
+
+
+def _file_paths(param):
+
+    if param.file_paths is None:
+        return []
+    return [Path(x).as_posix() if not isinstance(x, str) else x for x in param.file_paths]
+
+
+def _snapshot(param):
+
+    # roi arrays are replaced when rois change, never modified in place
+    return {
+        'settings': _settings(param),
+        'file_paths': _file_paths(param),
+        'channels': dict(param.channels),
+        'rois': dict(param.rois),
+    }
+
+
+def _read_snapshot(database):
+
+    settings, file_paths, channels, rois = database.read()
+    return {'settings': settings, 'file_paths': file_paths, 'channels': channels, 'rois': rois}
+
+
+def _decode(coordinates):
+    """Read rois stored in binary form or as json by earlier versions."""
+
+    if isinstance(coordinates, bytes):
+        return decode_rois(coordinates)
+    return as_roi_array(json.loads(coordinates))
+
+
+def _same_rois(a, b):
+
+    return a.shape == b.shape and np.array_equal(a, b)
+
+
+def _changes(synced, snapshot):
+    """Find the entries of a snapshot that differ from the synced snapshot."""
+
+    changes = {}
+    changes['settings'] = {k: v for k, v in snapshot['settings'].items() if synced['settings'].get(k) != v}
+    if snapshot['file_paths'] != synced['file_paths']:
+        current = set(snapshot['file_paths'])
+        kept = [x for x in synced['file_paths'] if x in current]
+        if snapshot['file_paths'][:len(kept)] == kept:
+            # files were only removed or appended
+            changes['removed_files'] = [x for x in synced['file_paths'] if x not in current]
+            changes['added_files'] = snapshot['file_paths'][len(kept):]
+        else:
+            changes['file_paths'] = snapshot['file_paths']
+    for name, equal in [('channels', lambda a, b: a == b), ('rois', _same_rois)]:
+        current = snapshot[name]
+        previous = synced[name]
+        changes[name] = {k: v for k, v in current.items() if (k not in previous) or not equal(previous[k], v)}
+        changes['removed_' + name] = [k for k in previous if k not in current]
+    return changes
+
+
+def load_sqlite_project(project_path):
+    """
+    Load the parameters of a project from its SQLite database.
+
+    Parameters
+    ----------
+    project_path : Path
+        path where the project is saved
+
+    Returns
+    -------
+    project : SQLiteParam
+        project object
+
+    """
+
+    project = SQLiteParam()
+    project.project_path = Path(project_path)
+    settings, file_paths, channels, rois = project.database.read()
+    for k, v in settings.items():
+        setattr(project, k, v)
+    project.file_paths = file_paths if len(file_paths) > 0 else None
+    project.channels = channels
+    project.rois = rois
+    project.project_path = Path(project_path)
+    project.database.synced = _snapshot(project)
+
+    return project
@@ -0,0 +1,235 @@
+"""
+Small previews of the images of a project with their annotations overlaid,
+generated in the background and stored in the cache folder of the project.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+from . import project as pr
+from .image_io import read_image, read_annotations, memmap_image, IMAGE_SUFFIXES
+
+
+THUMBNAIL_FOLDER = 'thumbnails'
+
+# colors of labels 1, 2, ... in the overlay, cycled for higher labels
+_LABEL_COLORS = np.array([
+    [230, 25, 75], [60, 180, 75], [255, 225, 25], [0, 130, 200], [245, 130, 48],
+    [145, 30, 180], [70, 240, 240], [240, 50, 230], [210, 245, 60], [250, 190, 212]], dtype=float)
+
+
+def _downsample(data, size, rgb):
+    """Take the middle plane of nD data and subsample it so that its
+    largest side is at most size. Memory-mapped data is only read at the
+    sampled pixels."""
+
+    plane_dims = data.ndim - (3 if rgb else 2)
+    data = data[tuple(s // 2 for s in data.shape[:plane_dims])]
+    step = max(1, int(np.ceil(max(data.shape[:2]) / size)))
+    return np.asarray(data[::step, ::step])
+
+
+def make_thumbnail(image_path, annotation_path=None, size=64, rgb=False):
+    """
+    Create a preview of an image with its annotations overlaid.
+
+    Parameters
+    ----------
+    image_path : str or Path
+        path of the image file
+    annotation_path : str or Path, optional
+        path of the annotation file
+    size : int
+        maximum side length of the thumbnail
+    rgb : bool
+        whether the image is RGB(A)
+
+    Returns
+    -------
+    thumbnail : array
+        (height, width, 3) uint8 array
+
+    """
+
+    image = memmap_image(image_path)
+    if image is None:
+        image = read_image(image_path)
+    image = _downsample(image, size, rgb).astype(float)
+
+    if rgb:
+        image = image[..., :3]
+    else:
+        image = np.repeat(image[..., np.newaxis], 3, axis=-1)
+    low, high = np.percentile(image, [1, 99])
+    thumbnail = np.clip((image - low) / max(high - low, 1e-12), 0, 1) * 255
+
+    if (annotation_path is not None) and Path(annotation_path).exists():
+        annotations = memmap_image(annotation_path)
+        if annotations is None:
+            annotations = read_annotations(annotation_path)
+        annotations = _downsample(annotations, size, False)
+        labelled = annotations > 0
+        colors = _LABEL_COLORS[(annotations[labelled].astype(np.int64) - 1) % len(_LABEL_COLORS)]
+        thumbnail[labelled] = 0.5 * thumbnail[labelled] + 0.5 * colors
+
+    return thumbnail.astype(np.uint8)
+
+
+class ThumbnailCache:
+    """
+    Thumbnails of the files of a project. Thumbnails are created by a pool
+    of threads and saved in the cache folder of the project under a name
+    made of the file path and of the size and modification time of the
+    image and annotation files, so that they are only created again when
+    one of the files changes.
+
+    Parameters
+    ----------
+    project_path : str or Path
+        path where the project is saved
+    size : int
+        maximum side length of the thumbnails
+    rgb : bool
+        whether the images are RGB(A)
+    num_threads : int
+        number of threads creating thumbnails
+    max_entries : int
+        number of thumbnails kept in memory
+    callback : callable, optional
+        called as callback(file_path) from a worker thread when the
+        thumbnail of a file is ready
+    convert : callable, optional
+        function applied to thumbnail arrays before they are kept in memory
+        and returned by get, e.g. to create icons. It is called in the
+        thread calling get.
+
+    """
+
+    def __init__(self, project_path, size=64, rgb=False, num_threads=2, max_entries=2000,
+                 callback=None, convert=None):
+
+        self.project_path = Path(project_path).absolute()
+        self.folder = pr.get_cache_folder(self.project_path).joinpath(THUMBNAIL_FOLDER)
+        self.size = size
+        self.rgb = rgb
+        self.max_entries = max_entries
+        self.callback = callback
+        self.convert = convert
+        self._entries = OrderedDict()
+        self._pending = set()
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    @staticmethod
+    def _digest(text):
+
+        return hashlib.blake2b(text.encode(), digest_size=10).hexdigest()
+
+    def _state(self, file_path):
+        """Size and modification time of the image and annotation files,
+        None if the image does not exist."""
+
+        image_path = pr.resolve_file_path(self.project_path, file_path)
+        annotation_path = pr.get_annotation_path(self.project_path, file_path)
+        try:
+            image_stat = os.stat(image_path)
+        except OSError:
+            return None
+        try:
+            annotation_stat = os.stat(annotation_path)
+            annotation_state = (annotation_stat.st_size, annotation_stat.st_mtime_ns)
+        except OSError:
+            annotation_state = None
+        return (image_stat.st_size, image_stat.st_mtime_ns, annotation_state, self.size, self.rgb)
+
+    def _thumbnail_path(self, file_path, state):
+
+        return self.folder.joinpath(f'{self._digest(file_path)}_{self._digest(repr(state))}.npy')
+
+    def get(self, file_path):
+        """
+        Get the thumbnail of a file. If no up-to-date thumbnail exists, it
+        is created in the background and None is returned.
+
+        Parameters
+        ----------
+        file_path : str
+            path of the file as stored in the parameters
+
+        Returns
+        -------
+        thumbnail : array or None
+            thumbnail, converted with convert if set
+
+        """
+
+        if Path(file_path).suffix.lower() not in IMAGE_SUFFIXES:
+            return None
+        state = self._state(file_path)
+        if state is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if (entry is not None) and (entry[0] == state):
+                self._entries.move_to_end(file_path)
+                return entry[1]
+
+        thumbnail_path = self._thumbnail_path(file_path, state)
+        try:
+            thumbnail = np.load(thumbnail_path)
+        except (OSError, ValueError):
+            self._submit(file_path, state)
+            return None
+        value = self.convert(thumbnail) if self.convert is not None else thumbnail
+        with self._lock:
+            self._entries[file_path] = (state, value)
+            self._entries.move_to_end(file_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def _submit(self, file_path, state):
+
+        with self._lock:
+            if ((file_path, state) in self._pending) or ((file_path, state) in self._failed):
+                return
+            self._pending.add((file_path, state))
+        self._executor.submit(self._create, file_path, state)
+
+    def _create(self, file_path, state):
+        """Create and save a thumbnail, replacing outdated ones of the file."""
+
+        try:
+            thumbnail = make_thumbnail(
+                pr.resolve_file_path(self.project_path, file_path),
+                pr.get_annotation_path(self.project_path, file_path), self.size, self.rgb)
+            self.folder.mkdir(parents=True, exist_ok=True)
+            thumbnail_path = self._thumbnail_path(file_path, state)
+            for outdated in self.folder.glob(f'{self._digest(file_path)}_*.npy'):
+                outdated.unlink(missing_ok=True)
+            # written under a temporary name so that a partial file is never read
+            temp_path = thumbnail_path.with_suffix('.tmp')
+            with open(temp_path, 'wb') as f:
+                np.save(f, thumbnail)
+            os.replace(temp_path, thumbnail_path)
+        except Exception:
+            # unreadable files have no thumbnail, they are not tried again
+            # until they change
+            with self._lock:
+                self._failed.add((file_path, state))
+            return
+        finally:
+            with self._lock:
+                self._pending.discard((file_path, state))
+        if self.callback is not None:
+            self.callback(file_path)
+
+    def close(self):
+        """Stop creating thumbnails. Thumbnails being created are completed."""
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,243 @@
+"""
+Automatic creation of fixed-size rois covering images. All functions
+return rois as an array of shape (N, 4, ndim) with the four corners of each
+rectangle, in the same order as rois drawn in the rois layer.
+"""
+import itertools
+import numpy as np
+
+from .rois import RoiIndex
+
+
+def rectangles(corners, roi_size):
+    """
+    Create square rois from their top-left corners.
+
+    Parameters
+    ----------
+    corners : array
+        (N, ndim) array of top-left corners. The first ndim-2 coordinates
+        are the plane of the roi
+    roi_size : int
+        side length of the rois
+
+    Returns
+    -------
+    rois : array
+        (N, 4, ndim) array of rois
+    """
+
+    corners = np.asarray(corners, dtype=float).reshape(len(corners), -1)
+    offsets = np.zeros((4, corners.shape[1]))
+    offsets[:, -2:] = np.array([[0, 0], [0, roi_size], [roi_size, roi_size], [roi_size, 0]])
+    return corners[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+
+
+def _all_planes(shape):
+
+    return list(itertools.product(*[range(s) for s in shape[:-2]]))
+
+
+def _axis_positions(length, roi_size, stride):
+    """Start positions along an axis. A last roi flush with the border is
+    added so that the whole axis is covered."""
+
+    if length < roi_size:
+        return np.zeros(0, dtype=int)
+    positions = np.arange(0, length - roi_size + 1, stride)
+    if positions[-1] != length - roi_size:
+        positions = np.append(positions, length - roi_size)
+    return positions
+
+
+def grid_rois(shape, roi_size, stride=None, planes=None):
+    """
+    Create rois on a regular grid.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the annotations of the image
+    roi_size : int
+        side length of the rois
+    stride : int, optional
+        distance between rois. Default is roi_size, i.e. no overlap.
+        Smaller values create overlapping rois.
+    planes : list of tuple, optional
+        planes in which to create rois for nD images. Default is all planes.
+
+    Returns
+    -------
+    rois : array
+        (N, 4, ndim) array of rois
+    """
+
+    if stride is None:
+        stride = roi_size
+    if planes is None:
+        planes = _all_planes(shape)
+    rows = _axis_positions(shape[-2], roi_size, stride)
+    cols = _axis_positions(shape[-1], roi_size, stride)
+    yx = np.stack(np.meshgrid(rows, cols, indexing='ij'), axis=-1).reshape(-1, 2)
+
+    planes = np.array(planes, dtype=float).reshape(len(planes), len(shape) - 2)
+    corners = np.concatenate([
+        np.repeat(planes, len(yx), axis=0),
+        np.tile(yx, (len(planes), 1))], axis=1)
+    return rectangles(corners, roi_size)
+
+
+def random_rois(shape, roi_size, num_rois, planes=None, rng=None):
+    """
+    Create rois at random positions within the image.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the annotations of the image
+    roi_size : int
+        side length of the rois
+    num_rois : int
+        number of rois to create
+    planes : list of tuple, optional
+        planes in which to create rois for nD images. Default is all planes.
+    rng : numpy.random.Generator, optional
+        random number generator
+
+    Returns
+    -------
+    rois : array
+        (N, 4, ndim) array of rois
+    """
+
+    rng = np.random.default_rng(rng)
+    if planes is None:
+        planes = _all_planes(shape)
+    if (shape[-2] < roi_size) or (shape[-1] < roi_size) or (len(planes) == 0):
+        return np.zeros((0, 4, len(shape)))
+
+    planes = np.array(planes, dtype=float).reshape(len(planes), len(shape) - 2)
+    corners = np.concatenate([
+        planes[rng.integers(0, len(planes), num_rois)],
+        rng.integers(0, shape[-2] - roi_size + 1, num_rois)[:, np.newaxis],
+        rng.integers(0, shape[-1] - roi_size + 1, num_rois)[:, np.newaxis]], axis=1)
+    return rectangles(corners, roi_size)
+
+
+def label_rois(labels, roi_size, num_rois, planes=None, rng=None):
+    """
+    Create rois at random positions centered on labelled pixels, so that
+    each roi contains annotations.
+
+    Parameters
+    ----------
+    labels : array
+        annotations of the image
+    roi_size : int
+        side length of the rois
+    num_rois : int
+        number of rois to create
+    planes : list of tuple, optional
+        planes in which to create rois for nD images. Default is all planes.
+    rng : numpy.random.Generator, optional
+        random number generator
+
+    Returns
+    -------
+    rois : array
+        (N, 4, ndim) array of rois. Fewer than num_rois rois are returned
+        if there are fewer labelled pixels.
+    """
+
+    rng = np.random.default_rng(rng)
+    shape = labels.shape
+    if planes is None:
+        planes = _all_planes(shape)
+    if (shape[-2] < roi_size) or (shape[-1] < roi_size):
+        return np.zeros((0, 4, len(shape)))
+
+    # labelled pixels of the selected planes, planes are read one by one
+    # so that memory-mapped annotations are not loaded entirely
+    coordinates = []
+    for plane in planes:
+        yx = np.argwhere(np.asarray(labels[tuple(plane)]) > 0)
+        coordinates.append(np.concatenate([np.tile(np.array(plane, dtype=int), (len(yx), 1)), yx], axis=1))
+    coordinates = np.concatenate(coordinates, axis=0) if coordinates else np.zeros((0, len(shape)), dtype=int)
+    if len(coordinates) == 0:
+        return np.zeros((0, 4, len(shape)))
+
+    selected = coordinates[rng.choice(len(coordinates), min(num_rois, len(coordinates)), replace=False)]
+    corners = selected.astype(float)
+    corners[:, -2] = np.clip(selected[:, -2] - roi_size // 2, 0, shape[-2] - roi_size)
+    corners[:, -1] = np.clip(selected[:, -1] - roi_size // 2, 0, shape[-1] - roi_size)
+    return rectangles(corners, roi_size)
+
+
+
+# tiling and sampling modes of generate_rois
+MODES = ['grid', 'random', 'labels']
+
+
+def generate_rois(mode, shape, roi_size, stride=None, num_rois=1, labels=None, planes=None, rng=None):
+    """
+    Create rois with one of the tiling or sampling modes.
+
+    Parameters
+    ----------
+    mode : str
+        'grid' (see grid_rois), 'random' (see random_rois) or 'labels'
+        (see label_rois)
+    shape : tuple
+        shape of the annotations of the image
+    roi_size : int
+        side length of the rois
+    stride : int, optional
+        distance between rois of the grid
+    num_rois : int
+        number of rois to sample
+    labels : array, optional
+        annotations of the image, only used in 'labels' mode. Without
+        annotations no roi is created in this mode.
+    planes : list of tuple, optional
+        planes in which to create rois for nD images. Default is all planes.
+    rng : numpy.random.Generator, optional
+        random number generator
+
+    Returns
+    -------
+    rois : array
+        (N, 4, ndim) array of rois
+    """
+
+    if mode == 'grid':
+        return grid_rois(shape, roi_size, stride, planes=planes)
+    elif mode == 'random':
+        return random_rois(shape, roi_size, num_rois, planes=planes, rng=rng)
+    elif mode != 'labels':
+        raise ValueError(f"Unknown mode {mode}. Use one of {MODES}")
+    if labels is None:
+        return np.zeros((0, 4, len(shape)))
+    return label_rois(labels, roi_size, num_rois, planes=planes, rng=rng)
+
+
+def remove_overlapping(rois, existing):
+    """
+    Remove the rois overlapping existing rois, e.g. to add rois to a file
+    without covering regions that already have rois.
+
+    Parameters
+    ----------
+    rois : array
+        (N, 4, ndim) array of new rois
+    existing : array or RoiIndex
+        rois of the file or their index
+
+    Returns
+    -------
+    rois : array
+        (M, 4, ndim) array of the rois not overlapping any existing roi
+    """
+
+    index = existing if isinstance(existing, RoiIndex) else RoiIndex(existing)
+    keep = [len(index.overlapping(roi)) == 0 for roi in rois]
+    return rois[np.array(keep, dtype=bool)]